@@ -0,0 +1,71 @@
+"""
+Compares the per-day albedo_decay loop of snotel_max_accumulation.ipynb with
+the segmented-scan scripts.albedo.albedo_decay on the three Daymet sites in
+data/daymet and on a synthetic basin of Daymet pixels, and checks that the
+outputs are exactly equal.
+Run from the repository root:
+    python -m benchmarks.bench_albedo
+"""
+import glob
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.timing import timed
+from scripts.albedo import albedo_decay
+
+N_PIXELS = 2000
+# pixels run through the loop, extrapolated to the basin
+N_LEGACY_PIXELS = 5
+
+albedo_min = 0.5
+albedo_max = 0.9
+landsurf_albedo = 0.2
+
+
+def legacy_albedo_decay(df):
+    """The per-day loop of snotel_max_accumulation.ipynb."""
+    # fill a with 0.2
+    a = np.full(df['swe (kg/m^2)'].shape, landsurf_albedo)
+    for i, snow in enumerate(df['swe (kg/m^2)']):
+        if i == 0:
+            previous_snow = 0
+        else:
+            previous_snow = df['swe (kg/m^2)'].iloc[i-1]
+        if snow == 0:
+            a[i] = landsurf_albedo
+        # if the difference between the previous day and the current day is greater than or equal to 0
+        elif (snow - previous_snow) > 0:
+            # increase albedo to 0.9
+            a[i] = albedo_max
+        else:
+            # decrease albedo towards 0.6 using decay rate of 16 days
+            a[i] = albedo_min + (a[i-1] - albedo_min) * np.exp(-(1)/16)
+    return a
+
+
+if __name__ == '__main__':
+    for filename in sorted(glob.glob('data/daymet/*.csv')):
+        daymet = pd.read_csv(filename, skiprows=7)
+        legacy_time, legacy = timed(legacy_albedo_decay, daymet)
+        new_time, new = timed(albedo_decay, daymet['swe (kg/m^2)'].to_numpy())
+        assert np.array_equal(legacy, new), filename
+        print(f'{filename}: loop {legacy_time * 1e3:.0f} ms, scan {new_time * 1e3:.2f} ms, equal')
+
+    # pixels of the three sites with noise, (time, pixel)
+    rng = np.random.default_rng(0)
+    sites = np.stack([pd.read_csv(f, skiprows=7)['swe (kg/m^2)'].to_numpy()
+                      for f in sorted(glob.glob('data/daymet/*.csv'))], axis=1)
+    swe = sites[:, rng.integers(0, sites.shape[1], N_PIXELS)]
+    swe = np.where(swe > 0, np.round(swe * rng.uniform(0.5, 1.5, N_PIXELS), 2), 0)
+
+    legacy_time = 0
+    for pixel in range(N_LEGACY_PIXELS):
+        elapsed, legacy = timed(legacy_albedo_decay, pd.DataFrame({'swe (kg/m^2)': swe[:, pixel]}))
+        legacy_time += elapsed
+    legacy_time *= N_PIXELS / N_LEGACY_PIXELS
+    new_time, new = timed(albedo_decay, swe)
+    for pixel in range(N_LEGACY_PIXELS):
+        assert np.array_equal(legacy_albedo_decay(pd.DataFrame({'swe (kg/m^2)': swe[:, pixel]})), new[:, pixel])
+    print(f'{N_PIXELS} pixels x {swe.shape[0]} days: loop ~{legacy_time:.0f} s (extrapolated), '
+          f'scan {new_time:.2f} s ({legacy_time / new_time:.0f}x), equal')
@@ -0,0 +1,67 @@
+"""
+Compares the original try-every-format scripts.get_sail_data.date_parser with
+the layout-cached date_parser and the vectorized parse_dates on day-level
+query dates in every accepted format. Their results are checked in
+tests/test_get_sail_data.py.
+Run from the repository root:
+    python -m benchmarks.bench_date_parser
+"""
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.timing import timed
+from scripts.get_sail_data import DATE_FORMATS, date_parser, parse_dates
+
+N_DAYS = 20000
+
+
+def legacy_date_parser(date_string, output_format='%Y%m%d', return_datetime=False):
+    """date_parser before the layout cache, with the broken format of the original list."""
+    date_fmts = [
+        '%Y-%m-%d',
+        '%d.%m.%Y',
+        '%d/%m/%Y',
+        '%Y%m%d',
+        '%Y/%m/%d',
+        '%Y-%m-%dT%H:%M:%S',
+        '%d.%m.%YT%H:%M:%S',
+        '%d/%m/%YT%H:%M:%S',
+        '%Y%m%dT%%H:%M:%S',
+        '%Y/%m/%dT%H:%M:%S',
+    ]
+    for fmt in date_fmts:
+        try:
+            datetime_obj = dt.datetime.strptime(date_string, fmt)
+            if return_datetime:
+                return datetime_obj
+            else:
+                return datetime_obj.strftime(output_format)
+        except ValueError:
+            pass
+    fmt_strings = ', '.join(date_fmts)
+    raise ValueError('Invalid Date format, please use one of these formats ' + fmt_strings)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    days = pd.date_range('2021-09-01', periods=N_DAYS, freq='D')
+    datetimes = days + pd.to_timedelta(rng.integers(0, 86400, N_DAYS), unit='s')
+    for fmt in DATE_FORMATS:
+        strings = [x.strftime(fmt) for x in datetimes]
+        if fmt == '%Y%m%dT%H:%M:%S':
+            # the original list spelled this format '%Y%m%dT%%H:%M:%S', nothing parsed
+            legacy_time = float('nan')
+        else:
+            legacy_time, _ = timed(lambda: [legacy_date_parser(x, return_datetime=True) for x in strings])
+        scalar_time, _ = timed(lambda: [date_parser(x, return_datetime=True) for x in strings])
+        vector_time, _ = timed(parse_dates, strings)
+        print(f'{fmt:20s} loop {legacy_time * 1e3:7.1f} ms, cached {scalar_time * 1e3:6.1f} ms, '
+              f'vectorized {vector_time * 1e3:5.1f} ms')
+
+    # every format mixed in one array
+    strings = np.array([x.strftime(DATE_FORMATS[i % len(DATE_FORMATS)]) for i, x in enumerate(datetimes)])
+    scalar_time, _ = timed(lambda: [date_parser(x, return_datetime=True) for x in strings])
+    vector_time, _ = timed(parse_dates, strings)
+    print(f'{N_DAYS} mixed formats: cached {scalar_time * 1e3:.1f} ms, vectorized {vector_time * 1e3:.1f} ms')
@@ -0,0 +1,88 @@
+"""
+Compares the per-file concat-and-sort loop that get_sail_data used to run
+with the single lazy multi-file open of `open_sail_files`.
+Synthetic daily MET-like netCDF files are written to a temporary directory.
+Run from the repository root:
+    python -m benchmarks.bench_sail_concat
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from scripts.get_sail_data import open_sail_files
+
+N_FILES = [10, 100, 500]
+# one minute data, one file per day
+SAMPLES_PER_FILE = 1440
+N_VARIABLES = 20
+
+
+def write_synthetic_files(directory, n_files, datastream='gucmetM1.b1'):
+    """Writes *n_files* daily ARM-like files and returns their paths."""
+    files = []
+    start = pd.Timestamp('2022-01-01')
+    rng = np.random.default_rng(0)
+    for i in range(n_files):
+        day = start + pd.Timedelta(days=i)
+        times = pd.date_range(day, periods=SAMPLES_PER_FILE, freq='1min')
+        ds = xr.Dataset(
+            {f'var_{j}': ('time', rng.standard_normal(SAMPLES_PER_FILE).astype('float32'))
+             for j in range(N_VARIABLES)},
+            coords={'time': times},
+        )
+        fname = os.path.join(directory, f'{datastream}.{day:%Y%m%d}.000000.nc')
+        ds.to_netcdf(fname)
+        files.append(fname)
+    # shuffle so both paths have to order the files
+    rng.shuffle(files)
+    return files
+
+
+def concat_loop(files):
+    """The previous get_sail_data loop: concat and re-sort once per file."""
+    for i, fname in enumerate(files):
+        if i == 0:
+            ds = xr.open_dataset(fname).load()
+        else:
+            tmp = xr.open_dataset(fname).load()
+            ds = xr.concat([ds, tmp], dim='time').sortby('time')
+    return ds
+
+
+def lazy_open(files):
+    ds = open_sail_files(files, time_chunk=SAMPLES_PER_FILE)
+    return ds
+
+
+def run(func, files):
+    ds = func(files)
+    ds['var_0'].mean().compute()
+    ds.close()
+
+
+def measure(func, files):
+    """Returns wall time and peak traced memory of reducing func(files)."""
+    start = time.perf_counter()
+    run(func, files)
+    elapsed = time.perf_counter() - start
+    # tracemalloc slows python down, so memory is measured in a second run
+    tracemalloc.start()
+    run(func, files)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    print(f'{"files":>6} {"method":>12} {"time (s)":>10} {"peak (MB)":>10}')
+    for n_files in N_FILES:
+        with tempfile.TemporaryDirectory() as directory:
+            files = write_synthetic_files(directory, n_files)
+            for name, func in [('concat_loop', concat_loop), ('lazy_open', lazy_open)]:
+                elapsed, peak = measure(func, files)
+                print(f'{n_files:>6} {name:>12} {elapsed:>10.2f} {peak / 1e6:>10.1f}')
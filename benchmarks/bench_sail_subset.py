@@ -0,0 +1,73 @@
+"""
+Compares decoding every variable of a SAIL file with the variable and time
+subsetting of `open_sail_files`.
+The sample ECOR file in data/ only holds 9 variables, so a synthetic
+one hour, 20 Hz tower file with every variable of scripts.variables is timed too.
+Run from the repository root:
+    python -m benchmarks.bench_sail_subset
+"""
+import datetime as dt
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from scripts.get_sail_data import open_sail_files
+from scripts.variables import VARIABLE_GROUPS
+
+FILES = {
+    'ecor': ('data/eddy_covariance_kettle_ponds_20220818_20220820.nc', ['sensible_heat_flux']),
+    'met': ('data/met_20220818_20220820.nc', ['temp_mean', 'wspd_vec_mean', 'wdir_vec_mean']),
+}
+START = dt.datetime(2022, 8, 18, 12)
+END = dt.datetime(2022, 8, 18, 12, 30)
+REPEATS = 10
+
+
+def write_synthetic_tower_file(directory):
+    """Writes a one hour, 20 Hz file holding every tower variable."""
+    times = pd.date_range('2022-08-18 12:00', '2022-08-18 13:00', freq='50ms', inclusive='left')
+    rng = np.random.default_rng(0)
+    names = [v for group in VARIABLE_GROUPS.values() for v in group]
+    ds = xr.Dataset(
+        {v: ('time', rng.standard_normal(len(times)).astype('float32')) for v in names},
+        coords={'time': times},
+    )
+    fname = os.path.join(directory, 'sos.tower.20220818.000000.nc')
+    ds.to_netcdf(fname)
+    return fname
+
+
+def full_decode(fname, variables):
+    return xr.open_dataset(fname).load()
+
+
+def subset_decode(fname, variables):
+    return open_sail_files([fname], variables=variables, start=START, end=END).load()
+
+
+def measure(func, fname, variables):
+    """Returns mean wall time and peak traced memory of func."""
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func(fname, variables).close()
+    elapsed = (time.perf_counter() - start) / REPEATS
+    tracemalloc.start()
+    func(fname, variables).close()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    print(f'{"file":>6} {"method":>14} {"time (ms)":>10} {"peak (MB)":>10}')
+    directory = tempfile.mkdtemp()
+    FILES['tower'] = (write_synthetic_tower_file(directory), 'PRESSURE_VARIABLES')
+    for name, (fname, variables) in FILES.items():
+        for method, func in [('full_decode', full_decode), ('subset_decode', subset_decode)]:
+            elapsed, peak = measure(func, fname, variables)
+            print(f'{name:>6} {method:>14} {elapsed * 1e3:>10.1f} {peak / 1e6:>10.2f}')
@@ -0,0 +1,73 @@
+"""
+Compares the per-water-year days-until-meltout loop of
+snotel_max_accumulation.ipynb with scripts.snow_events on a synthetic SNOTEL
+network of 900 stations x 40 water years, and checks that both agree.
+Run from the repository root:
+    python -m benchmarks.bench_snow_events
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from scripts.snow_events import days_until_meltout, snow_events
+from scripts.water_year import add_water_year_columns
+
+N_STATIONS = 900
+START = '1980-10-01'
+END = '2020-09-30'
+# stations run through the loop, extrapolated to the network
+N_LEGACY_STATIONS = 3
+
+
+def legacy_days_until_meltout(df):
+    """The water_year loop of snotel_max_accumulation.ipynb for one station."""
+    df = df.copy()
+    for i, year in enumerate(df['water_year'].unique()):
+        year_df = df[df['water_year'] == year]
+        year_df = year_df[year_df['dowy'] > 92]
+        snow_dissapearance = year_df['SWE'].idxmin()
+        if year_df.empty:
+            continue
+        else:
+            df.loc[(df['water_year'] == year) & (df['dowy'] < year_df.iloc[0]['dowy']), 'before_melt'] = -(df['dowy'] - year_df.loc[snow_dissapearance]['dowy'])
+            df.loc[(df['water_year'] == year) & (df['dowy'] >= year_df.iloc[0]['dowy']), 'after_melt'] = -(df['dowy'] - year_df.loc[snow_dissapearance]['dowy'])
+            df['days_until_meltout'] = df['before_melt'].combine_first(df['after_melt'])
+    return df['days_until_meltout']
+
+
+def synthetic_swe(dates, rng):
+    # a triangular accumulation and melt season with a random peak and noise
+    dowy = add_water_year_columns(pd.DataFrame({'datetime': dates}))['dowy'].to_numpy()
+    peak_dowy = rng.integers(150, 220)
+    peak = rng.uniform(200, 1500)
+    swe = np.where(dowy < peak_dowy, peak * np.clip((dowy - 40) / (peak_dowy - 40), 0, 1),
+                   peak * np.clip(1 - (dowy - peak_dowy) / 70, 0, 1))
+    return np.round(swe + rng.normal(0, 5, swe.size).clip(0), 1) * (swe > 0)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    dates = pd.date_range(START, END, freq='D')
+    df = pd.DataFrame({
+        'station': np.repeat(np.arange(N_STATIONS), len(dates)),
+        'datetime': np.tile(dates.values, N_STATIONS),
+        'SWE': np.concatenate([synthetic_swe(dates, rng) for _ in range(N_STATIONS)]),
+    })
+
+    start = time.perf_counter()
+    events = snow_events(df)
+    until_meltout = days_until_meltout(df, events)
+    new_time = time.perf_counter() - start
+
+    legacy_time = 0
+    for station in range(N_LEGACY_STATIONS):
+        station_df = add_water_year_columns(df[df['station'] == station].reset_index(drop=True))
+        start = time.perf_counter()
+        legacy = legacy_days_until_meltout(station_df)
+        legacy_time += time.perf_counter() - start
+        new = until_meltout[df['station'] == station].to_numpy()
+        assert np.array_equal(legacy.to_numpy(), new), f'station {station} differs'
+    legacy_time *= N_STATIONS / N_LEGACY_STATIONS
+    print(f'{N_STATIONS} stations x {len(dates)} days ({len(df):.1e} rows), {len(events)} station-years: '
+          f'loop ~{legacy_time:.0f} s (extrapolated), vectorized {new_time:.2f} s; days until meltout agree')
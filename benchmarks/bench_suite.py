@@ -0,0 +1,278 @@
+"""
+Times the data loaders and analysis helpers on synthetic inputs shaped like
+the real ones (ARM SAIL netCDF, Snodgrass AWS csv and meta file, radiosonde
+.cdf files and monthly PRISM/IMERG-like cubes) across input sizes, and
+appends wall time, peak traced memory and the per-stage timings reported
+through scripts.instrument to a JSON history. With --compare every result is
+compared with the previous run of the same benchmark and size.
+Everything runs offline in a temporary directory.
+Run from the repository root:
+    python -m benchmarks.bench_suite
+    python -m benchmarks.bench_suite --sizes small medium large --compare
+    python -m benchmarks.bench_suite --only windrose snodgrass_store
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from benchmarks.bench_sail_concat import write_synthetic_files
+from scripts.get_sail_data import get_sail_data
+from scripts.get_snodgrass_data import get_snodgrass_data, snodgrass_store_path
+from scripts.helper_funcs import create_windrose_df, simple_sounding
+from scripts.instrument import record_timings, summarize_timings
+from scripts.intercompare import intercompare
+from scripts.regrid import regrid
+from scripts.soundings import composite_soundings
+
+HISTORY_FILE = os.path.join(os.path.dirname(__file__), 'history.json')
+# a result this many times slower than the previous run is flagged
+REGRESSION_RATIO = 1.25
+SAIL_DATASTREAM = 'gucmetM1.b1'
+# input size of every benchmark: files, rows, levels or months
+SIZES = {
+    'sail_local': {'small': 10, 'medium': 100, 'large': 500},
+    'snodgrass_ingest': {'small': 8760, 'medium': 87600, 'large': 876000},
+    'snodgrass_store': {'small': 8760, 'medium': 87600, 'large': 876000},
+    'windrose': {'small': 10**5, 'medium': 10**6, 'large': 10**7},
+    'simple_sounding': {'small': 1000, 'medium': 6000, 'large': 20000},
+    'composite_soundings': {'small': 10, 'medium': 50, 'large': 200},
+    'regrid': {'small': 12, 'medium': 60, 'large': 240},
+    'regrid_cached': {'small': 12, 'medium': 60, 'large': 240},
+    'intercompare': {'small': 60, 'medium': 240, 'large': 1200},
+}
+SNODGRASS_COLUMNS = ['year', 'month', 'day', 'hour (MST)', 'minute', 'Tair (deg C)', 'RH (%)',
+                     'wind speed (m/s)', 'wind direction (deg)', 'SWE (mm)', 'snow depth (cm)']
+
+
+def write_snodgrass_files(directory, n_rows):
+    """Writes an hourly Snodgrass-like AWS csv and its meta file."""
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2010-10-01', periods=n_rows, freq='h')
+    data = pd.DataFrame({'year': times.year, 'month': times.month, 'day': times.day, 'hour': times.hour,
+                         'minute': times.minute})
+    for column in SNODGRASS_COLUMNS[5:]:
+        data[column] = np.round(rng.uniform(0, 100, n_rows), 2)
+    filename = os.path.join(directory, 'SND_opn_AWS_data_001hr.csv')
+    filemeta = os.path.join(directory, 'SND_opn_AWS_data_meta.txt')
+    data.to_csv(filename, header=False, index=False)
+    with open(filemeta, 'w') as f:
+        f.write('SND_opn\nlat = 38.92\nlon = -106.98\nelevation = 3350\n')
+        f.writelines(f'column {i} = {column}\n' for i, column in enumerate(SNODGRASS_COLUMNS))
+    return filename, filemeta
+
+
+def write_sonde_files(directory, n_files, n_levels=3000):
+    """Writes ARM-like radiosonde .cdf files and returns their paths."""
+    rng = np.random.default_rng(0)
+    files = []
+    for i in range(n_files):
+        launch = pd.Timestamp('2022-08-18 11:30') + pd.Timedelta(hours=12 * i)
+        pres = np.linspace(700, 150, n_levels)
+        height = np.linspace(0, 1, n_levels)
+        ds = xr.Dataset({
+            'pres': ('time', pres, {'units': 'hPa'}),
+            'tdry': ('time', 20 - 75 * height + rng.normal(0, 0.3, n_levels), {'units': 'degC'}),
+            'rh': ('time', rng.uniform(20, 90, n_levels), {'units': '%'}),
+            'u_wind': ('time', 5 + 20 * height + rng.normal(0, 1, n_levels), {'units': 'm/s'}),
+            'v_wind': ('time', rng.normal(0, 3, n_levels), {'units': 'm/s'}),
+        }, coords={'time': launch + pd.to_timedelta(np.arange(n_levels), unit='s')})
+        fname = os.path.join(directory, f'gucsondewnpnM1.b1.{launch:%Y%m%d.%H%M%S}.cdf')
+        ds.to_netcdf(fname)
+        files.append(fname)
+    return files
+
+
+def monthly_cube(n_months, resolution, seed=0):
+    """Returns a monthly precipitation cube on a UCRB-sized lat/lon grid."""
+    rng = np.random.default_rng(seed)
+    x = np.arange(-112, -105, resolution) + resolution / 2
+    y = np.arange(43, 36, -resolution) - resolution / 2
+    months = pd.date_range('2000-01-01', periods=n_months, freq='MS')
+    ppt = rng.gamma(2, 30, (n_months, y.size, x.size))
+    return xr.DataArray(ppt, coords={'month': months, 'y': y, 'x': x}, dims=('month', 'y', 'x'), name='ppt')
+
+
+def setup_sail_local(directory, n):
+    # the file cache layout of download_sail_files, read with local_only
+    os.makedirs(os.path.join(directory, SAIL_DATASTREAM))
+    write_synthetic_files(os.path.join(directory, SAIL_DATASTREAM), n, SAIL_DATASTREAM)
+    return directory,
+
+
+def run_sail_local(directory):
+    ds = get_sail_data(None, None, SAIL_DATASTREAM, '2022-01-01', '2030-01-01', cache_dir=directory,
+                       local_only=True)
+    ds['var_0'].mean().compute()
+    ds.close()
+
+
+def run_snodgrass_ingest(filename, filemeta):
+    shutil.rmtree(snodgrass_store_path(filename), ignore_errors=True)
+    get_snodgrass_data(filename, filemeta)
+
+
+def setup_snodgrass_store(directory, n):
+    filename, filemeta = write_snodgrass_files(directory, n)
+    get_snodgrass_data(filename, filemeta)
+    return filename, filemeta
+
+
+def run_snodgrass_store(filename, filemeta):
+    # the first winter of the record
+    get_snodgrass_data(filename, filemeta, columns=['SWE', 'Tair'], start='2010-12-01', end='2011-03-01')
+
+
+def setup_windrose(directory, n):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({'spd_3m_c': rng.gamma(2, 2, n), 'dir_3m_c': rng.uniform(0, 360, n)}),
+
+
+def run_windrose(df):
+    create_windrose_df(df, 'dir_3m_c', 'spd_3m_c')
+
+
+def setup_simple_sounding(directory, n):
+    fname, = write_sonde_files(directory, 1, n_levels=n)
+    return fname,
+
+
+def run_simple_sounding(fname):
+    with xr.open_dataset(fname) as ds:
+        fig = simple_sounding(ds.load())
+    plt.close(fig)
+
+
+def setup_composite_soundings(directory, n):
+    return write_sonde_files(directory, n),
+
+
+def run_composite_soundings(files):
+    composite_soundings(files, groupby='hour')
+
+
+def setup_regrid(directory, n):
+    # PRISM 4 km to the IMERG 0.1 degree grid, building the weights on every call
+    return monthly_cube(n, 1 / 24), monthly_cube(1, 0.1).isel(month=0), None
+
+
+def setup_regrid_cached(directory, n):
+    prism, imerg, _ = setup_regrid(directory, n)
+    return prism, imerg, directory
+
+
+def run_regrid(prism, imerg, cache_dir):
+    regrid(prism, imerg, method='conservative', src_crs=4326, dst_crs=4326, cache_dir=cache_dir)
+
+
+def setup_intercompare(directory, n):
+    return monthly_cube(n, 0.1, seed=0), monthly_cube(n, 0.1, seed=1)
+
+
+def run_intercompare(x, y):
+    intercompare(x, y, groupby='month')
+
+
+# name -> (setup(directory, size) returning the run arguments, run)
+BENCHMARKS = {
+    'sail_local': (setup_sail_local, run_sail_local),
+    'snodgrass_ingest': (write_snodgrass_files, run_snodgrass_ingest),
+    'snodgrass_store': (setup_snodgrass_store, run_snodgrass_store),
+    'windrose': (setup_windrose, run_windrose),
+    'simple_sounding': (setup_simple_sounding, run_simple_sounding),
+    'composite_soundings': (setup_composite_soundings, run_composite_soundings),
+    'regrid': (setup_regrid, run_regrid),
+    'regrid_cached': (setup_regrid_cached, run_regrid),
+    'intercompare': (setup_intercompare, run_intercompare),
+}
+
+
+def measure(run, args):
+    """Returns wall time, peak traced memory and stage timings of run(*args)."""
+    # one untimed run first, so imports, matplotlib setup and the weight caches are warm
+    run(*args)
+    with record_timings() as timings:
+        start = time.perf_counter()
+        run(*args)
+        elapsed = time.perf_counter() - start
+    # tracemalloc slows python down, so memory is measured in a second run
+    tracemalloc.start()
+    run(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, summarize_timings(timings)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def previous_result(history, name, n):
+    # the latest earlier result of a benchmark at the same input size
+    for run in reversed(history):
+        for result in run['results']:
+            if result['benchmark'] == name and result['n'] == n:
+                return result
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=['small', 'medium', 'large'])
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--history', default=HISTORY_FILE, help='JSON history file')
+    parser.add_argument('--compare', action='store_true', help='compare with the previous run')
+    parser.add_argument('--no-save', action='store_true', help='do not append to the history')
+    args = parser.parse_args()
+
+    history = read_history(args.history)
+    results = []
+    print(f'{"benchmark":>20} {"size":>8} {"n":>9} {"time (s)":>10} {"peak (MB)":>10}  stages')
+    for name in args.only or BENCHMARKS:
+        setup, run = BENCHMARKS[name]
+        for size in args.sizes:
+            n = SIZES[name][size]
+            with tempfile.TemporaryDirectory() as directory:
+                elapsed, peak, stages = measure(run, setup(directory, n))
+            result = {'benchmark': name, 'size': size, 'n': n, 'seconds': elapsed, 'peak_mb': peak / 1e6,
+                      'stages': stages}
+            results.append(result)
+            line = (f'{name:>20} {size:>8} {n:>9} {elapsed:>10.3f} {peak / 1e6:>10.1f}  '
+                    + ', '.join(f'{key} {value:.3f}' for key, value in stages.items()))
+            previous = previous_result(history, name, n) if args.compare else None
+            if previous is not None:
+                ratio = elapsed / previous['seconds']
+                line += f'  [{ratio:.2f}x previous{", REGRESSION" if ratio > REGRESSION_RATIO else ""}]'
+            print(line)
+
+    if not args.no_save:
+        history.append({'timestamp': dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds'),
+                        'commit': git_commit(), 'python': platform.python_version(),
+                        'platform': platform.platform(), 'results': results})
+        with open(args.history + '.tmp', 'w') as f:
+            json.dump(history, f, indent=1)
+        os.replace(args.history + '.tmp', args.history)
@@ -0,0 +1,66 @@
+"""
+Compares the row-wise calendar columns of snotel_max_accumulation.ipynb with
+the vectorized scripts.water_year functions on a 40-year daily record for
+300 stations, and lists the dates where the notebook's `year % 4` dowy rule
+disagrees with the calendar.
+Run from the repository root:
+    python -m benchmarks.bench_water_year
+"""
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.timing import timed
+from scripts.water_year import day_of_water_year, water_year, yday_to_date
+
+N_STATIONS = 300
+START = '1980-10-01'
+END = '2020-09-30'
+# rows timed with the row-wise functions, extrapolated to the full record
+N_LEGACY_ROWS = 10**5
+
+
+def legacy_dowy(date):
+    """The per-row dowy() of snotel_max_accumulation.ipynb."""
+    if date.day_of_year < 274:
+        if date.year % 4 == 0:
+            return date.day_of_year + 93
+        else:
+            return date.day_of_year + 92
+    else:
+        if date.year % 4 == 0:
+            return date.day_of_year - 274
+        else:
+            return date.day_of_year - 273
+
+
+if __name__ == '__main__':
+    days = pd.date_range(START, END, freq='D')
+    dates = pd.Series(np.tile(days.values, N_STATIONS))
+    n_rows = len(dates)
+
+    sample = dates.iloc[:N_LEGACY_ROWS]
+    daymet = pd.DataFrame({'year': sample.dt.year, 'yday': sample.dt.dayofyear})
+    legacy_time, _ = timed(lambda: (
+        daymet.apply(lambda row: dt.datetime(int(row['year']), 1, 1) + dt.timedelta(int(row['yday']) - 1), axis=1),
+        sample.apply(legacy_dowy),
+        sample.apply(lambda date: date.year if date.month < 10 else date.year + 1),
+    ))
+    legacy_time *= n_rows / N_LEGACY_ROWS
+
+    daymet = pd.DataFrame({'year': dates.dt.year, 'yday': dates.dt.dayofyear})
+    new_time, _ = timed(lambda: (
+        yday_to_date(daymet['year'], daymet['yday']),
+        day_of_water_year(dates),
+        water_year(dates),
+    ))
+    print(f'{N_STATIONS} stations x {len(days)} days ({n_rows:.1e} rows): '
+          f'row-wise ~{legacy_time:.0f} s (extrapolated), vectorized {new_time:.2f} s')
+
+    legacy = days.to_series().apply(legacy_dowy).to_numpy()
+    dowy = day_of_water_year(days)
+    wrong = days[legacy != dowy]
+    print(f'year % 4 dowy differs on {len(wrong)} of {len(days)} days, e.g. '
+          + ', '.join(f'{d:%Y-%m-%d} ({l} vs {n})' for d, l, n in
+                      zip(wrong[:3], legacy[legacy != dowy][:3], dowy[legacy != dowy][:3])))
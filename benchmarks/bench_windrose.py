@@ -0,0 +1,58 @@
+"""
+Compares the previous pandas cut/groupby create_windrose_df with the NumPy
+wind rose engine (`windrose_counts`) on 10^7 rows, and times one batched
+call over every sonic of WIND_VARIABLES.
+Run from the repository root:
+    python -m benchmarks.bench_windrose
+"""
+import numpy as np
+import pandas as pd
+
+from benchmarks.timing import timed
+from scripts.helper_funcs import WIND_VARIABLES, create_windrose_df, windrose_counts
+
+N_ROWS = 10**7
+# 5-minute data over a season for the batched call
+N_ROWS_BATCHED = 10**5
+
+
+def legacy_create_windrose_df(df, wind_dir_var, wind_spd_var):
+    """The pandas cut/groupby implementation replaced by windrose_counts."""
+    df['speed_bins'] = pd.cut(df[wind_spd_var],
+                              bins=[0, 2, 4, 6, 8, 10, 12, 14, 50],
+                              labels=['0-2', '2-4', '4-6', '6-8', '8-10', '10-12', '12-14', '>14+'])
+    theta_labels = [
+        'N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+        'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW',
+    ]
+    theta_angles = np.arange(0, 360.1, 22.5)
+    df['dir_bins'] = pd.cut(df[wind_dir_var], bins=theta_angles, labels=theta_labels)
+    windrose_df = df.groupby(['dir_bins', 'speed_bins'], observed=False).count().dropna()
+    windrose_df['direction'] = windrose_df.index.get_level_values('dir_bins')
+    windrose_df['speed'] = windrose_df.index.get_level_values('speed_bins')
+    windrose_df = windrose_df[
+        ['direction', 'speed', wind_spd_var]
+    ].droplevel(0).reset_index().drop('speed_bins', axis=1)
+    windrose_df.rename(columns={wind_spd_var: 'frequency'}, inplace=True)
+    windrose_df['frequency'] = 100 * windrose_df['frequency'] / windrose_df['frequency'].sum()
+    return windrose_df
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'spd': rng.gamma(2, 2, N_ROWS),
+        'dir': rng.uniform(0, 360, N_ROWS),
+    })
+    legacy_time, _ = timed(legacy_create_windrose_df, df.copy(), 'dir', 'spd')
+    new_time, _ = timed(create_windrose_df, df, 'dir', 'spd')
+    print(f'{N_ROWS:.0e} rows: legacy {legacy_time:.2f} s, numpy {new_time:.2f} s '
+          f'({legacy_time / new_time:.0f}x)')
+
+    spd_vars = [x for x in WIND_VARIABLES if x.startswith('spd_')]
+    dir_vars = [x for x in WIND_VARIABLES if x.startswith('dir_')]
+    speed = rng.gamma(2, 2, (N_ROWS_BATCHED, len(spd_vars)))
+    direction = rng.uniform(0, 360, (N_ROWS_BATCHED, len(dir_vars)))
+    batched_time, counts = timed(windrose_counts, speed, direction)
+    print(f'{len(spd_vars)} sonics x {N_ROWS_BATCHED:.0e} rows in one call: {batched_time:.2f} s, '
+          f'counts shape {counts.shape}')
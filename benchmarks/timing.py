@@ -0,0 +1,10 @@
+"""
+Wall-clock timing shared by the standalone comparison benchmarks.
+"""
+import time
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
@@ -0,0 +1,73 @@
+import numpy as np
+import xarray as xr
+
+# snow albedo model parameters of snotel_max_accumulation.ipynb
+ALBEDO_MIN = 0.5
+ALBEDO_MAX = 0.9
+LAND_SURFACE_ALBEDO = 0.2
+# e-folding time (days) of the decay towards ALBEDO_MIN
+ALBEDO_DECAY_DAYS = 16
+
+
+def _decay_table(start, n_steps, albedo_min, decay):
+    # albedo n days after a reset to start, with the same float operations, in the same order, as the day loop
+    table = np.empty(n_steps + 1)
+    table[0] = start
+    for i in range(1, n_steps + 1):
+        table[i] = albedo_min + (table[i - 1] - albedo_min) * decay
+    return table
+
+
+def albedo_decay(swe, albedo_min=ALBEDO_MIN, albedo_max=ALBEDO_MAX, land_albedo=LAND_SURFACE_ALBEDO,
+                 decay_days=ALBEDO_DECAY_DAYS):
+    """
+    This function models daily snow albedo from SWE: land albedo without snow, albedo_max on days SWE increases,
+    and an exponential decay towards albedo_min otherwise
+    The day to day recurrence is evaluated as a segmented scan: every day is a number of days after the last
+    reset (no snow or new snow), and the decayed albedo is looked up in a table built with the loop's own
+    arithmetic, so the result equals the loop bit for bit
+    Inputs:
+        swe: 1d (time) or 2d (time, location) array of SWE
+        albedo_min: albedo the snow decays to
+        albedo_max: albedo of new snow
+        land_albedo: albedo of the snow free surface
+        decay_days: e-folding time (days) of the decay
+    Outputs:
+        albedo: array of the shape of swe
+    """
+    swe = np.asarray(swe, dtype=float)
+    n_days = swe.shape[0]
+    previous = np.concatenate([np.zeros_like(swe[:1]), swe[:-1]])
+    bare = swe == 0
+    new_snow = ~bare & ((swe - previous) > 0)
+    days = np.arange(n_days).reshape((-1,) + (1,) * (swe.ndim - 1))
+    # day of the last reset, -1 before the first one; the loop then decays from its initial land albedo
+    last_reset = np.maximum.accumulate(np.where(bare | new_snow, days, -1), axis=0)
+    since_reset = days - last_reset
+    from_new_snow = np.take_along_axis(new_snow, np.maximum(last_reset, 0), axis=0) & (last_reset >= 0)
+    decay = np.exp(-1 / decay_days)
+    # tables only as long as the longest run without a reset
+    n_steps = int(since_reset.max()) if since_reset.size else 0
+    land_table = _decay_table(land_albedo, n_steps, albedo_min, decay)
+    snow_table = _decay_table(albedo_max, n_steps, albedo_min, decay)
+    return np.where(from_new_snow, snow_table[since_reset], land_table[since_reset])
+
+
+def albedo_decay_xr(swe, time_dim='time', **kwargs):
+    """
+    This function runs albedo_decay on an xarray SWE cube, e.g. Daymet swe on (time, y, x), chunk by chunk
+    when it is dask backed; chunk across space, time has to be one chunk
+    Inputs:
+        swe: xarray dataarray of SWE with a time dimension
+        time_dim: name of the time dimension
+        kwargs: parameters of albedo_decay
+    Outputs:
+        albedo: xarray dataarray like swe
+    """
+    def _albedo(values):
+        # apply_ufunc moves time last
+        return np.moveaxis(albedo_decay(np.moveaxis(values, -1, 0), **kwargs), 0, -1)
+
+    albedo = xr.apply_ufunc(_albedo, swe, input_core_dims=[[time_dim]], output_core_dims=[[time_dim]],
+                            dask='parallelized', output_dtypes=[float])
+    return albedo.transpose(*swe.dims).rename('albedo')
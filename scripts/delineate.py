@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import geopandas as gpd
+import shapely
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import breadth_first_order
+from scipy.spatial import cKDTree
+
+from scripts.zonal import BASIN_POLYGON_DIR
+
+# conditioned flow grids, one directory per DEM checksum
+FLOW_GRID_DIR = './data/basin_polygons/flow_grids/'
+# pysheds D8 direction values of N, NE, E, SE, S, SW, W, NW, as in compare_IMERG_PRISM.ipynb
+DIRMAP = (64, 128, 1, 2, 4, 8, 16, 32)
+# (row, col) step of every direction of DIRMAP
+D8_OFFSETS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+# pour points are snapped to the nearest cell draining more cells than this
+SNAP_ACCUMULATION = 1000
+# basin areas are computed in UTM 13N (the UCRB's zone); the polygons stay in the crs of the grid, EPSG:4326 for
+# the notebook's ucrb_dem_150m_4326.tif
+BASIN_AREA_CRS = 'EPSG:32613'
+
+
+def dem_checksum(path, chunk_size=2**24):
+    # sha1 of the DEM file contents, the key of its flow grids
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def condition_dem(dem_path, dirmap=DIRMAP):
+    """
+    This function conditions a DEM and computes D8 flow direction and accumulation with pysheds, the expensive
+    steps of the notebook's generate_basins branch
+    Inputs:
+        dem_path: string of the DEM raster, e.g. ./data/basin_polygons/ucrb_dem_150m_4326.tif
+        dirmap: D8 direction values
+    Outputs:
+        fdir: 2d int16 array of flow directions
+        acc: 2d float64 array of flow accumulation (cells)
+        meta: dictionary of the affine transform (a, b, c, d, e, f), crs and dirmap
+    """
+    from pysheds.grid import Grid
+    grid = Grid.from_raster(dem_path)
+    dem = grid.read_raster(dem_path)
+    # fill pits and depressions, then resolve flats
+    inflated_dem = grid.resolve_flats(grid.fill_depressions(grid.fill_pits(dem)))
+    fdir = grid.flowdir(inflated_dem, dirmap=dirmap)
+    acc = grid.accumulation(fdir, dirmap=dirmap)
+    meta = {'affine': list(fdir.affine)[:6], 'crs': fdir.crs.srs, 'dirmap': list(dirmap)}
+    return np.asarray(fdir, dtype=np.int16), np.asarray(acc, dtype=np.float64), meta
+
+
+def downstream_cells(fdir, dirmap=DIRMAP):
+    # flat index of the cell every cell drains to, -1 for pits, flats, nodata and the grid edge
+    n_rows, n_cols = fdir.shape
+    rows, cols = np.indices(fdir.shape)
+    downstream = np.full(fdir.shape, -1, dtype=np.int64)
+    for value, (drow, dcol) in zip(dirmap, D8_OFFSETS):
+        cells = fdir == value
+        to_row, to_col = rows[cells] + drow, cols[cells] + dcol
+        inside = (to_row >= 0) & (to_row < n_rows) & (to_col >= 0) & (to_col < n_cols)
+        downstream[rows[cells][inside], cols[cells][inside]] = to_row[inside] * n_cols + to_col[inside]
+    return downstream.ravel()
+
+
+def save_flow_grids(fdir, acc, meta, cache_dir):
+    """
+    This function writes conditioned flow grids as .npy files that are memory mapped when read, with the
+    upstream graph used for delineation
+    Inputs:
+        fdir: 2d array of flow directions
+        acc: 2d array of flow accumulation
+        meta: dictionary from condition_dem
+        cache_dir: string of the directory of this DEM's grids
+    Outputs:
+        cache_dir: string of the directory
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    downstream = downstream_cells(fdir, meta['dirmap'])
+    # cells grouped by the cell they drain to: the upstream neighbours of cell i are
+    # upstream_indices[upstream_indptr[i]:upstream_indptr[i + 1]]
+    drains = np.flatnonzero(downstream >= 0)
+    order = np.argsort(downstream[drains], kind='stable')
+    indptr = np.zeros(downstream.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(downstream[drains], minlength=downstream.size), out=indptr[1:])
+    arrays = {'fdir': np.asarray(fdir, dtype=np.int16), 'acc': np.asarray(acc, dtype=np.float64),
+              'upstream_indptr': indptr, 'upstream_indices': drains[order]}
+    for name, array in arrays.items():
+        np.save(os.path.join(cache_dir, f'{name}.tmp.npy'), array)
+        os.replace(os.path.join(cache_dir, f'{name}.tmp.npy'), os.path.join(cache_dir, f'{name}.npy'))
+    # the meta file is written last, so a directory with one holds complete grids
+    with open(os.path.join(cache_dir, 'meta.json.tmp'), 'w') as f:
+        json.dump({**meta, 'shape': list(np.shape(fdir))}, f)
+    os.replace(os.path.join(cache_dir, 'meta.json.tmp'), os.path.join(cache_dir, 'meta.json'))
+    return cache_dir
+
+
+def load_flow_grids(cache_dir):
+    """
+    This function opens flow grids written by save_flow_grids without reading them into memory
+    Inputs:
+        cache_dir: string of the directory of the grids
+    Outputs:
+        flow_grids: dictionary of memory mapped fdir, acc, upstream_indptr and upstream_indices, the affine,
+                    crs, dirmap and shape, and the upstream graph
+    """
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        flow_grids = json.load(f)
+    for name in ('fdir', 'acc', 'upstream_indptr', 'upstream_indices'):
+        flow_grids[name] = np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r')
+    n_cells = int(np.prod(flow_grids['shape']))
+    # csgraph works on float64 csr matrices, built once here rather than on every catchment
+    flow_grids['upstream'] = sparse.csr_matrix(
+        (np.ones(flow_grids['upstream_indices'].size), flow_grids['upstream_indices'], flow_grids['upstream_indptr']),
+        shape=(n_cells, n_cells))
+    return flow_grids
+
+
+def get_flow_grids(dem_path, cache_dir=FLOW_GRID_DIR):
+    """
+    This function returns the flow grids of a DEM, conditioning it only if its checksum has no cached grids
+    Inputs:
+        dem_path: string of the DEM raster
+        cache_dir: directory of the flow grid caches
+    Outputs:
+        flow_grids: dictionary from load_flow_grids
+    """
+    grid_dir = os.path.join(cache_dir, dem_checksum(dem_path))
+    if not os.path.exists(os.path.join(grid_dir, 'meta.json')):
+        save_flow_grids(*condition_dem(dem_path), grid_dir)
+    return load_flow_grids(grid_dir)
+
+
+def snap_pour_points(flow_grids, x, y, threshold=SNAP_ACCUMULATION):
+    """
+    This function moves pour points to the nearest cell with an accumulation above threshold, like pysheds
+    snap_to_mask, for all points at once
+    Inputs:
+        flow_grids: dictionary from load_flow_grids
+        x, y: 1d arrays of the pour point coordinates, in the grid's crs
+        threshold: accumulation (cells) of the snapping mask
+    Outputs:
+        cells: 1d array of the flat cell index of every snapped point
+    """
+    a, _, c, _, e, f = flow_grids['affine']
+    rows, cols = np.nonzero(np.asarray(flow_grids['acc']) > threshold)
+    # cell centers of the mask
+    tree = cKDTree(np.column_stack([c + (cols + 0.5) * a, f + (rows + 0.5) * e]))
+    _, nearest = tree.query(np.column_stack([x, y]))
+    return rows[nearest] * flow_grids['shape'][1] + cols[nearest]
+
+
+def catchment_polygon(flow_grids, cells):
+    # polygon of a set of flat cell indices: one box per run of cells along a row, dissolved
+    n_cols = flow_grids['shape'][1]
+    a, _, c, _, e, f = flow_grids['affine']
+    cells = np.sort(cells)
+    rows, cols = cells // n_cols, cells % n_cols
+    run_start = np.r_[True, (np.diff(cells) != 1) | (np.diff(rows) != 0)]
+    starts = np.flatnonzero(run_start)
+    ends = np.r_[starts[1:], cells.size] - 1
+    x0, x1 = c + cols[starts] * a, c + (cols[ends] + 1) * a
+    y0, y1 = f + rows[starts] * e, f + (rows[starts] + 1) * e
+    boxes = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+    return shapely.union_all(boxes)
+
+
+def delineate_basins(flow_grids, pour_points, threshold=SNAP_ACCUMULATION, area_crs=BASIN_AREA_CRS):
+    """
+    This function delineates the catchments of many pour points from cached flow grids
+    Inputs:
+        flow_grids: dictionary from get_flow_grids or load_flow_grids
+        pour_points: geopandas geodataframe of gage points indexed by gage id, e.g. gage_locs
+        threshold: accumulation (cells) pour points are snapped to
+        area_crs: crs the basin areas are computed in
+    Outputs:
+        basins: geopandas geodataframe indexed by gage id with the basin polygon, area_km2, n_cells and the
+                snapped pour point x_snap, y_snap, in the grid's crs
+    """
+    points = pour_points.to_crs(flow_grids['crs'])
+    snapped = snap_pour_points(flow_grids, points.geometry.x.to_numpy(), points.geometry.y.to_numpy(), threshold)
+    a, _, c, _, e, f = flow_grids['affine']
+    n_cols = flow_grids['shape'][1]
+    geometries, n_cells = [], []
+    for cell in snapped:
+        # every cell upstream of the pour point, nested gages each get their whole catchment
+        upstream = breadth_first_order(flow_grids['upstream'], int(cell), directed=True,
+                                       return_predecessors=False)
+        geometries.append(catchment_polygon(flow_grids, upstream))
+        n_cells.append(upstream.size)
+    basins = gpd.GeoDataFrame({'x_snap': c + (snapped % n_cols + 0.5) * a,
+                               'y_snap': f + (snapped // n_cols + 0.5) * e,
+                               'n_cells': n_cells},
+                              geometry=geometries, index=points.index, crs=flow_grids['crs'])
+    basins['area_km2'] = basins.to_crs(area_crs).area / 1e6
+    return basins
+
+
+def write_basin_polygons(basins, directory=BASIN_POLYGON_DIR):
+    """
+    This function writes every basin as gage_{id}.json, the files read by zonal.read_gage_basins
+    Inputs:
+        basins: geopandas geodataframe from delineate_basins
+        directory: directory of the basin polygons
+    Outputs:
+        paths: list of the written files
+    """
+    paths = []
+    for gage_id in basins.index:
+        path = os.path.join(directory, f'gage_{gage_id}.json')
+        basins.loc[[gage_id]].reset_index(names='gage_id').to_file(path, driver='GeoJSON')
+        paths.append(path)
+    return paths
@@ -0,0 +1,152 @@
+# %%
+import glob
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from scripts.albedo import albedo_decay
+from scripts.water_year import day_of_water_year, water_year, yday_to_date
+
+DAYMET_DIR = './data/daymet/'
+DAYMET_PATTERN = '*_daymet_*.csv'
+# binary copy of the csvs, written next to them
+DAYMET_CACHE_NAME = 'daymet_sites.nc'
+# daymet csv columns: short variable name, units and dtype
+DAYMET_COLUMNS = {
+    'year': ('year', '', np.int32),
+    'yday': ('yday', '', np.int32),
+    'dayl (s)': ('dayl', 's', np.float64),
+    'prcp (mm/day)': ('prcp', 'mm/day', np.float64),
+    'srad (W/m^2)': ('srad', 'W/m^2', np.float64),
+    'swe (kg/m^2)': ('swe', 'kg/m^2', np.float64),
+    'tmax (deg c)': ('tmax', 'deg c', np.float64),
+    'tmin (deg c)': ('tmin', 'deg c', np.float64),
+    'vp (Pa)': ('vp', 'Pa', np.float64),
+}
+
+
+def parse_daymet_header(filename):
+    """
+    This function reads the site header block of a daymet single pixel csv
+    Inputs:
+        filename: string of the daymet csv
+    Outputs:
+        meta: dictionary of latitude, longitude, x_lcc, y_lcc, tile, elevation (m) and header_lines,
+              the number of lines before the column names
+    """
+    meta = {}
+    with open(filename) as f:
+        for header_lines, line in enumerate(f):
+            if line.startswith('year,'):
+                break
+            lat_lon = re.match(r'Latitude:\s*(\S+)\s+Longitude:\s*(\S+)', line)
+            x_y = re.match(r'X & Y on Lambert Conformal Conic:\s*(\S+)\s+(\S+)', line)
+            if lat_lon:
+                meta['latitude'], meta['longitude'] = float(lat_lon.group(1)), float(lat_lon.group(2))
+            elif x_y:
+                meta['x_lcc'], meta['y_lcc'] = float(x_y.group(1)), float(x_y.group(2))
+            elif line.startswith('Tile:'):
+                meta['tile'] = int(line.split(':')[1])
+            elif line.startswith('Elevation:'):
+                meta['elevation'] = float(line.split(':')[1].split()[0])
+        else:
+            raise ValueError(f'{filename} has no daymet column header')
+    meta['header_lines'] = header_lines
+    return meta
+
+
+def daymet_site_name(filename):
+    # harts_pass_daymet_20051001_20100930.csv -> harts_pass
+    return os.path.basename(filename).split('_daymet_')[0]
+
+
+def read_daymet_csv(filename):
+    """
+    This function reads one daymet single pixel csv with explicit dtypes
+    Inputs:
+        filename: string of the daymet csv
+    Outputs:
+        data: pandas dataframe of the short variable names indexed by time
+        meta: dictionary from parse_daymet_header
+    """
+    meta = parse_daymet_header(filename)
+    data = pd.read_csv(filename, skiprows=meta['header_lines'],
+                       dtype={column: dtype for column, (_, _, dtype) in DAYMET_COLUMNS.items()})
+    data = data.rename(columns={column: name for column, (name, _, _) in DAYMET_COLUMNS.items()})
+    data.index = pd.DatetimeIndex(yday_to_date(data['year'].to_numpy(), data['yday'].to_numpy()), name='time')
+    return data.drop(columns=['year', 'yday']), meta
+
+
+def _daymet_sources(files):
+    # file name and modification time of every csv, the key of the binary copy
+    return json.dumps({os.path.basename(f): os.path.getmtime(f) for f in files}, sort_keys=True)
+
+
+def build_daymet_dataset(files, n_workers=4):
+    """
+    This function reads daymet csvs in parallel and stacks them into one dataset with the derived variables
+    Inputs:
+        files: list of daymet csv paths
+        n_workers: number of threads reading csvs
+    Outputs:
+        ds: xarray dataset on (site, time) with the daymet variables, tavg, albedo, water_year and dowy,
+            and the site latitude, longitude, elevation, x_lcc, y_lcc and tile
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        results = list(pool.map(read_daymet_csv, files))
+    sites = [daymet_site_name(f) for f in files]
+    # outer join on time, sites with a shorter record are nan padded
+    ds = xr.concat([xr.Dataset.from_dataframe(data) for data, _ in results],
+                   dim=pd.Index(sites, name='site', dtype=object), join='outer')
+    for key in ('latitude', 'longitude', 'elevation', 'x_lcc', 'y_lcc', 'tile'):
+        ds = ds.assign_coords({key: ('site', [meta.get(key, np.nan) for _, meta in results])})
+    for name, units, _ in DAYMET_COLUMNS.values():
+        if name in ds:
+            ds[name].attrs['units'] = units
+    # derived variables, once for all sites
+    ds['tavg'] = (ds['tmax'] + ds['tmin']) / 2
+    ds['tavg'].attrs['units'] = 'deg c'
+    ds['albedo'] = (('site', 'time'), albedo_decay(ds['swe'].transpose('time', 'site').values).T)
+    ds = ds.assign_coords(water_year=('time', water_year(ds['time'].values)),
+                          dowy=('time', day_of_water_year(ds['time'].values)))
+    return ds
+
+
+def get_daymet_data(directory=DAYMET_DIR, pattern=DAYMET_PATTERN, n_workers=4, use_cache=True):
+    """
+    This function loads every daymet csv of a directory as one dataset, from the binary copy when it is current
+    Inputs:
+        directory: directory of the daymet csvs
+        pattern: glob pattern of the daymet csvs
+        n_workers: number of threads reading csvs
+        use_cache: read and write the binary copy (DAYMET_CACHE_NAME in directory)
+    Outputs:
+        ds: xarray dataset from build_daymet_dataset
+    """
+    files = sorted(glob.glob(os.path.join(directory, pattern)))
+    if not files:
+        raise FileNotFoundError(f'no {pattern} files in {directory}')
+    sources = _daymet_sources(files)
+    cache = os.path.join(directory, DAYMET_CACHE_NAME)
+    if use_cache and os.path.exists(cache):
+        with xr.open_dataset(cache) as cached:
+            if cached.attrs.get('sources') == sources:
+                return cached.load()
+    ds = build_daymet_dataset(files, n_workers=n_workers)
+    if use_cache:
+        ds.attrs['sources'] = sources
+        tmp = cache + '.tmp'
+        ds.to_netcdf(tmp)
+        os.replace(tmp, cache)
+    return ds
+
+
+# %%
+if __name__ == '__main__':
+    daymet = get_daymet_data()
+    print(daymet)
@@ -5,26 +5,78 @@ import datetime as dt
 import requests
 import pytz
 import ftplib
-import nctoolkit as nc
 import argparse
+import functools
 import json
 import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
+from scripts.variables import VARIABLE_GROUPS
+from scripts.instrument import stage
+
 try:
     from urllib.request import urlopen
 except ImportError:
     from urllib import urlopen
 
+ARM_LIVE_URL = 'https://adc.arm.gov/armlive/livedata/'
+# ARM file names carry the file start as .YYYYMMDD.hhmmss.
+ARM_FILE_TIME = re.compile(r'\.(\d{8})\.(\d{6})\.')
+# input formats of date_parser, tried in order
+DATE_FORMATS = [
+    '%Y-%m-%d',
+    '%d.%m.%Y',
+    '%d/%m/%Y',
+    '%Y%m%d',
+    '%Y/%m/%d',
+    '%Y-%m-%dT%H:%M:%S',
+    '%d.%m.%YT%H:%M:%S',
+    '%d/%m/%YT%H:%M:%S',
+    '%Y%m%dT%H:%M:%S',
+    '%Y/%m/%dT%H:%M:%S',
+]
+_DIGITS_TO_D = str.maketrans('0123456789', 'dddddddddd')
+
+def _date_shape(date_string):
+    """Returns the layout of a date string, its digits replaced by 'd'."""
+    return date_string.translate(_DIGITS_TO_D)
+
+
+def _first_format(date_string):
+    """Returns the first of DATE_FORMATS that parses a string."""
+    for fmt in DATE_FORMATS:
+        try:
+            dt.datetime.strptime(date_string, fmt)
+            return fmt
+        except ValueError:
+            pass
+    fmt_strings = ', '.join(DATE_FORMATS)
+    raise ValueError('Invalid Date format, please use one of these formats ' + fmt_strings)
+
+
+@functools.lru_cache(maxsize=None)
+def _shape_format(shape):
+    """Returns the format of the strings of one layout (e.g. dddd-dd-dd).
+    Strings of one layout parse with the same format, so the format is
+    detected once per layout and remembered.
+    """
+    return _first_format(shape.replace('d', '1'))
+
+
 def date_parser(date_string, output_format='%Y%m%d', return_datetime=False):
     """Converts one datetime string to another or to
     a datetime object.
+    The format is detected once per string layout and remembered, so
+    later strings of the same layout are parsed with a single strptime.
     Parameters
     ----------
     date_string : str
         datetime string to be parsed. Accepted formats are
-        YYYY-MM-DD, DD.MM.YYYY, DD/MM/YYYY or YYYYMMDD.
+        YYYY-MM-DD, DD.MM.YYYY, DD/MM/YYYY, YYYYMMDD or YYYY/MM/DD, or
+        any of the previous formats with THH:MM:SS added onto the end.
     output_format : str
         Format for datetime.strftime to output datetime string.
     return_datetime : bool
@@ -37,32 +89,372 @@ def date_parser(date_string, output_format='%Y%m%d', return_datetime=False):
     datetime_obj : datetime.datetime
         A datetime object.
     """
-    date_fmts = [
-        '%Y-%m-%d',
-        '%d.%m.%Y',
-        '%d/%m/%Y',
-        '%Y%m%d',
-        '%Y/%m/%d',
-        '%Y-%m-%dT%H:%M:%S',
-        '%d.%m.%YT%H:%M:%S',
-        '%d/%m/%YT%H:%M:%S',
-        '%Y%m%dT%%H:%M:%S',
-        '%Y/%m/%dT%H:%M:%S',
-    ]
-    for fmt in date_fmts:
+    try:
+        datetime_obj = dt.datetime.strptime(date_string, _shape_format(_date_shape(date_string)))
+    except ValueError:
+        # e.g. an out of range month, scan the formats for this string alone
+        datetime_obj = dt.datetime.strptime(date_string, _first_format(date_string))
+    if return_datetime:
+        return datetime_obj
+    return datetime_obj.strftime(output_format)
+
+
+def parse_dates(date_strings):
+    """Parses an array of datetime strings at once.
+    Strings are grouped by layout and every group is parsed in one
+    vectorized call with its format, see `date_parser`.
+    Parameters
+    ----------
+    date_strings : array-like of str
+        datetime strings in any of the formats accepted by `date_parser`,
+        formats may be mixed.
+    returns
+    -------
+    datetimes : numpy.ndarray
+        datetime64[ns] array of the shape of *date_strings*.
+    """
+    strings = np.asarray(date_strings, dtype=object)
+    flat = strings.ravel()
+    # parse every distinct string once
+    unique, inverse = np.unique(flat, return_inverse=True)
+    shapes = np.array([_date_shape(x) for x in unique])
+    parsed = np.empty(len(unique), dtype='datetime64[ns]')
+    for shape in np.unique(shapes):
+        group = shapes == shape
         try:
-            datetime_obj = dt.datetime.strptime(date_string, fmt)
-            if return_datetime:
-                return datetime_obj
-            else:
-                return datetime_obj.strftime(output_format)
+            parsed[group] = pd.to_datetime(unique[group], format=_shape_format(shape)).to_numpy()
         except ValueError:
-            pass
-    fmt_strings = ', '.join(date_fmts)
-    raise ValueError('Invalid Date format, please use one of these formats ' + fmt_strings)
+            parsed[group] = [date_parser(x, return_datetime=True) for x in unique[group]]
+    return parsed[inverse].reshape(strings.shape)
+
+
+def query_window(startdate, enddate):
+    """Parses the start and end dates of an ARM Live query.
+    Parameters
+    ----------
+    startdate : str or None
+        Start date in any format accepted by `date_parser`.
+    enddate : str or None
+        End date in any format accepted by `date_parser`.
+    returns
+    -------
+    start_datetime, end_datetime : datetime.datetime or None
+        Start and end of the query window. If the start and end are the
+        same, the end is moved to the last second of that day.
+    """
+    start_datetime, end_datetime = None, None
+    if startdate:
+        start_datetime = date_parser(startdate, return_datetime=True)
+    if enddate:
+        end_datetime = date_parser(enddate, return_datetime=True)
+        # If the start and end date are the same, and a day to the end date
+        if start_datetime == end_datetime:
+            end_datetime += timedelta(hours=23, minutes=59, seconds=59)
+    return start_datetime, end_datetime
+
+
+def build_query_url(username, token, datastream, startdate, enddate, base_url=ARM_LIVE_URL):
+    """Builds the ARM Live query url listing the files of a datastream."""
+    # default start and end are empty
+    start, end = '', ''
+    start_datetime, end_datetime = query_window(startdate, enddate)
+    # start and end strings for query_url are constructed
+    # if the arguments were provided
+    if start_datetime is not None:
+        start = start_datetime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        start = f'&start={start}'
+    if end_datetime is not None:
+        end = end_datetime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        end = f'&end={end}'
+    # build the url to query the web service using the arguments provided
+    query_url = (
+        base_url + 'query?' + 'user={0}&ds={1}{2}{3}&wt=json'
+    ).format(':'.join([username, token]), datastream, start, end)
+    return query_url
+
+
+def build_save_data_url(username, token, fname, base_url=ARM_LIVE_URL):
+    """Builds the ARM Live saveData url of a single file."""
+    return (
+        base_url + 'saveData?user={0}&file={1}'
+    ).format(':'.join([username, token]), fname)
+
+
+def parse_query_response(response_body):
+    """Parses the body of an ARM Live query response into a json object."""
+    # if the response is an html doc, then there was an error with the user
+    if response_body[1:14] == '!DOCTYPE html':
+        raise ConnectionRefusedError('Error with user. Check username or token.')
+    # parse into json object
+    return json.loads(response_body)
+
+
+def arm_file_time(fname):
+    """Returns the start time encoded in an ARM file name, or None."""
+    match = ARM_FILE_TIME.search(os.path.basename(fname))
+    if match is None:
+        return None
+    return dt.datetime.strptime(''.join(match.groups()), '%Y%m%d%H%M%S')
+
+
+def sort_by_file_time(files):
+    """Sorts file names by the start time encoded in their ARM file name."""
+    return sorted(files, key=lambda f: (arm_file_time(f) or dt.datetime.min, os.path.basename(f)))
+
+
+def resolve_variables(variables):
+    """Expands variable group names into the variables of the group.
+    Parameters
+    ----------
+    variables : str or list
+        A variable or group name (a key of `variables.VARIABLE_GROUPS`,
+        e.g. 'WIND_VARIABLES'), or a list mixing both.
+    returns
+    -------
+    variables : list
+        Unique variable names, in order.
+    """
+    if isinstance(variables, str):
+        variables = [variables]
+    resolved = []
+    for name in variables:
+        resolved.extend(VARIABLE_GROUPS.get(name, [name]))
+    return list(dict.fromkeys(resolved))
+
+
+def files_in_window(files, start=None, end=None):
+    """Drops time-ordered files that cannot hold data inside [start, end].
+    A file is kept if it starts before *end* and the next file starts
+    after *start*. Files without a timestamp in their name are kept.
+    """
+    kept = []
+    for i, fname in enumerate(files):
+        file_time = arm_file_time(fname)
+        if file_time is not None:
+            if end is not None and file_time > end:
+                continue
+            next_time = arm_file_time(files[i + 1]) if i + 1 < len(files) else None
+            if start is not None and next_time is not None and next_time <= start:
+                continue
+        kept.append(fname)
+    return kept
+
+
+def subset_sail_dataset(ds, variables=None, start=None, end=None):
+    """Selects variables and a time window from a (lazy) SAIL dataset.
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Dataset to subset, nothing is loaded.
+    variables : str, list or None
+        Variables or variable groups to keep, see `resolve_variables`.
+        Set to None to keep all variables.
+    start, end : datetime.datetime or None
+        Inclusive time window to keep.
+    returns
+    -------
+    ds : xarray.Dataset
+        The subset dataset.
+    """
+    if variables is not None:
+        keep = [v for v in resolve_variables(variables) if v in ds.variables]
+        ds = ds[keep]
+    if start is not None or end is not None:
+        ds = ds.sel(time=slice(start, end))
+    return ds
 
 
-def get_sail_data(username, token, datastream, startdate, enddate, time=None):
+def open_sail_files(files, time_chunk=None, parallel=False, variables=None, start=None, end=None):
+    """Lazily opens many ARM netCDF files as one dask-backed dataset.
+    The files are ordered by the timestamp in their names and concatenated
+    once along time, so nothing is loaded or re-sorted until computed.
+    Variables that are not requested are dropped as each file is opened,
+    each file is trimmed to the time window while still lazy and files
+    outside the window are never opened, so only the requested fields and
+    time slices are ever decoded. The files are concatenated with the
+    default arguments of `xr.concat`, as the per-file loop did, so
+    variables without a time dimension are stacked along time too.
+    Parameters
+    ----------
+    files : list
+        Paths of the netCDF files to open.
+    time_chunk : int or None
+        Chunk size along time. Set to None to use one chunk per file.
+    parallel : bool
+        If True, open the files in parallel threads.
+    variables : str, list or None
+        Variables or variable groups to keep, see `resolve_variables`.
+        Set to None to keep all variables.
+    start, end : datetime.datetime or None
+        Inclusive time window to keep.
+    returns
+    -------
+    ds : xarray.Dataset
+        Dask-backed dataset over all files.
+    """
+    files = files_in_window(sort_by_file_time(files), start, end)
+    if len(files) == 0:
+        raise ValueError(f'no files hold data between {start} and {end}')
+    with stage('open_sail_files', 'decode'):
+        first = xr.open_dataset(files[0])
+        drop_variables = None
+        if variables is not None:
+            keep = set(resolve_variables(variables)) | {'time'}
+            # a datastream keeps its variables across files, so the names are
+            # taken from the first file and the rest are dropped on open
+            drop_variables = [v for v in first.variables if v not in keep]
+            first = first.drop_vars(drop_variables)
+
+        def open_one(fname):
+            tmp = xr.open_dataset(fname, drop_variables=drop_variables)
+            # trim while still lazy, then wrap what is left in dask
+            return subset_sail_dataset(tmp, start=start, end=end).chunk()
+
+        if parallel:
+            with ThreadPoolExecutor() as pool:
+                rest = list(pool.map(open_one, files[1:]))
+        else:
+            rest = [open_one(fname) for fname in files[1:]]
+        datasets = [subset_sail_dataset(first, start=start, end=end).chunk()] + rest
+    with stage('open_sail_files', 'concat'):
+        ds = xr.concat(datasets, dim='time', data_vars='all', coords='different', compat='equals')
+    if time_chunk is not None:
+        ds = ds.chunk({'time': time_chunk})
+    return ds
+
+
+def cached_sail_files(cache_dir, datastream, startdate=None, enddate=None, time=None):
+    """Lists the files of a datastream already in the local cache.
+    Parameters
+    ----------
+    cache_dir : str
+        Root directory of the file cache.
+    datastream : str
+        The name of the datastream.
+    startdate, enddate : str or None
+        Only files that can hold data inside this window are returned,
+        see `files_in_window`.
+    time : str or None
+        Only files with this HHMMSS time in their name are returned.
+    returns
+    -------
+    files : list
+        Sorted list of cached file paths.
+    """
+    stream_dir = os.path.join(cache_dir, datastream)
+    if not os.path.isdir(stream_dir):
+        return []
+    start_datetime, end_datetime = query_window(startdate, enddate)
+    files = []
+    for fname in os.listdir(stream_dir):
+        # skip partial downloads
+        if fname.endswith('.part'):
+            continue
+        if time is not None and time not in fname:
+            continue
+        files.append(os.path.join(stream_dir, fname))
+    # a file starting before the window still holds its first hours
+    return files_in_window(sort_by_file_time(files), start_datetime, end_datetime)
+
+
+def _fetch_file(session, url, path, chunk_size=2**20):
+    """Downloads one file into the cache, resuming a partial download."""
+    part_path = path + '.part'
+    headers = {}
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > 0:
+        headers['Range'] = f'bytes={offset}-'
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        # nothing left past the offset, the partial file is already complete
+        if response.status_code == 416 and offset > 0:
+            os.replace(part_path, path)
+            return path
+        response.raise_for_status()
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    # only complete files get their final name
+    os.replace(part_path, path)
+    return path
+
+
+def download_sail_files(username, token, datastream, startdate, enddate, time=None,
+                        cache_dir='sail_cache', n_workers=4, local_only=False,
+                        base_url=ARM_LIVE_URL):
+    """Downloads the files of a datastream into a local cache in parallel.
+    Files are stored as *cache_dir*/*datastream*/<ARM file name>. Files
+    already in the cache are not downloaded again and interrupted downloads
+    are resumed from their partial *.part* file.
+    Parameters
+    ----------
+    username : str
+        The username to use for logging into the ADC archive.
+    token : str
+        The access token for accessing the ADC archive.
+    datastream : str
+        The name of the datastream to acquire.
+    startdate, enddate : str
+        The start and end date of the data to acquire, see `get_sail_data`.
+    time : str or None
+        The specific time. Format is HHMMSS. Set to None to download all files
+        in the given date interval.
+    cache_dir : str
+        Root directory of the file cache.
+    n_workers : int
+        Number of parallel download workers sharing one HTTP session.
+    local_only : bool
+        If True, only list the matching files already in the cache and
+        never touch the network.
+    base_url : str
+        Root url of the ARM Live Data Webservice.
+    returns
+    -------
+    files : list
+        Sorted list of local file paths.
+    """
+    if local_only:
+        return cached_sail_files(cache_dir, datastream, startdate, enddate, time=time)
+
+    stream_dir = os.path.join(cache_dir, datastream)
+    os.makedirs(stream_dir, exist_ok=True)
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=n_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        query_url = build_query_url(username, token, datastream, startdate, enddate, base_url=base_url)
+        response = session.get(query_url, timeout=60)
+        response.raise_for_status()
+        response_body_json = parse_query_response(response.text)
+        if response_body_json is None:
+            print('ARM Data Live Webservice does not appear to be functioning')
+            return []
+        if response_body_json['status'] != 'success':
+            return []
+
+        fnames = response_body_json['files']
+        if time is not None:
+            fnames = [fname for fname in fnames if time in fname]
+        jobs = []
+        for fname in fnames:
+            path = os.path.join(stream_dir, fname)
+            # skip files that are already in the cache
+            if os.path.exists(path):
+                continue
+            print(f'[DOWNLOADING] {fname}')
+            jobs.append((build_save_data_url(username, token, fname, base_url=base_url), path))
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            # list() re-raises the first failed download
+            list(pool.map(lambda job: _fetch_file(session, *job), jobs))
+
+    files = [os.path.join(stream_dir, fname) for fname in fnames]
+    return sort_by_file_time(files)
+
+
+def get_sail_data(username, token, datastream, startdate, enddate, time=None,
+                  cache_dir=None, n_workers=4, local_only=False, base_url=ARM_LIVE_URL,
+                  time_chunk=None, variables=None, exact_window=False):
     """
     *** This tool was adapted from the ARM Atmospheric Data Community Toolkit ***
 
@@ -89,14 +481,33 @@ def get_sail_data(username, token, datastream, startdate, enddate, time=None):
     time: str or None
         The specific time. Format is HHMMSS. Set to None to download all files
         in the given date interval.
-    output : str
-        The output directory for the data. Set to None to make a folder in the
-        current working directory with the same name as *datastream* to place
-        the files in.
+    cache_dir : str or None
+        Directory of the local file cache. If given, files are downloaded in
+        parallel into *cache_dir*/*datastream* (see `download_sail_files`),
+        files already in the cache are skipped and the dataset is built from
+        the cached files. Set to None to stream every file from the web service.
+    n_workers : int
+        Number of parallel download workers used when *cache_dir* is given.
+    local_only : bool
+        If True, build the dataset from the files in *cache_dir* only, without
+        touching the network. Requires *cache_dir*.
+    base_url : str
+        Root url of the ARM Live Data Webservice.
+    time_chunk : int or None
+        Chunk size along time of the returned dataset. With *cache_dir* the
+        dataset is opened lazily (see `open_sail_files`) and None means one
+        chunk per file; otherwise None returns an in-memory dataset.
+    variables : str, list or None
+        Variables to decode, or one of the named groups of
+        `variables.VARIABLE_GROUPS` (e.g. 'WIND_VARIABLES'). Set to None
+        to decode all variables.
+    exact_window : bool
+        If True, trim the data to exactly *startdate* to *enddate* instead of
+        returning the whole files that overlap them.
     Returns
     -------
-    files : list
-        Returns list of files retrieved
+    ds : xarray.Dataset
+        Dataset of all files retrieved, concatenated along time.
     Notes
     -----
     This programmatic interface allows users to query and automate
@@ -128,35 +539,37 @@ def get_sail_data(username, token, datastream, startdate, enddate, time=None):
             "userName", "XXXXXXXXXXXXXXXX", "sgpmetE13.b1", "2017-01-14", "2017-01-20"
         )
     """
-    # default start and end are empty
-    start, end = '', ''
-    # start and end strings for query_url are constructed
-    # if the arguments were provided
-    if startdate:
-        start_datetime = date_parser(startdate, return_datetime=True)
-        start = start_datetime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-        start = f'&start={start}'
-    if enddate:
-        end_datetime = date_parser(enddate, return_datetime=True)
-        # If the start and end date are the same, and a day to the end date
-        if start_datetime == end_datetime:
-            end_datetime += timedelta(hours=23, minutes=59, seconds=59)
-        end = end_datetime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-        end = f'&end={end}'
-    # build the url to query the web service using the arguments provided
-    query_url = (
-        'https://adc.arm.gov/armlive/livedata/query?' + 'user={0}&ds={1}{2}{3}&wt=json'
-    ).format(':'.join([username, token]), datastream, start, end)
-    
+    if local_only and cache_dir is None:
+        raise ValueError('local_only reads the local file cache, so it requires cache_dir')
+    start_datetime, end_datetime = None, None
+    if exact_window:
+        start_datetime, end_datetime = query_window(startdate, enddate)
+
+    if cache_dir is not None:
+        # bulk mode, files are fetched in parallel into the local cache
+        # and the dataset is built from the cached files
+        with stage('get_sail_data', 'fetch'):
+            files = download_sail_files(username, token, datastream, startdate, enddate,
+                                        time=time, cache_dir=cache_dir, n_workers=n_workers,
+                                        local_only=local_only, base_url=base_url)
+        if exact_window:
+            files = files_in_window(files, start_datetime, end_datetime)
+        if len(files) == 0:
+            print(
+                f'No files returned or url status error for {datastream}.\n' 'Check datastream name, start, and end date.'
+            )
+            return
+        ds = open_sail_files(files, time_chunk=time_chunk, variables=variables,
+                             start=start_datetime, end=end_datetime)
+        return ds
+
+    query_url = build_query_url(username, token, datastream, startdate, enddate, base_url=base_url)
+
     # get url response, read the body of the message,
     # and decode from bytes type to utf-8 string
-    response_body = urlopen(query_url).read().decode('utf-8')
-    # if the response is an html doc, then there was an error with the user
-    if response_body[1:14] == '!DOCTYPE html':
-        raise ConnectionRefusedError('Error with user. Check username or token.')
-
-    # parse into json object
-    response_body_json = json.loads(response_body)
+    with stage('get_sail_data', 'fetch'):
+        response_body = urlopen(query_url).read().decode('utf-8')
+    response_body_json = parse_query_response(response_body)
 
     # not testing, response is successful and files were returned
     if response_body_json is None:
@@ -164,22 +577,27 @@ def get_sail_data(username, token, datastream, startdate, enddate, time=None):
         return []
 
     num_files = len(response_body_json['files'])
-    file_names = []
     if response_body_json['status'] == 'success' and num_files > 0:
-        for i,fname in enumerate(response_body_json['files']):
-            if time is not None:
-                if time not in fname:
-                    continue
+        # nctoolkit imports matplotlib.pyplot, so it is only loaded for the streaming path
+        import nctoolkit as nc
+        fnames = response_body_json['files']
+        if time is not None:
+            fnames = [fname for fname in fnames if time in fname]
+        datasets = []
+        for fname in sort_by_file_time(fnames):
             print(f'[DOWNLOADING] {fname}')
             # construct link to web service saveData function
-            save_data_url = (
-                'https://adc.arm.gov/armlive/livedata/' + 'saveData?user={0}&file={1}'
-            ).format(':'.join([username, token]), fname)
-            if i == 0:
-                ds = nc.open_data(save_data_url).to_xarray()
-            else: 
+            save_data_url = build_save_data_url(username, token, fname, base_url=base_url)
+            with stage('get_sail_data', 'fetch'):
                 tmp = nc.open_data(save_data_url).to_xarray()
-                ds = xr.concat([ds,tmp], dim='time').sortby('time')
+            # subset before anything is loaded or concatenated
+            with stage('get_sail_data', 'transform'):
+                datasets.append(subset_sail_dataset(tmp, variables, start_datetime, end_datetime))
+        # files are already in time order, concatenate once
+        with stage('get_sail_data', 'concat'):
+            ds = xr.concat(datasets, dim='time', data_vars='all', coords='different', compat='equals')
+        if time_chunk is not None:
+            ds = ds.chunk({'time': time_chunk})
         return ds
     else:
         print(
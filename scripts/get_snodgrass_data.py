@@ -3,6 +3,22 @@ import pandas as pd
 import numpy as np
 import datetime as dt
 import geopandas as gpd
+import glob
+import json
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scripts.instrument import stage
+
+# schema metadata key holding the site name, location and units of a store
+SNODGRASS_META_KEY = b'snodgrass'
+TIME_COLUMNS = ['year', 'month', 'day', 'hour', 'minute']
+MST_OFFSET = np.timedelta64(7, 'h')
+STATION_DATA_DIR = '../../../01_data/raw_data/station_data/'
+# station catalogs keyed on directory and meta file mtimes
+_CATALOG_CACHE = {}
 
 def get_metadata_and_cols(filename):
     with open(filename) as f:
@@ -23,35 +39,194 @@ def get_metadata_and_cols(filename):
     site_cols = dict(zip(range(len(site_cols)), site_cols.values()))
     return site_cols, site_loc, site_name
 
-def get_snodgrass_data(filename, filemeta, meta_dict=None, send_meta=False):
-    # read in the data
-    site_data = pd.read_csv(filename, header=None)
+def get_columns_and_units(filemeta):
+    """
+    This function parses the column names, units and dtypes of a station csv from its meta file once
+    Inputs:
+        filemeta: string of the station meta file
+    Outputs:
+        names: list of the csv column names, without units
+        units: dictionary of the units of the output columns
+        dtypes: dictionary of explicit dtypes for read_csv, of the integer time columns
+        site_loc: dictionary of the site location
+        site_name: string of the site name
+    """
     # get metadate, columns, and site name
     site_cols, site_loc, site_name = get_metadata_and_cols(filemeta)
-    
-    # rename the columns
-    site_data.columns = site_cols.values()
     # renmae the hour (MST) column to hour
-    site_data = site_data.rename(columns={'hour (MST)': 'hour'})
-    # convert the year month day hour minute columns to a datetime 
-    site_data['datetime'] = pd.to_datetime(site_data[['year', 'month', 'day', 'hour', 'minute']])
-    # make timezone aware and set to MST
-    site_data['datetime'] = site_data['datetime'].dt.tz_localize('MST')
-    # convert to UTC
-    site_data['datetime'] = site_data['datetime'].dt.tz_convert('UTC')
-    # remove the year month day hour minute columns
-    site_data = site_data.drop(['year', 'month', 'day', 'hour', 'minute'], axis=1)
+    cols = ['hour' if x == 'hour (MST)' else x for x in site_cols.values()]
     # remove the units from the column names (if they exist) inside the parentheses
-    units= [x.split(' (')[1][:-1] if '(' in x else '' for x in site_data.columns]
-    site_data.columns = [x.split(' (')[0] for x in site_data.columns]
+    names = [x.split(' (')[0] for x in cols]
+    units = {x.split(' (')[0]: x.split(' (')[1][:-1] if '(' in x else ''
+             for x in cols if x not in TIME_COLUMNS}
+    units['datetime'] = ''
+    # the time columns are integers, measurements are made floats after parsing (see _finish_chunk)
+    dtypes = {x: 'int64' for x in names if x in TIME_COLUMNS}
+    return names, units, dtypes, site_loc, site_name
+
+def build_utc_datetime(site_data):
+    # build datetimes straight from the integer columns, without a per-column to_datetime
+    months = (site_data['year'].to_numpy() - 1970) * 12 + site_data['month'].to_numpy() - 1
+    local = (months.astype('datetime64[M]').astype('datetime64[m]')
+             + (site_data['day'].to_numpy() - 1).astype('timedelta64[D]')
+             + site_data['hour'].to_numpy().astype('timedelta64[h]')
+             + site_data['minute'].to_numpy().astype('timedelta64[m]'))
+    # MST has no daylight saving time, so UTC is always local time + 7 hours
+    utc = (local + MST_OFFSET).astype('datetime64[ns]')
+    return pd.DatetimeIndex(utc).tz_localize('UTC')
+
+def _finish_chunk(site_data):
+    # every measurement is a float in every chunk, values that are not numbers (e.g. a text flag) become nan
+    for column in site_data.columns.difference(TIME_COLUMNS):
+        site_data[column] = pd.to_numeric(site_data[column], errors='coerce').astype('float64')
+    # convert the year month day hour minute columns to a UTC datetime
+    site_data['datetime'] = build_utc_datetime(site_data)
+    # remove the year month day hour minute columns
+    return site_data.drop(TIME_COLUMNS, axis=1)
+
+def parse_snodgrass_csv(filename, filemeta):
+    names, units, dtypes, site_loc, site_name = get_columns_and_units(filemeta)
+    # read in the data
+    site_data = pd.read_csv(filename, header=None, names=names, dtype=dtypes)
+    return _finish_chunk(site_data), units, site_loc, site_name
+
+def stream_snodgrass_data(filename, filemeta, chunksize=100000):
+    """
+    This function reads a station csv chunk by chunk so memory stays bounded for any record length
+    Inputs:
+        filename: string of the station data csv
+        filemeta: string of the station meta file
+        chunksize: number of rows per chunk
+    Outputs:
+        generator of pandas dataframes, concatenated they equal get_snodgrass_data(..., use_store=False)
+    """
+    names, units, dtypes, site_loc, site_name = get_columns_and_units(filemeta)
+    with pd.read_csv(filename, header=None, names=names, dtype=dtypes, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield _finish_chunk(chunk)
+
+def to_utc(time):
+    # naive times are taken as UTC, aware times are converted
+    time = pd.Timestamp(time)
+    return time.tz_localize('UTC') if time.tzinfo is None else time.tz_convert('UTC')
+
+def snodgrass_store_path(filename):
+    # the columnar store sits next to the csv, e.g. SND_opn_AWS_data_001hr.parquet/
+    return os.path.splitext(filename)[0] + '.parquet'
+
+def ingest_snodgrass_data(filename, filemeta, store_path=None, chunksize=100000):
+    """
+    This function parses a station csv once and writes it to a compressed Parquet store partitioned by year
+    Inputs:
+        filename: string of the station data csv
+        filemeta: string of the station meta file
+        store_path: string of the store directory, defaults to the csv path with a .parquet suffix
+        chunksize: number of csv rows parsed and written at a time
+    Outputs:
+        store_path: string of the store directory
+    """
+    if store_path is None:
+        store_path = snodgrass_store_path(filename)
+    names, units, dtypes, site_loc, site_name = get_columns_and_units(filemeta)
+    # keep units and site location with the data
+    meta = json.dumps({'site_name': site_name, 'site_loc': site_loc, 'units': units})
+    # write next to the store and swap it in at the end, so an interrupted ingest never leaves a partial store
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    # append chunk by chunk so the whole csv is never in memory
+    for i, site_data in enumerate(stream_snodgrass_data(filename, filemeta, chunksize=chunksize)):
+        # partition by year so that time ranges only touch the files they need
+        site_data['year'] = site_data['datetime'].dt.year
+        table = pa.Table.from_pandas(site_data, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), SNODGRASS_META_KEY: meta})
+        pq.write_to_dataset(table, tmp_path, partition_cols=['year'], compression='zstd',
+                            basename_template=f'chunk{i:05d}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore')
+    # replace any previous store
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+    return store_path
+
+def read_snodgrass_store_meta(store_path):
+    # units, site location and name are kept in the schema metadata
+    schema = pq.read_schema(next(iter(sorted(glob.glob(os.path.join(store_path, '*', '*.parquet'))))))
+    return json.loads(schema.metadata[SNODGRASS_META_KEY])
+
+def read_snodgrass_store(store_path, columns=None, start=None, end=None):
+    """
+    This function reads station data from a Parquet store written by ingest_snodgrass_data
+    Inputs:
+        store_path: string of the store directory
+        columns: list of columns to read, datetime is always read. None reads all columns
+        start: start of the time range (UTC), None for no lower bound
+        end: end of the time range (UTC, inclusive), None for no upper bound
+    Outputs:
+        site_data: pandas dataframe with a UTC datetime column
+    """
+    filters = []
+    if start is not None:
+        start = to_utc(start)
+        # prune whole year partitions first, then rows
+        filters += [('year', '>=', start.year), ('datetime', '>=', start)]
+    if end is not None:
+        end = to_utc(end)
+        filters += [('year', '<=', end.year), ('datetime', '<=', end)]
+    if columns is not None:
+        columns = ['datetime'] + [x for x in columns if x != 'datetime']
+    site_data = pd.read_parquet(store_path, columns=columns, filters=filters or None)
+    if 'year' in site_data.columns:
+        site_data = site_data.drop('year', axis=1)
+    site_data = site_data.sort_values('datetime').reset_index(drop=True)
+    return site_data
+
+def get_snodgrass_data(filename, filemeta, meta_dict=None, send_meta=False,
+                       use_store=True, columns=None, start=None, end=None):
+    """
+    This function returns the station data of a Snodgrass AWS csv with a UTC datetime column.
+    By default the csv is parsed once into a Parquet store next to it (see ingest_snodgrass_data)
+    and later calls read from the store.
+    Inputs:
+        filename: string of the station data csv
+        filemeta: string of the station meta file
+        meta_dict: dictionary to add the site location and units to, if given
+        send_meta: return meta_dict instead of the data
+        use_store: read from the Parquet store, set to False to parse the csv
+        columns: list of columns to read, None reads all columns
+        start: start of the time range (UTC), None for no lower bound
+        end: end of the time range (UTC, inclusive), None for no upper bound
+    Outputs:
+        site_data: pandas dataframe, or meta_dict if send_meta is True
+    """
     if meta_dict is not None:
+        # site location and units come from the meta file alone
+        _, units, _, site_loc, site_name = get_columns_and_units(filemeta)
         meta_dict[site_name] = site_loc
         # add the units to the meta_dict
-        meta_dict[site_name].update(dict(zip(site_data.columns, units)))
+        meta_dict[site_name].update(units)
         if send_meta:
             return meta_dict
-    else:
-        return site_data
+        return
+    if use_store:
+        store_path = snodgrass_store_path(filename)
+        # rebuild the store if the csv or meta file changed since it was written
+        if (not os.path.exists(store_path)
+                or os.path.getmtime(store_path) < max(os.path.getmtime(filename), os.path.getmtime(filemeta))):
+            with stage('get_snodgrass_data', 'decode'):
+                ingest_snodgrass_data(filename, filemeta, store_path)
+        with stage('get_snodgrass_data', 'decode'):
+            return read_snodgrass_store(store_path, columns=columns, start=start, end=end)
+    with stage('get_snodgrass_data', 'decode'):
+        site_data, units, site_loc, site_name = parse_snodgrass_csv(filename, filemeta)
+    with stage('get_snodgrass_data', 'transform'):
+        if columns is not None:
+            site_data = site_data[['datetime'] + [x for x in columns if x != 'datetime']]
+        if start is not None:
+            site_data = site_data[site_data['datetime'] >= to_utc(start)]
+        if end is not None:
+            site_data = site_data[site_data['datetime'] <= to_utc(end)]
+    return site_data
 # turn metadict into geodataframe
 def meta_to_gdf(meta_dict):
     # convert the meta_dict to a dataframe
@@ -62,17 +237,32 @@ def meta_to_gdf(meta_dict):
     meta_gdf.crs = 'EPSG:4326'
     return meta_gdf
 
-def get_snodgrass_metadata():
-    meta_dict = {}
-    # filenames for the open and forest sites
-    open_site_datafile = '../../../01_data/raw_data/station_data/SND_opn_AWS_data_001hr.csv'
-    open_site_metafile = '../../../01_data/raw_data/station_data/SND_opn_AWS_data_meta.txt'
-    forest_site_datafile = '../../../01_data/raw_data/station_data/SND_for_AWS_data_001hr.csv'
-    forest_site_metafile = '../../../01_data/raw_data/station_data/SND_for_AWS_data_meta.txt'
-    # get metadate, columns, and site name
-    for name,meta in zip([open_site_datafile, forest_site_datafile], [open_site_metafile, forest_site_metafile]):
-        # get the meta dict from get_snodgrass_data
-        meta_dict.update(get_snodgrass_data(name, meta, meta_dict=meta_dict,send_meta=True))
+def build_snodgrass_catalog(directory):
+    """
+    This function builds the site location and units of every station in a directory from the *_meta.txt files alone
+    The data csvs are never read, and the result is cached until a meta file is added, removed or modified
+    Inputs:
+        directory: string of the directory holding the station meta files
+    Outputs:
+        meta_dict: dictionary of site name to site location and units
+    """
+    metafiles = sorted(glob.glob(os.path.join(directory, '*_meta.txt')))
+    cache_key = (os.path.abspath(directory), tuple((x, os.path.getmtime(x)) for x in metafiles))
+    if cache_key not in _CATALOG_CACHE:
+        meta_dict = {}
+        for meta in metafiles:
+            _, units, _, site_loc, site_name = get_columns_and_units(meta)
+            meta_dict[site_name] = {**site_loc, **units}
+        # drop stale entries of the same directory
+        for key in [x for x in _CATALOG_CACHE if x[0] == cache_key[0]]:
+            del _CATALOG_CACHE[key]
+        _CATALOG_CACHE[cache_key] = meta_dict
+    # hand out copies so callers cannot modify the cache
+    return {site: dict(meta) for site, meta in _CATALOG_CACHE[cache_key].items()}
+
+def get_snodgrass_metadata(directory=STATION_DATA_DIR):
+    # get the site location and units of every station in the directory
+    meta_dict = build_snodgrass_catalog(directory)
     # convert the meta_dict to a geodataframe
     meta_gdf = meta_to_gdf(meta_dict)
     return meta_gdf
@@ -0,0 +1,274 @@
+# %%
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# schema metadata key holding the fetched date ranges and units of a station store
+SNOTEL_META_KEY = b'snotel'
+SNOTEL_STORE_DIR = './data/snotel/'
+SNOTEL_VARIABLES = ['SWE', 'PRECIPITATION']
+# units metloom reports, the units they are stored in and the conversion
+SNOTEL_UNITS = {
+    'SWE': ('in', 'mm', lambda x: x * 25.4),
+    'PRECIPITATION': ('in', 'mm', lambda x: x * 25.4),
+    'SNOWDEPTH': ('in', 'mm', lambda x: x * 25.4),
+    'AVG AIR TEMP': ('degF', 'degC', lambda x: (x - 32) * 5 / 9),
+    'MAX AIR TEMP': ('degF', 'degC', lambda x: (x - 32) * 5 / 9),
+    'MIN AIR TEMP': ('degF', 'degC', lambda x: (x - 32) * 5 / 9),
+}
+# SnotelPointData.ALLOWED_VARIABLES attribute of every variable, whose display name is the variable name
+METLOOM_VARIABLES = {
+    'SWE': 'SWE',
+    'PRECIPITATION': 'PRECIPITATION',
+    'SNOWDEPTH': 'SNOWDEPTH',
+    'AVG AIR TEMP': 'TEMPAVG',
+    'MAX AIR TEMP': 'TEMPMAX',
+    'MIN AIR TEMP': 'TEMPMIN',
+}
+
+
+def metloom_fetcher(station_id, name, start, end, variables):
+    """
+    This function requests daily data of one station from the NRCS service through metloom
+    Inputs:
+        station_id: string of the station triplet, e.g. '515:WA:SNTL'
+        name: string of the station name
+        start: first day (pandas timestamp)
+        end: last day (pandas timestamp)
+        variables: list of variable names of METLOOM_VARIABLES, e.g. ['SWE', 'AVG AIR TEMP']
+    Outputs:
+        data: pandas dataframe with a datetime column and one column (and {var}_units column) per variable,
+              in the service's units, or None when the service has no data
+    """
+    unknown = [var for var in variables if var not in METLOOM_VARIABLES]
+    if unknown:
+        raise ValueError(f'no metloom variable for {unknown}, use one of {list(METLOOM_VARIABLES)}')
+    from metloom.pointdata import SnotelPointData
+    station = SnotelPointData(station_id=station_id, name=name)
+    allowed = station.ALLOWED_VARIABLES
+    data = station.get_daily_data(start.to_pydatetime(), end.to_pydatetime(),
+                                  [getattr(allowed, METLOOM_VARIABLES[var]) for var in variables])
+    if data is None:
+        return None
+    return pd.DataFrame(data.reset_index().drop(columns=['geometry', 'site', 'datasource'], errors='ignore'))
+
+
+def local_fetcher(directory):
+    """
+    This function makes an offline stand-in for metloom_fetcher that serves {station_id}.csv files of a directory
+    (':' replaced by '_'), with a datetime column and variables in the service's units
+    Inputs:
+        directory: string of the directory of station csvs
+    Outputs:
+        fetcher: function with the arguments of metloom_fetcher
+    """
+    def fetcher(station_id, name, start, end, variables):
+        path = os.path.join(directory, snotel_station_key(station_id) + '.csv')
+        if not os.path.exists(path):
+            return None
+        data = pd.read_csv(path, parse_dates=['datetime'])
+        if data['datetime'].dt.tz is not None:
+            data['datetime'] = data['datetime'].dt.tz_localize(None)
+        keep = (data['datetime'] >= start) & (data['datetime'] <= end)
+        return data.loc[keep, ['datetime'] + [x for x in data.columns if x.split('_units')[0] in variables]]
+    return fetcher
+
+
+def snotel_station_key(station_id):
+    # file name safe station key, 515:WA:SNTL -> 515_WA_SNTL
+    return station_id.replace(':', '_')
+
+
+def to_si_units(data, variables):
+    """
+    This function converts fetched station data to the units of SNOTEL_UNITS, once at ingest
+    Inputs:
+        data: pandas dataframe from a fetcher
+        variables: list of variables in data
+    Outputs:
+        data: pandas dataframe of datetime (daily, naive) and the converted variables
+        units: dictionary of the units of every variable
+    """
+    data = data.copy()
+    dates = pd.to_datetime(data['datetime'])
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    data['datetime'] = dates.dt.floor('D')
+    units = {}
+    for var in variables:
+        if var not in data:
+            data[var] = np.nan
+        source_units, si_units, convert = SNOTEL_UNITS.get(var, (None, None, None))
+        reported = data.pop(f'{var}_units').dropna().unique() if f'{var}_units' in data else []
+        if convert is not None and (len(reported) == 0 or list(reported) == [source_units]):
+            data[var] = convert(data[var].astype(float))
+            units[var] = si_units
+        else:
+            units[var] = reported[0] if len(reported) else ''
+    return data[['datetime'] + list(variables)], units
+
+
+def snotel_store_path(station_id, store_dir=SNOTEL_STORE_DIR):
+    return os.path.join(store_dir, snotel_station_key(station_id) + '.parquet')
+
+
+def read_snotel_store(path):
+    """
+    This function reads a station store
+    Inputs:
+        path: string of the station parquet file
+    Outputs:
+        data: pandas dataframe of datetime and the variables, empty if there is no store
+        meta: dictionary of the fetched date ranges of every variable ('fetched', variable to list of
+              [start, end] strings) and units
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=['datetime']), {'fetched': {}, 'units': {}}
+    table = pq.read_table(path)
+    meta = json.loads(table.schema.metadata[SNOTEL_META_KEY])
+    data = table.to_pandas()
+    if isinstance(meta['fetched'], list):
+        # stores written before the ranges were kept per variable held the ranges of every column
+        meta['fetched'] = {var: meta['fetched'] for var in data.columns if var != 'datetime'}
+    return data, meta
+
+
+def write_snotel_store(path, data, meta):
+    # the whole station is one small file, rewritten through a temporary file
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), SNOTEL_META_KEY: json.dumps(meta)})
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp, compression='zstd')
+    os.replace(tmp, path)
+
+
+def missing_ranges(fetched, start, end):
+    """
+    This function finds the days of [start, end] not covered by already fetched ranges
+    Inputs:
+        fetched: list of [start, end] day ranges
+        start: first day
+        end: last day
+    Outputs:
+        missing: list of (start, end) pandas timestamps of the gaps
+    """
+    days = pd.date_range(pd.Timestamp(start).floor('D'), pd.Timestamp(end).floor('D'), freq='D')
+    covered = np.zeros(len(days), dtype=bool)
+    for first, last in fetched:
+        covered |= (days >= pd.Timestamp(first)) & (days <= pd.Timestamp(last))
+    # runs of uncovered days
+    edges = np.diff(np.r_[0, (~covered).astype(int), 0])
+    return [(days[i], days[j - 1]) for i, j in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))]
+
+
+def _merge_ranges(ranges):
+    # union of [start, end] day ranges as sorted, non overlapping ranges
+    merged = []
+    for first, last in sorted((pd.Timestamp(a), pd.Timestamp(b)) for a, b in ranges):
+        if merged and first <= merged[-1][1] + pd.Timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return [[str(a.date()), str(b.date())] for a, b in merged]
+
+
+def update_snotel_station(station_id, name, start, end, variables=SNOTEL_VARIABLES, store_dir=SNOTEL_STORE_DIR,
+                          fetcher=metloom_fetcher):
+    """
+    This function brings the store of one station up to date for [start, end], requesting only missing days
+    Inputs:
+        station_id: string of the station triplet
+        name: string of the station name
+        start, end: first and last day
+        variables: list of variables
+        store_dir: directory of the station stores
+        fetcher: function returning the service data, see metloom_fetcher and local_fetcher
+    Outputs:
+        path: string of the station store
+    """
+    path = snotel_store_path(station_id, store_dir)
+    data, meta = read_snotel_store(path)
+    # days missing for any of the variables; the ranges are kept per variable, so a variable new to the store
+    # is fetched for every day without marking the other columns fetched
+    missing = [gap for var in variables for gap in missing_ranges(meta['fetched'].get(var, []), start, end)]
+    gaps = [(pd.Timestamp(first), pd.Timestamp(last)) for first, last in _merge_ranges(missing)]
+    if not gaps:
+        return path
+    merged = data.set_index('datetime')
+    covered = []
+    for first, last in gaps:
+        print(f'[DOWNLOADING] {station_id} {first.date()} to {last.date()}')
+        new = fetcher(station_id, name, first, last, list(variables))
+        if new is not None and len(new):
+            new, units = to_si_units(new, variables)
+            meta['units'].update(units)
+            # fetched values replace stored values of the same day column by column, other columns are kept
+            merged = new.drop_duplicates('datetime', keep='last').set_index('datetime').combine_first(merged)
+            # days after the last returned day may not be published yet, so they are requested again next time
+            covered.append([str(first.date()), str(min(last, new['datetime'].max()).date())])
+    if not covered:
+        return path
+    data = merged.sort_index().rename_axis('datetime').reset_index()
+    for var in variables:
+        meta['fetched'][var] = _merge_ranges(meta['fetched'].get(var, []) + covered)
+    write_snotel_store(path, data, meta)
+    return path
+
+
+def get_snotel_data(stations, start, end, variables=SNOTEL_VARIABLES, store_dir=SNOTEL_STORE_DIR,
+                    n_workers=4, offline=False, fetcher=None):
+    """
+    This function returns daily SNOTEL data of many stations in SI units from a local incremental store,
+    fetching the days the store does not have yet concurrently
+    Inputs:
+        stations: dictionary of station triplet to name, e.g. {'515:WA:SNTL': 'Harts Pass'}, or list of triplets
+        start: first day, e.g. '2005-10-01'
+        end: last day, e.g. '2010-09-30'
+        variables: list of variables, e.g. ['SWE', 'PRECIPITATION']
+        store_dir: directory of the station stores
+        n_workers: number of stations fetched at a time
+        offline: never use the network; read the store only, or the stand-in fetcher when one is given
+        fetcher: function returning the service data, default of metloom_fetcher (see local_fetcher)
+    Outputs:
+        data: long pandas dataframe of station, name, datetime and the variables (mm, degC)
+    """
+    if not isinstance(stations, dict):
+        stations = {station_id: station_id for station_id in stations}
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if fetcher is None and not offline:
+        fetcher = metloom_fetcher
+    if fetcher is not None:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            # list() re-raises the first failed station
+            list(pool.map(lambda item: update_snotel_station(item[0], item[1], start, end, variables=variables,
+                                                             store_dir=store_dir, fetcher=fetcher),
+                          stations.items()))
+    frames = []
+    for station_id, name in stations.items():
+        data, _ = read_snotel_store(snotel_store_path(station_id, store_dir))
+        if not len(data):
+            continue
+        data = data[(data['datetime'] >= start) & (data['datetime'] <= end)]
+        frames.append(data.assign(station=station_id, name=name))
+    if not frames:
+        return pd.DataFrame(columns=['station', 'name', 'datetime'] + list(variables))
+    data = pd.concat(frames, ignore_index=True)
+    return data[['station', 'name', 'datetime'] + [var for var in variables if var in data]]
+
+
+def get_snotel_units(station_id, store_dir=SNOTEL_STORE_DIR):
+    # units of the variables of a station store
+    return read_snotel_store(snotel_store_path(station_id, store_dir))[1]['units']
+
+
+# %%
+if __name__ == '__main__':
+    stations = {'515:WA:SNTL': 'Harts Pass', '766:UT:SNTL': 'Snowbird', '539:CA:SNTL': 'Independence Camp'}
+    snotel = get_snotel_data(stations, '2005-10-01', '2010-09-30')
+    print(snotel.groupby('name')[SNOTEL_VARIABLES].max())
@@ -5,99 +5,106 @@ from metpy.plots import SkewT, add_metpy_logo
 from metpy.units import units
 import metpy.calc as mcalc
 
-WIND_VARIABLES = [
-# Sonic Anemometer Data for 4 towers
-'spd_1m_uw',     'dir_1m_uw',     'u_1m_uw',   'v_1m_uw',   'w_1m_uw',
-'spd_3m_uw',     'dir_3m_uw',     'u_3m_uw',   'v_3m_uw',   'w_3m_uw',
-'spd_10m_uw',    'dir_10m_uw',    'u_10m_uw',  'v_10m_uw',  'w_10m_uw',
-'spd_1m_ue',     'dir_1m_ue',     'u_1m_ue',   'v_1m_ue',   'w_1m_ue',
-'spd_3m_ue',     'dir_3m_ue',     'u_3m_ue',   'v_3m_ue',   'w_3m_ue',
-'spd_10m_ue',    'dir_10m_ue',    'u_10m_ue',  'v_10m_ue',  'w_10m_ue',
-'spd_1m_d',     'dir_1m_d',     'u_1m_d',   'v_1m_d',   'w_1m_d',
-'spd_3m_d',     'dir_3m_d',     'u_3m_d',   'v_3m_d',   'w_3m_d',
-'spd_10m_d',    'dir_10m_d',    'u_10m_d',  'v_10m_d',  'w_10m_d',
-'spd_2m_c',     'dir_2m_c',     'u_2m_c',   'v_2m_c',   'w_2m_c',
-'spd_3m_c',     'dir_3m_c',     'u_3m_c',   'v_3m_c',   'w_3m_c',
-'spd_5m_c',     'dir_5m_c',     'u_5m_c',   'v_5m_c',   'w_5m_c',
-'spd_10m_c',    'dir_10m_c',    'u_10m_c',  'v_10m_c',  'w_10m_c',
-'spd_15m_c',    'dir_15m_c',    'u_15m_c',  'v_15m_c',  'w_15m_c',
-'spd_20m_c',    'dir_20m_c',    'u_20m_c',  'v_20m_c',  'w_20m_c',
-]
-COUNT_VARIABLES = ['counts_3m_c',
- 'counts_3m_ue',
- 'counts_1m_d',
- 'counts_15m_c',
- 'counts_10m_uw',
- 'counts_1m_ue',
- 'counts_20m_c',
- 'counts_2m_c',
- 'counts_10m_ue',
- 'counts_1m_c',
- 'counts_1m_uw',
- 'counts_3m_uw',
- 'counts_10m_c',
- 'counts_3m_d',
- 'counts_5m_c',
- 'counts_10m_d']
-TURBULENCE_VARIABLES = [
-    'tc_1m_uw',        'u_u__1m_uw',    'v_v__1m_uw',    'w_w__1m_uw',    
-        'u_w__1m_uw',    'v_w__1m_uw',  'u_tc__1m_uw',  'v_tc__1m_uw',   'u_h2o__1m_uw',  'v_h2o__1m_uw',   'w_tc__1m_uw',   'w_h2o__1m_uw',
-    'tc_3m_uw',        'u_u__3m_uw',    'v_v__3m_uw',    'w_w__3m_uw',    
-        'u_w__3m_uw',    'v_w__3m_uw',  'u_tc__3m_uw',  'v_tc__3m_uw',   'u_h2o__3m_uw',  'v_h2o__3m_uw',   'w_tc__3m_uw',   'w_h2o__3m_uw',
-    'tc_10m_uw',      'u_u__10m_uw',   'v_v__10m_uw',   'w_w__10m_uw',   
-        'u_w__10m_uw',   'v_w__10m_uw', 'u_tc__10m_uw', 'v_tc__10m_uw',  'u_h2o__10m_uw', 'v_h2o__10m_uw',  'w_tc__10m_uw',  'w_h2o__10m_uw',
-
-    'tc_1m_ue',        'u_u__1m_ue',    'v_v__1m_ue',    'w_w__1m_ue',    
-        'u_w__1m_ue',    'v_w__1m_ue',  'u_tc__1m_ue',  'v_tc__1m_ue',   'u_h2o__1m_ue',  'v_h2o__1m_ue',   'w_tc__1m_ue',   'w_h2o__1m_ue',
-    'tc_3m_ue',        'u_u__3m_ue',    'v_v__3m_ue',    'w_w__3m_ue',    
-        'u_w__3m_ue',    'v_w__3m_ue',  'u_tc__3m_ue',  'v_tc__3m_ue',   'u_h2o__3m_ue',  'v_h2o__3m_ue',   'w_tc__3m_ue',   'w_h2o__3m_ue',
-    'tc_10m_ue',      'u_u__10m_ue',   'v_v__10m_ue',   'w_w__10m_ue',   
-        'u_w__10m_ue',   'v_w__10m_ue', 'u_tc__10m_ue', 'v_tc__10m_ue',  'u_h2o__10m_ue', 'v_h2o__10m_ue',  'w_tc__10m_ue',  'w_h2o__10m_ue',
+from scripts.instrument import timed_stage
 
-    'tc_1m_d',         'u_u__1m_d',    'v_v__1m_d',    'w_w__1m_d',    
-        'u_w__1m_d',    'v_w__1m_d',  'u_tc__1m_d',  'v_tc__1m_d',   'u_h2o__1m_d',  'v_h2o__1m_d',   'w_tc__1m_d',   'w_h2o__1m_d',
-    'tc_3m_d',         'u_u__3m_d',    'v_v__3m_d',    'w_w__3m_d',    
-        'u_w__3m_d',    'v_w__3m_d',  'u_tc__3m_d',  'v_tc__3m_d',   'u_h2o__3m_d',  'v_h2o__3m_d',   'w_tc__3m_d',   'w_h2o__3m_d',
-    'tc_10m_d',       'u_u__10m_d',   'v_v__10m_d',   'w_w__10m_d',   
-        'u_w__10m_d',   'v_w__10m_d', 'u_tc__10m_d', 'v_tc__10m_d',  'u_h2o__10m_d', 'v_h2o__10m_d',  'w_tc__10m_d',  'w_h2o__10m_d',
+# the variable lists live in scripts.variables, re-exported here for the notebooks
+from scripts.variables import (COUNT_VARIABLES, PRESSURE_VARIABLES, SNOW_FLUX, TEMPERATURE_VARIABLES,
+                               TURBULENCE_VARIABLES, VARIABLE_GROUPS, WATER_VAPOR_VARIABLES, WIND_VARIABLES)
 
-    'tc_2m_c',     'u_u__2m_c',    'v_v__2m_c',    'w_w__2m_c',    
-        'u_w__2m_c',    'v_w__2m_c',  'u_tc__2m_c',  'v_tc__2m_c',   'u_h2o__2m_c',  'v_h2o__2m_c',   'w_tc__2m_c',   'w_h2o__2m_c',
-    'tc_3m_c',     'u_u__3m_c',    'v_v__3m_c',    'w_w__3m_c',    
-        'u_w__3m_c',    'v_w__3m_c',  'u_tc__3m_c',  'v_tc__3m_c',   'u_h2o__3m_c',  'v_h2o__3m_c',   'w_tc__3m_c',   'w_h2o__3m_c',
-    'tc_5m_c',     'u_u__5m_c',    'v_v__5m_c',    'w_w__5m_c',    
-        'u_w__5m_c',    'v_w__5m_c',  'u_tc__5m_c',  'v_tc__5m_c',   'u_h2o__5m_c',  'v_h2o__5m_c',   'w_tc__5m_c',   'w_h2o__5m_c',
-    'tc_10m_c',   'u_u__10m_c',   'v_v__10m_c',   'w_w__10m_c',   
-        'u_w__10m_c',   'v_w__10m_c', 'u_tc__10m_c', 'v_tc__10m_c',  'u_h2o__10m_c', 'v_h2o__10m_c',  'w_tc__10m_c',  'w_h2o__10m_c',
-    'tc_15m_c',   'u_u__15m_c',   'v_v__15m_c',   'w_w__15m_c',   
-        'u_w__15m_c',   'v_w__15m_c', 'u_tc__15m_c', 'v_tc__15m_c',  'u_h2o__15m_c', 'v_h2o__15m_c',  'w_tc__15m_c',  'w_h2o__15m_c',
-    'tc_20m_c',   'u_u__20m_c',   'v_v__20m_c',   'w_w__20m_c',   
-        'u_w__20m_c',   'v_w__20m_c', 'u_tc__20m_c', 'v_tc__20m_c',  'u_h2o__20m_c', 'v_h2o__20m_c',  'w_tc__20m_c',  'w_h2o__20m_c',
-]
-WATER_VAPOR_VARIABLES = [
-'h2o_1m_uw', 'h2o_3m_uw', 'h2o_10m_uw', 'h2o_1m_ue', 'h2o_3m_ue', 'h2o_10m_ue', 'h2o_1m_d', 'h2o_3m_d', 'h2o_10m_d', 'h2o_2m_c', 'h2o_3m_c', 'h2o_5m_c', 'h2o_10m_c', 'h2o_15m_c', 'h2o_20m_c'
+# wind rose speed bins (m/s), closed on the right like pd.cut
+WINDROSE_SPEED_BINS = [0, 2, 4, 6, 8, 10, 12, 14, 50]
+WINDROSE_SPEED_LABELS = ['0-2', '2-4', '4-6', '6-8', '8-10', '10-12', '12-14', '>14+']
+# number of speed/direction pairs binned at a time by windrose_counts
+WINDROSE_BLOCK_SIZE = 2**20
+# cardinal wind directions for 16 sectors centred on north
+WINDROSE_DIRECTION_LABELS = [
+    'N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+    'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW',
 ]
-TEMPERATURE_VARIABLES = [    
-    # Temperature & Relative Humidity Array 
-    'T_2m_c', 'T_3m_c', 'T_4m_c', 'T_5m_c', 'T_6m_c', 'T_7m_c', 'T_8m_c', 'T_9m_c', 'T_10m_c',
-    'T_11m_c', 'T_12m_c', 'T_13m_c', 'T_14m_c', 'T_15m_c', 'T_16m_c', 'T_17m_c', 'T_18m_c', 'T_19m_c', 'T_20m_c',
 
-    'RH_2m_c', 'RH_3m_c', 'RH_4m_c', 'RH_5m_c', 'RH_6m_c', 'RH_7m_c', 'RH_8m_c', 'RH_9m_c', 'RH_10m_c',
-    'RH_11m_c','RH_12m_c','RH_13m_c','RH_14m_c','RH_15m_c','RH_16m_c','RH_17m_c','RH_18m_c','RH_19m_c','RH_20m_c'
-]
-PRESSURE_VARIABLES = [
-    # Pressure Sensors
-    'P_20m_c',
-    'P_10m_c', 'P_10m_d', 'P_10m_uw', 'P_10m_ue'
-]
-SNOW_FLUX = [
-    # Blowing snow/FlowCapt Sensors
-    'SF_avg_1m_ue', 'SF_avg_2m_ue',
-]
+def windrose_counts(speed, direction, speed_bins=WINDROSE_SPEED_BINS, n_sectors=16, counts=None):
+    """
+    This function counts wind speed/direction pairs into a 2D histogram for one or many sensors in one call
+    Inputs:
+        speed: array of wind speeds, shape (time,) or (time, sensor)
+        direction: array of wind directions in degrees, same shape as speed
+        speed_bins: speed bin edges, bins are closed on the right
+        n_sectors: number of direction sectors, the first one centred on north
+        counts: counts returned by an earlier call, added to the new counts so that
+                roses from chunks or files can be merged incrementally
+    Outputs:
+        counts: integer array of shape (n_sectors, n_speed_bins), or (sensor, n_sectors, n_speed_bins)
+                for 2D input. Pairs with a missing value or a speed outside the bins are not counted
+    """
+    speed = np.asarray(speed, dtype=float)
+    direction = np.asarray(direction, dtype=float)
+    squeeze = speed.ndim == 1
+    speed = speed.reshape(speed.shape[0], -1)
+    direction = direction.reshape(direction.shape[0], -1)
+    n_pairs = speed.shape[1]
+    speed_bins = np.asarray(speed_bins, dtype=float)
+    n_speed = len(speed_bins) - 1
+    n_bins = n_pairs * n_sectors * n_speed
+    # offset of each sensor in the flattened histogram
+    pair_offset = np.arange(n_pairs) * n_sectors * n_speed
+    new_counts = np.zeros(n_bins, dtype=np.int64)
+    # work through blocks of rows so the temporaries stay small and in cache
+    block = max(1, WINDROSE_BLOCK_SIZE // n_pairs)
+    for i in range(0, speed.shape[0], block):
+        spd = speed[i:i + block]
+        wdir = direction[i:i + block]
+        # shift by half a sector so that the first sector is centred on north and 360 falls in it
+        with np.errstate(invalid='ignore'):
+            flat = np.floor((wdir + 180 / n_sectors) * (n_sectors / 360)).astype(np.int64)
+        flat %= n_sectors
+        # right-closed speed bins, nan speeds land past the last bin
+        speed_ix = np.searchsorted(speed_bins, spd, side='left') - 1
+        valid = (speed_ix >= 0) & (speed_ix < n_speed) & np.isfinite(wdir)
+        flat *= n_speed
+        flat += speed_ix
+        flat += pair_offset
+        # invalid pairs are counted in an extra bin that is dropped
+        flat[~valid] = n_bins
+        new_counts += np.bincount(flat.ravel(), minlength=n_bins + 1)[:n_bins]
+    new_counts = new_counts.reshape(n_pairs, n_sectors, n_speed)
+    if squeeze:
+        new_counts = new_counts[0]
+    if counts is not None:
+        new_counts = new_counts + counts
+    return new_counts
+
+def windrose_counts_to_df(counts, speed_labels=WINDROSE_SPEED_LABELS, direction_labels=None):
+    """
+    This function converts wind rose counts of one sensor into a dataframe of frequencies for a plotly windrose
+    Inputs:
+        counts: integer array of shape (n_sectors, n_speed_bins) from windrose_counts
+        speed_labels: list of labels of the speed bins
+        direction_labels: list of labels of the sectors, cardinal directions for 16 sectors
+                          and the sector centre in degrees otherwise
+    Outputs:
+        windrose_df: pandas dataframe with direction, speed and frequency (%) columns
+    """
+    n_sectors, n_speed = counts.shape
+    if direction_labels is None:
+        if n_sectors == 16:
+            direction_labels = WINDROSE_DIRECTION_LABELS
+        else:
+            direction_labels = [f'{x:g}' for x in np.arange(n_sectors) * 360 / n_sectors]
+    windrose_df = pd.DataFrame({
+        'direction': np.repeat(direction_labels, n_speed),
+        'speed': np.tile(speed_labels, n_sectors),
+        'frequency': counts.ravel(),
+    })
+    # divide frequency by the total sum as a percentage
+    windrose_df['frequency'] = 100*windrose_df['frequency']/windrose_df['frequency'].sum()
+    return windrose_df
+
 # create a function to setup a dataframe for a windrose plot in plotly
+@timed_stage('transform')
 def create_windrose_df(df, wind_dir_var, wind_spd_var):
     """
     This function takes in a dataframe and wind speed and direction variables and returns a dataframe with the wind speed binned by direction
+    The input dataframe is not modified
     Inputs:
         df: pandas dataframe
         wind_dir_var: string of the wind direction variable
@@ -106,29 +113,11 @@ def create_windrose_df(df, wind_dir_var, wind_spd_var):
         windrose_df: pandas dataframe with the wind speed binned by direction
     """
     # group by 0-2, 2-4, 4-6, 6-8, 8-10, 10-12, 12-14, and >14 m/s bins
-    df['speed_bins'] = pd.cut(df[wind_spd_var], 
-                                           bins=[0,2,4,6,8,10,12,14,50], 
-                                           labels=['0-2','2-4','4-6','6-8','8-10','10-12','12-14','>14+'])
-    # group by cardinal wind directions
-    theta_labels = [
-            'N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
-             'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW', 
-        ]
-    theta_angles = np.arange(0, 360.1, 22.5)
-    df['dir_bins'] = pd.cut(df[wind_dir_var], 
-                                         bins=theta_angles, 
-                                         labels=theta_labels)
-    windrose_df = df.groupby(['dir_bins','speed_bins']).count().dropna()
-    windrose_df['direction'] = windrose_df.index.get_level_values('dir_bins')
-    windrose_df['speed'] = windrose_df.index.get_level_values('speed_bins')
-    windrose_df = windrose_df[
-                ['direction','speed', wind_spd_var]
-            ].droplevel(0).reset_index().drop('speed_bins',axis=1)
-    windrose_df.rename(columns={wind_spd_var:'frequency'}, inplace=True)
-    # divide frequency by the total sum as a percentage
-    windrose_df['frequency'] = 100*windrose_df['frequency']/windrose_df['frequency'].sum() 
-    return windrose_df
+    # and 16 cardinal wind directions centred on north
+    counts = windrose_counts(df[wind_spd_var].to_numpy(), df[wind_dir_var].to_numpy())
+    return windrose_counts_to_df(counts)
 
+@timed_stage('render')
 def simple_sounding(ds):
     """
     This function takes in a dataset and plots a skew-t diagram with the radiosonde data
@@ -227,7 +216,7 @@ def mean_sounding(df_mean, title):
     This function takes in a dataframe of mean u,v wind components, mean temperature, mean dewpoint, and mean pressure at 10 mb intervals
     and plots a skew-t diagram with the mean radiosonde data.
     Inputs:
-        df_mean: pandas dataframe
+        df_mean: pandas dataframe, e.g. one group of soundings.composite_soundings
         title: string of the title for the plot
     Outputs:
         fig: matplotlib figure
@@ -308,4 +297,4 @@ def mean_sounding(df_mean, title):
     # add metpy logo as an inset to the bottom left corner
     logo_fig= plt.gcf()
     add_metpy_logo(logo_fig, 750, -p.max().magnitude+1100, size='small', zorder=0)
-    return 
\ No newline at end of file
+    return fig
@@ -0,0 +1,94 @@
+import contextlib
+import functools
+import time
+
+# stages the data loaders and analysis helpers report
+STAGES = ('fetch', 'decode', 'concat', 'transform', 'render')
+# functions called with every timing record, nothing is timed while this is empty
+_SINKS = []
+
+
+def add_timing_sink(sink):
+    """
+    This function turns stage timing on by registering a sink, e.g. a list's append or print_sink
+    Inputs:
+        sink: function called with one record per timed stage, a dictionary of function, stage and seconds
+    Outputs:
+        sink: the registered sink, to pass to remove_timing_sink
+    """
+    _SINKS.append(sink)
+    return sink
+
+
+def remove_timing_sink(sink):
+    # stage timing turns off again once the last sink is removed
+    if sink in _SINKS:
+        _SINKS.remove(sink)
+
+
+def print_sink(record):
+    print(f'[TIMING] {record["function"]} {record["stage"]} {record["seconds"]:.3f} s')
+
+
+@contextlib.contextmanager
+def stage(function, name):
+    """
+    This function times one stage of a library function and reports it to every registered sink
+    Without a sink nothing is timed, so the hook costs one list check
+    Inputs:
+        function: string of the reporting function, e.g. 'get_sail_data'
+        name: one of STAGES
+    """
+    if not _SINKS:
+        yield
+        return
+    if name not in STAGES:
+        raise ValueError(f'unknown stage {name}, use one of {STAGES}')
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {'function': function, 'stage': name, 'seconds': time.perf_counter() - start}
+        for sink in list(_SINKS):
+            sink(record)
+
+
+def timed_stage(name):
+    """
+    This function times every call of the decorated function as one stage, for helpers timed as a whole
+    Inputs:
+        name: one of STAGES
+    Outputs:
+        decorator: function wrapping a function in stage(function name, name)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(func.__name__, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def record_timings():
+    """
+    This function collects the stage timings of everything run inside a with block
+    Outputs:
+        timings: list of timing records, filled while the block runs
+    """
+    timings = []
+    sink = add_timing_sink(timings.append)
+    try:
+        yield timings
+    finally:
+        remove_timing_sink(sink)
+
+
+def summarize_timings(timings):
+    # total seconds of every (function, stage), e.g. for a benchmark history
+    summary = {}
+    for record in timings:
+        key = f'{record["function"]}.{record["stage"]}'
+        summary[key] = summary.get(key, 0.0) + record['seconds']
+    return summary
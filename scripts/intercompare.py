@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import scipy.stats as stats
+
+from scripts.instrument import stage
+
+# running statistics kept per group and pixel: count, means, centred sums of squares and products,
+# and the sums of squared and absolute differences
+SUFFICIENT_STATISTICS = ['n', 'x_mean', 'y_mean', 'ssx', 'ssy', 'spxy', 'sse', 'sad']
+# meteorological seasons of each calendar month
+SEASONS = {12: 'DJF', 1: 'DJF', 2: 'DJF', 3: 'MAM', 4: 'MAM', 5: 'MAM',
+           6: 'JJA', 7: 'JJA', 8: 'JJA', 9: 'SON', 10: 'SON', 11: 'SON'}
+
+
+def time_groups(time, groupby='month'):
+    """
+    This function labels every time step with its group
+    Inputs:
+        time: array of datetimes
+        groupby: None (one group 'all'), 'month' (calendar month), 'season', 'water_year' (October to September),
+                 'year', a function of the pandas datetimeindex or an array of labels
+    Outputs:
+        groups: 1d array of the group label of every time step
+    """
+    time = pd.DatetimeIndex(time)
+    message = "groupby must be None, 'month', 'season', 'water_year', 'year', a function or labels"
+    if groupby is None:
+        return np.full(len(time), 'all', dtype=object)
+    # strings first, comparing an array of labels with a string is elementwise
+    if isinstance(groupby, str):
+        if groupby == 'month':
+            return time.month.to_numpy()
+        if groupby == 'season':
+            return time.month.map(SEASONS).to_numpy()
+        if groupby == 'water_year':
+            return np.where(time.month >= 10, time.year + 1, time.year)
+        if groupby == 'year':
+            return time.year.to_numpy()
+        raise ValueError(message)
+    if callable(groupby):
+        return np.asarray(groupby(time))
+    groups = np.asarray(groupby)
+    if groups.shape != (len(time),):
+        raise ValueError(message)
+    return groups
+
+
+def _time_batches(da, time_dim, batch_size):
+    # slices along time following the dask chunks, or batch_size steps for in-memory cubes
+    if da.chunks is not None and batch_size is None:
+        bounds = np.cumsum((0,) + da.chunks[da.get_axis_num(time_dim)])
+    else:
+        bounds = np.arange(0, da.sizes[time_dim] + (batch_size or 12), batch_size or 12)
+    bounds = np.minimum(bounds, da.sizes[time_dim])
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def _accumulate(sums, x, y, rows):
+    # merge one batch (time, ...) of pairs into the (group, ...) statistics, pairs with a nan are skipped
+    # the batch is centred on its own means and merged with Chan's pairwise update, so long series of large
+    # values do not lose precision to cancellation as raw moment sums do
+    valid = np.isfinite(x) & np.isfinite(y)
+    for row in np.unique(rows):
+        ok = valid[rows == row]
+        bx = np.where(ok, x[rows == row], 0)
+        by = np.where(ok, y[rows == row], 0)
+        n_batch = ok.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_mean = bx.sum(axis=0) / n_batch
+            y_mean = by.sum(axis=0) / n_batch
+        dx = np.where(ok, bx - x_mean, 0)
+        dy = np.where(ok, by - y_mean, 0)
+        n_total = sums['n'][row] + n_batch
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta_x = np.where(n_batch > 0, x_mean - sums['x_mean'][row], 0)
+            delta_y = np.where(n_batch > 0, y_mean - sums['y_mean'][row], 0)
+            share = np.where(n_total > 0, n_batch / n_total, 0)
+        weight = sums['n'][row] * share
+        sums['x_mean'][row] = sums['x_mean'][row] + delta_x * share
+        sums['y_mean'][row] = sums['y_mean'][row] + delta_y * share
+        sums['ssx'][row] = sums['ssx'][row] + (dx * dx).sum(axis=0) + delta_x * delta_x * weight
+        sums['ssy'][row] = sums['ssy'][row] + (dy * dy).sum(axis=0) + delta_y * delta_y * weight
+        sums['spxy'][row] = sums['spxy'][row] + (dx * dy).sum(axis=0) + delta_x * delta_y * weight
+        sums['sse'][row] = sums['sse'][row] + ((bx - by) ** 2).sum(axis=0)
+        sums['sad'][row] = sums['sad'][row] + np.abs(bx - by).sum(axis=0)
+        sums['n'][row] = n_total
+
+
+def statistics_from_sums(sums):
+    """
+    This function computes the comparison statistics of y against x from running statistics
+    Inputs:
+        sums: dictionary of SUFFICIENT_STATISTICS arrays
+    Outputs:
+        statistics: dictionary of n, x_mean, y_mean, corr, r_squared, slope, intercept (of y on x, as stats.linregress),
+                    rmse, mae, bias (mean of y - x) and p_value (two sided, of the slope / correlation)
+    """
+    n = sums['n'].astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(n > 0, sums['x_mean'], np.nan)
+        y_mean = np.where(n > 0, sums['y_mean'], np.nan)
+        ssx = sums['ssx']
+        ssy = sums['ssy']
+        spxy = sums['spxy']
+        corr = np.clip(spxy / np.sqrt(ssx * ssy), -1, 1)
+        slope = spxy / ssx
+        intercept = y_mean - slope * x_mean
+        rmse = np.sqrt(sums['sse'] / n)
+        mae = sums['sad'] / n
+        bias = y_mean - x_mean
+        dof = n - 2
+        t = corr * np.sqrt(dof / ((1 - corr) * (1 + corr)))
+        p_value = 2 * stats.t.sf(np.abs(t), dof)
+    p_value = np.where(dof > 0, p_value, np.nan)
+    return {'n': sums['n'], 'x_mean': x_mean, 'y_mean': y_mean, 'corr': corr, 'r_squared': corr ** 2,
+            'slope': slope, 'intercept': intercept, 'rmse': rmse, 'mae': mae, 'bias': bias, 'p_value': p_value}
+
+
+def intercompare(x, y, groupby='month', time_dim='month', spatial_dims=('y', 'x'), batch_size=None):
+    """
+    This function compares two aligned cubes per pixel and on their spatial means, for every group, in one pass
+    The cubes are read one time batch (dask chunk) at a time and only running statistics are kept, so memory does
+    not grow with the length of the record
+    Inputs:
+        x: xarray dataarray (time, y, x), e.g. imerg.ppt, can be dask backed
+        y: xarray dataarray on the same grid and times, e.g. prism_10km_ppt.ppt
+        groupby: grouping of the time steps, see time_groups
+        time_dim: name of the time dimension
+        spatial_dims: names of the grid dimensions
+        batch_size: number of time steps read at a time, default of the dask chunks (or 12)
+    Outputs:
+        pixel: xarray dataset of the statistics on (group, y, x)
+        spatial_mean: xarray dataset of the statistics of the spatial mean series on (group)
+    """
+    x, y = xr.align(x, y, join='exact')
+    x = x.transpose(time_dim, *spatial_dims)
+    y = y.transpose(time_dim, *spatial_dims)
+    groups = time_groups(x[time_dim].values, groupby)
+    labels, rows = np.unique(groups, return_inverse=True)
+    grid_shape = tuple(x.sizes[dim] for dim in spatial_dims)
+    pixel_sums = {name: np.zeros((len(labels),) + grid_shape) for name in SUFFICIENT_STATISTICS}
+    mean_sums = {name: np.zeros(len(labels)) for name in SUFFICIENT_STATISTICS}
+    for batch in _time_batches(x, time_dim, batch_size):
+        with stage('intercompare', 'decode'):
+            x_batch = np.asarray(x[{time_dim: batch}].values, dtype=float)
+            y_batch = np.asarray(y[{time_dim: batch}].values, dtype=float)
+        with stage('intercompare', 'transform'):
+            _accumulate(pixel_sums, x_batch, y_batch, rows[batch])
+            # spatial means over the pixels valid in both cubes
+            both = np.isfinite(x_batch) & np.isfinite(y_batch)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                count = both.sum(axis=(1, 2))
+                x_mean = np.where(both, x_batch, 0).sum(axis=(1, 2)) / count
+                y_mean = np.where(both, y_batch, 0).sum(axis=(1, 2)) / count
+            _accumulate(mean_sums, x_mean, y_mean, rows[batch])
+    group_coord = {'group': labels}
+    pixel_coords = dict(group_coord, **{dim: x[dim].values for dim in spatial_dims})
+    pixel = xr.Dataset({name: (('group',) + tuple(spatial_dims), values)
+                        for name, values in statistics_from_sums(pixel_sums).items()}, coords=pixel_coords)
+    spatial_mean = xr.Dataset({name: ('group', values)
+                               for name, values in statistics_from_sums(mean_sums).items()}, coords=group_coord)
+    return pixel, spatial_mean
@@ -0,0 +1,149 @@
+import glob
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import xarray as xr
+import rioxarray as rxr
+import shapely
+
+from scripts.instrument import stage
+
+# filename date patterns of the monthly rasters: a regex with one group and the strptime format of that group
+# e.g. PRISM_ppt_stable_4kmM3_201603_bil.bil and 3B-MO.MS.MRG.3IMERG.V06B_2016-03-01.tif
+RASTER_DATE_PATTERNS = {
+    'prism': (r'_(\d{6})_bil\.bil$', '%Y%m'),
+    'imerg': (r'(\d{4}-\d{2}-\d{2})\.tif$', '%Y-%m-%d'),
+}
+# name of the time dimension of the cubes, kept as 'month' to match compare_IMERG_PRISM.ipynb
+RASTER_TIME_DIM = 'month'
+# variable name xarray gives an unnamed dataarray written to netcdf
+UNNAMED_VARIABLE = '__xarray_dataarray_variable__'
+
+
+def parse_raster_date(filename, pattern='prism'):
+    """
+    This function parses the date of a raster from its filename
+    Inputs:
+        filename: string of the raster path
+        pattern: key of RASTER_DATE_PATTERNS, a (regex, format) tuple or a function of the filename returning a date
+    Outputs:
+        date: pandas timestamp
+    """
+    if callable(pattern):
+        return pd.Timestamp(pattern(filename))
+    regex, date_format = RASTER_DATE_PATTERNS.get(pattern, pattern)
+    match = re.search(regex, os.path.basename(filename))
+    if match is None:
+        raise ValueError(f'{filename} does not match the date pattern {regex}')
+    return pd.to_datetime(match.group(1), format=date_format)
+
+
+def _clip_raster(job):
+    # clip one raster, reading only the window of the boundary's bounding box
+    filename, geometry, crs = job
+    raster = rxr.open_rasterio(filename)
+    raster = raster.rio.clip_box(*shapely.total_bounds(geometry), crs=crs)
+    clipped = raster.rio.clip(geometry, crs=crs).squeeze('band', drop=True).load()
+    raster.close()
+    return clipped
+
+
+def clip_rasters(files, boundary, n_workers=None):
+    """
+    This function clips many rasters to a boundary in parallel
+    Inputs:
+        files: list of raster paths
+        boundary: geopandas geodataframe of the clipping polygon(s)
+        n_workers: number of processes, default of os.cpu_count(); 1 clips in this process
+    Outputs:
+        clipped: list of xarray dataarrays (y, x) in the order of files
+    """
+    # plain shapely geometries pickle cheaply to the workers
+    geometry = list(boundary.geometry.values)
+    crs = boundary.crs
+    jobs = [(filename, geometry, crs) for filename in files]
+    if n_workers == 1 or len(jobs) < 2:
+        return [_clip_raster(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(_clip_raster, jobs))
+
+
+def open_raster_cube(path, name=None):
+    """
+    This function opens a raster cube written by ingest_raster_stack, or an older unnamed netcdf cube
+    Inputs:
+        path: string of the .nc or .zarr cube
+        name: variable name given to an unnamed cube (__xarray_dataarray_variable__)
+    Outputs:
+        cube: xarray dataset
+    """
+    if path.rstrip('/').endswith('.zarr'):
+        cube = xr.open_zarr(path)
+    else:
+        cube = xr.open_dataset(path)
+    if name is not None and UNNAMED_VARIABLE in cube:
+        cube = cube.rename({UNNAMED_VARIABLE: name})
+    return cube
+
+
+def _write_cube(cube, path):
+    # write the whole cube, through a temporary path so a failed write keeps the old cube
+    tmp = path.rstrip('/') + '.tmp'
+    if path.rstrip('/').endswith('.zarr'):
+        cube.to_zarr(tmp, mode='w')
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        cube.to_netcdf(tmp)
+        if os.path.exists(path):
+            os.remove(path)
+    os.replace(tmp, path)
+
+
+def ingest_raster_stack(files, boundary, out_path, name, pattern='prism', n_workers=None):
+    """
+    This function clips a stack of rasters to a boundary and writes them as one time-indexed cube
+    Only files whose date is not in an existing cube at out_path are read, so adding one month clips one file
+    Inputs:
+        files: list of raster paths, or a glob pattern
+        boundary: geopandas geodataframe of the clipping polygon(s), e.g. the UCRB boundary
+        out_path: string of the cube, written as zarr if it ends with .zarr and netcdf otherwise
+        name: string of the variable name in the cube, e.g. 'ppt' or 'tmean'
+        pattern: filename date pattern, see parse_raster_date
+        n_workers: number of processes clipping rasters
+    Outputs:
+        cube: xarray dataset with the variable name on (month, y, x), sorted by month
+    """
+    if isinstance(files, str):
+        files = glob.glob(files)
+    dates = pd.DatetimeIndex([parse_raster_date(filename, pattern) for filename in files])
+    existing = None
+    if os.path.exists(out_path):
+        # opened lazily, only the month index is read to find the new files
+        existing = open_raster_cube(out_path, name)
+        new = ~dates.isin(existing[RASTER_TIME_DIM].values)
+        files = [filename for filename, is_new in zip(files, new) if is_new]
+        dates = dates[new]
+    if len(files) == 0:
+        return existing
+    with stage('ingest_raster_stack', 'decode'):
+        clipped = clip_rasters(files, boundary, n_workers=n_workers)
+    with stage('ingest_raster_stack', 'concat'):
+        # the clipped grids share the boundary's window, so their coordinates are overridden rather than aligned
+        stack = xr.concat(clipped, dim=pd.Index(dates, name=RASTER_TIME_DIM), join='override')
+        cube = stack.to_dataset(name=name).sortby(RASTER_TIME_DIM)
+    if existing is None:
+        _write_cube(cube, out_path)
+        return cube
+    if out_path.rstrip('/').endswith('.zarr') and cube[RASTER_TIME_DIM].min() > existing[RASTER_TIME_DIM].max():
+        # months after the end of the cube are appended without rewriting it
+        cube.to_zarr(out_path, append_dim=RASTER_TIME_DIM)
+        return xr.concat([existing, cube], dim=RASTER_TIME_DIM, join='override')
+    # the whole cube is rewritten, so the existing months are read before the file is replaced
+    existing = existing.load()
+    existing.close()
+    cube = xr.concat([existing, cube], dim=RASTER_TIME_DIM, join='override').sortby(RASTER_TIME_DIM)
+    _write_cube(cube, out_path)
+    return cube
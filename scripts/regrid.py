@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+import xarray as xr
+import pyproj
+import shapely
+import scipy.sparse as sparse
+
+from scripts.instrument import stage
+from scripts.zonal import grid_cells, grid_fingerprint
+
+# directory of the cached regridding weights
+REGRID_CACHE_DIR = './data/regrid_weights/'
+REGRID_METHODS = ('nearest', 'conservative')
+
+
+def _grid_crs(da, crs):
+    # crs given explicitly, or from the rioxarray accessor when rioxarray is loaded
+    if crs is not None:
+        return pyproj.CRS.from_user_input(crs)
+    try:
+        rio_crs = da.rio.crs
+    except AttributeError:
+        rio_crs = None
+    if rio_crs is None:
+        raise ValueError('the grid has no crs, pass it explicitly or write it with rio.write_crs')
+    return pyproj.CRS.from_user_input(rio_crs)
+
+
+def nearest_weights(src_x, src_y, src_crs, dst_x, dst_y, dst_crs):
+    """
+    This function maps every target cell to the source cell containing its center, as Resampling.nearest
+    Inputs:
+        src_x, src_y: 1d arrays of the regular source cell centers
+        src_crs: crs of the source grid
+        dst_x, dst_y: 1d arrays of the regular target cell centers
+        dst_crs: crs of the target grid
+    Outputs:
+        weights: scipy sparse csr matrix (target cell, source cell), one 1 per target cell inside the source grid
+    """
+    src_x = np.asarray(src_x, dtype=float)
+    src_y = np.asarray(src_y, dtype=float)
+    xx, yy = np.meshgrid(np.asarray(dst_x, dtype=float), np.asarray(dst_y, dtype=float))
+    transformer = pyproj.Transformer.from_crs(dst_crs, src_crs, always_xy=True)
+    xx, yy = transformer.transform(xx.ravel(), yy.ravel())
+    # index of the containing cell on the regular source grid
+    col = np.floor((xx - src_x[0]) / (src_x[1] - src_x[0]) + 0.5)
+    row = np.floor((yy - src_y[0]) / (src_y[1] - src_y[0]) + 0.5)
+    valid = np.isfinite(col) & np.isfinite(row) & (col >= 0) & (col < src_x.size) & (row >= 0) & (row < src_y.size)
+    target = np.flatnonzero(valid)
+    source = row[valid].astype(np.int64) * src_x.size + col[valid].astype(np.int64)
+    return sparse.csr_matrix((np.ones(target.size), (target, source)), shape=(xx.size, src_x.size * src_y.size))
+
+
+def _interval_overlaps(src, dst):
+    # length of overlap of every target cell with every source cell along one axis of regular grids
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    src_step = np.abs(np.diff(src).mean()) if src.size > 1 else 1.0
+    dst_step = np.abs(np.diff(dst).mean()) if dst.size > 1 else 1.0
+    order = np.argsort(src)
+    src_low = src[order] - src_step / 2
+    dst_low, dst_high = dst - dst_step / 2, dst + dst_step / 2
+    # the sorted source cells overlapping each target cell are a contiguous run
+    first = np.searchsorted(src_low + src_step, dst_low, side='right')
+    last = np.searchsorted(src_low, dst_high, side='left')
+    counts = np.maximum(last - first, 0)
+    target = np.repeat(np.arange(dst.size), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+    length = (np.minimum(dst_high[target], src_low[position] + src_step)
+              - np.maximum(dst_low[target], src_low[position]))
+    keep = length > 0
+    return sparse.csr_matrix((length[keep], (target[keep], order[position[keep]])), shape=(dst.size, src.size))
+
+
+def conservative_weights(src_x, src_y, src_crs, dst_x, dst_y, dst_crs):
+    """
+    This function computes the area of overlap of every target cell with every source cell
+    Grids in the same crs are both rectilinear, so the overlaps are the outer product of the overlaps along x and
+    along y, without building a polygon per cell, e.g. for the 150 m dem onto the IMERG grid
+    Grids in different crs build a polygon per source cell, which is meant for grids of up to about a million
+    cells: target cells are projected to the source crs with densified edges, source cells inside a target cell
+    count fully and only the cells on target cell edges are intersected
+    Inputs:
+        src_x, src_y: 1d arrays of the regular source cell centers
+        src_crs: crs of the source grid
+        dst_x, dst_y: 1d arrays of the regular target cell centers
+        dst_crs: crs of the target grid
+    Outputs:
+        weights: scipy sparse csr matrix (target cell, source cell) of overlap areas in source crs units
+    """
+    if pyproj.CRS.from_user_input(src_crs).equals(pyproj.CRS.from_user_input(dst_crs)):
+        # (target row, source row) x (target column, source column) in row-major cell order
+        return sparse.kron(_interval_overlaps(src_y, dst_y), _interval_overlaps(src_x, dst_x), format='csr')
+    src_cells, src_area = grid_cells(src_x, src_y)
+    dst_cells, _ = grid_cells(dst_x, dst_y)
+    transformer = pyproj.Transformer.from_crs(dst_crs, src_crs, always_xy=True)
+    step = min(np.abs(np.diff(dst_x).mean()), np.abs(np.diff(dst_y).mean())) / 8
+    dst_cells = shapely.transform(shapely.segmentize(dst_cells, step),
+                                  lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+    tree = shapely.STRtree(src_cells)
+    target, source = tree.query(dst_cells, predicate='intersects')
+    inside_target, inside_source = tree.query(dst_cells, predicate='contains')
+    # pairs with the source cell fully inside the target cell, by a sorted pair key
+    n_src = src_cells.size
+    inside = np.isin(target * n_src + source, inside_target * n_src + inside_source)
+    area = np.full(target.size, src_area)
+    edge = ~inside
+    area[edge] = shapely.area(shapely.intersection(dst_cells[target[edge]], src_cells[source[edge]]))
+    keep = area > 0
+    return sparse.csr_matrix((area[keep], (target[keep], source[keep])), shape=(dst_cells.size, n_src))
+
+
+def regrid_weights(src_x, src_y, src_crs, dst_x, dst_y, dst_crs, method='nearest', cache_dir=REGRID_CACHE_DIR):
+    """
+    This function returns the weights of a source to target grid pair, computed once and cached on disk
+    Inputs:
+        src_x, src_y, src_crs: source grid cell centers and crs
+        dst_x, dst_y, dst_crs: target grid cell centers and crs
+        method: 'nearest' or 'conservative' (area weighted)
+        cache_dir: directory of the .npz weights, None to skip the cache
+    Outputs:
+        weights: scipy sparse csr matrix (target cell, source cell)
+    """
+    if method not in REGRID_METHODS:
+        raise ValueError(f'method must be one of {REGRID_METHODS}')
+    path = None
+    if cache_dir is not None:
+        key = f'{grid_fingerprint(src_x, src_y, src_crs)}_{grid_fingerprint(dst_x, dst_y, dst_crs)}_{method}.npz'
+        path = os.path.join(cache_dir, key)
+        if os.path.exists(path):
+            return sparse.load_npz(path).tocsr()
+    if method == 'nearest':
+        weights = nearest_weights(src_x, src_y, src_crs, dst_x, dst_y, dst_crs)
+    else:
+        weights = conservative_weights(src_x, src_y, src_crs, dst_x, dst_y, dst_crs)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path[:-len('.npz')] + '.tmp.npz'
+        sparse.save_npz(tmp, weights)
+        os.replace(tmp, path)
+    return weights
+
+
+def apply_regrid_weights(weights, da, dst_x, dst_y, x_dim='x', y_dim='y'):
+    """
+    This function regrids a whole stack with one sparse product
+    Each target cell is the weighted mean of its valid (not nan) source cells
+    Inputs:
+        weights: scipy sparse csr matrix from regrid_weights
+        da: xarray dataarray (..., y, x) on the source grid, e.g. a (month, y, x) precipitation cube
+        dst_x, dst_y: 1d arrays of the target cell centers
+        x_dim, y_dim: names of the grid dimensions
+    Outputs:
+        regridded: xarray dataarray (..., y, x) on the target grid, nan where no source cell overlaps
+    """
+    da = da.transpose(..., y_dim, x_dim)
+    other_dims = da.dims[:-2]
+    values = da.values.reshape(-1, weights.shape[1])
+    valid = np.isfinite(values)
+    # (target, source) @ (source, stack)
+    totals = weights @ np.where(valid, values, 0).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        regridded = (totals / (weights @ valid.T.astype(float))).T
+    regridded = regridded.reshape(da.shape[:-2] + (len(dst_y), len(dst_x)))
+    coords = {dim: da[dim] for dim in other_dims}
+    coords[y_dim] = np.asarray(dst_y)
+    coords[x_dim] = np.asarray(dst_x)
+    return xr.DataArray(regridded, dims=other_dims + (y_dim, x_dim), coords=coords, name=da.name, attrs=da.attrs)
+
+
+def regrid(da, target, method='nearest', src_crs=None, dst_crs=None, cache_dir=REGRID_CACHE_DIR,
+           x_dim='x', y_dim='y'):
+    """
+    This function regrids a dataarray onto the grid of another, the cached replacement of rio.reproject_match
+    Inputs:
+        da: xarray dataarray (..., y, x) to regrid, e.g. the 150 m dem or prism_4km_ppt.ppt
+        target: xarray dataarray or dataset on the target grid, e.g. imerg
+        method: 'nearest' or 'conservative'
+        src_crs, dst_crs: crs of the grids, default of da.rio.crs and target.rio.crs
+        cache_dir: directory of the cached weights
+        x_dim, y_dim: names of the grid dimensions
+    Outputs:
+        regridded: xarray dataarray (..., y, x) on the target grid
+    """
+    src_crs = _grid_crs(da, src_crs)
+    dst_crs = _grid_crs(target, dst_crs)
+    dst_x = target[x_dim].values
+    dst_y = target[y_dim].values
+    with stage('regrid', 'transform'):
+        weights = regrid_weights(da[x_dim].values, da[y_dim].values, src_crs, dst_x, dst_y, dst_crs,
+                                 method=method, cache_dir=cache_dir)
+        return apply_regrid_weights(weights, da, dst_x, dst_y, x_dim=x_dim, y_dim=y_dim)
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+from scripts.water_year import WATER_YEAR_START_MONTH, day_of_water_year, water_year
+
+# meltout is searched from this day of water year on (92 = December 31st), as in snotel_max_accumulation.ipynb
+MELTOUT_SEARCH_DOWY = 92
+
+
+def _station_years(df, station_col, date_col, start_month):
+    # integer station-year code of every row with a date: station position * n_years + years since the first
+    # water year; rows without a date belong to no water year, as in the notebook's groupby
+    dates = pd.DatetimeIndex(df[date_col])
+    valid = ~dates.isna()
+    if station_col is not None:
+        station_codes, stations = pd.factorize(df[station_col], sort=True)
+    else:
+        station_codes, stations = np.zeros(len(df), dtype=np.int64), pd.Index([0])
+    dates, station_codes = dates[valid], station_codes[valid]
+    wy = water_year(dates, start_month)
+    first_wy = wy.min() if wy.size else 0
+    n_years = wy.max() - first_wy + 1 if wy.size else 1
+    codes = {'stations': stations, 'first_wy': first_wy, 'n_years': n_years, 'valid': valid}
+    return station_codes * n_years + (wy - first_wy), day_of_water_year(dates, start_month), dates.values, codes
+
+
+def _first_where(mask, starts, size):
+    # position of the first True of each group of a frame sorted by group, -1 for none
+    positions = np.where(mask, np.arange(size), size)
+    first = np.minimum.reduceat(positions, starts)
+    return np.where(first < size, first, -1)
+
+
+def snow_events(df, station_col='station', date_col='datetime', swe_col='SWE',
+                meltout_search_dowy=MELTOUT_SEARCH_DOWY, start_month=WATER_YEAR_START_MONTH):
+    """
+    This function finds the snow season events of every station and water year in one pass
+    Peak SWE is the first day with the largest SWE, meltout the first day after meltout_search_dowy with the
+    smallest SWE (the notebook's idxmin), first snow the first day with SWE > 0
+    Inputs:
+        df: long pandas dataframe with one row per station and day
+        station_col: name of the station column, None for a single station
+        date_col: name of the datetime column
+        swe_col: name of the SWE column
+        meltout_search_dowy: meltout is the minimum SWE after this day of water year
+        start_month: first month of the water year
+    Outputs:
+        events: pandas dataframe indexed by (station, water_year) with peak_date, peak_dowy, peak_swe,
+                meltout_date, meltout_dowy, first_snow_date, first_snow_dowy and accumulation_days
+                (first snow to peak)
+    """
+    group, dowy, dates, codes = _station_years(df, station_col, date_col, start_month)
+    swe = df[swe_col].to_numpy(dtype=float)[codes['valid']]
+    # one sort for the whole frame, skipped for frames already in station and date order
+    key = group * 367 + dowy
+    if not np.all(key[1:] >= key[:-1]):
+        order = np.argsort(key, kind='stable')
+        group, dowy, dates, swe = group[order], dowy[order], dates[order], swe[order]
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]]) if swe.size else np.array([], dtype=int)
+    counts = np.diff(np.r_[starts, swe.size])
+    events = {}
+    if swe.size:
+        # reductions over contiguous groups, nan ignored
+        peak_swe = np.fmax.reduceat(swe, starts)
+        meltout_swe = np.where(dowy > meltout_search_dowy, swe, np.nan)
+        meltout_min = np.fmin.reduceat(meltout_swe, starts)
+        rows = {
+            'peak': _first_where(swe == np.repeat(peak_swe, counts), starts, swe.size),
+            'meltout': _first_where(meltout_swe == np.repeat(meltout_min, counts), starts, swe.size),
+            'first_snow': _first_where(swe > 0, starts, swe.size),
+        }
+        for name, row in rows.items():
+            found = row >= 0
+            events[f'{name}_date'] = np.where(found, dates[row], np.datetime64('NaT'))
+            events[f'{name}_dowy'] = np.where(found, dowy[row], np.nan)
+        events['peak_swe'] = peak_swe
+        events['accumulation_days'] = events['peak_dowy'] - events['first_snow_dowy']
+    labels = group[starts]
+    index = pd.MultiIndex.from_arrays([codes['stations'][labels // codes['n_years']],
+                                       labels % codes['n_years'] + codes['first_wy']],
+                                      names=['station', 'water_year'])
+    return pd.DataFrame(events, index=index)
+
+
+def days_until_meltout(df, events=None, station_col='station', date_col='datetime', swe_col='SWE',
+                       start_month=WATER_YEAR_START_MONTH):
+    """
+    This function computes the days until meltout of every row, negative after meltout
+    Inputs:
+        df: long pandas dataframe, see snow_events
+        events: dataframe from snow_events, computed when not given
+        station_col, date_col, swe_col, start_month: see snow_events
+    Outputs:
+        days_until_meltout: pandas series on the index of df
+    """
+    if events is None:
+        events = snow_events(df, station_col=station_col, date_col=date_col, swe_col=swe_col,
+                             start_month=start_month)
+    group, dowy, _, codes = _station_years(df, station_col, date_col, start_month)
+    # meltout day of every station-year code, looked up per row
+    station = codes['stations'].get_indexer(events.index.get_level_values('station'))
+    year = events.index.get_level_values('water_year').to_numpy() - codes['first_wy']
+    known = (station >= 0) & (year >= 0) & (year < codes['n_years'])
+    meltout_dowy = np.full(len(codes['stations']) * codes['n_years'], np.nan)
+    meltout_dowy[station[known] * codes['n_years'] + year[known]] = events['meltout_dowy'].to_numpy()[known]
+    days = np.full(len(df), np.nan)
+    days[codes['valid']] = meltout_dowy[group] - dowy
+    return pd.Series(days, index=df.index, name='days_until_meltout')
@@ -0,0 +1,380 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from metpy.units import units
+import metpy.calc as mcalc
+
+from scripts.instrument import stage
+
+# variables read from each sonde file
+SOUNDING_VARIABLES = ['pres', 'tdry', 'rh', 'u_wind', 'v_wind']
+# dendritic growth zone temperature bounds (degC)
+DGZ_BOUNDS = (-18, -12)
+# pressures (mb) where wind barbs are drawn, every 50 mb
+BARB_LEVELS = np.arange(200, 720, 50)
+# common 10 mb pressure grid (mb) of composite soundings, surface first
+PRESSURE_LEVELS = np.arange(1050, 190, -10)
+# variables gridded and composited across soundings
+COMPOSITE_VARIABLES = ['tdry', 'tdew', 'u_wind', 'v_wind']
+# histogram bins used for running quantiles, 0.25 degC or m/s wide
+QUANTILE_BINS = np.arange(-120, 120.25, 0.25)
+
+
+def find_sonde_files(path):
+    """
+    This function lists the sonde files in a directory or matching a glob pattern
+    Inputs:
+        path: string of a directory (every *.cdf / *.nc file in it) or a glob pattern
+    Outputs:
+        files: sorted list of file paths
+    """
+    if os.path.isdir(path):
+        files = glob.glob(os.path.join(path, '*.cdf')) + glob.glob(os.path.join(path, '*.nc'))
+    else:
+        files = glob.glob(path)
+    return sorted(files)
+
+
+def load_soundings(files, min_pres=200):
+    """
+    This function reads many sonde files into one long dataframe, keeping levels with pres > min_pres
+    Inputs:
+        files: list of sonde file paths, or a directory / glob pattern
+        min_pres: lowest pressure (mb) to keep
+    Outputs:
+        soundings: pandas dataframe with sounding, launch_time, file and the SOUNDING_VARIABLES columns
+    """
+    if isinstance(files, str):
+        files = find_sonde_files(files)
+    frames = []
+    for i, fname in enumerate(files):
+        with xr.open_dataset(fname) as ds:
+            df = pd.DataFrame({var: ds[var].values for var in SOUNDING_VARIABLES})
+            if 'tdew' in ds:
+                df['tdew'] = ds['tdew'].values
+            df['launch_time'] = pd.to_datetime(ds['time'].values[0])
+        df['sounding'] = i
+        df['file'] = fname
+        frames.append(df[df['pres'] > min_pres])
+    soundings = pd.concat(frames, ignore_index=True)
+    return soundings
+
+
+def derive_sounding_fields(soundings):
+    """
+    This function computes dewpoint and the DGZ bounds of every sounding in one vectorized pass
+    Inputs:
+        soundings: long dataframe from load_soundings
+    Outputs:
+        soundings: the dataframe with a tdew column (degC)
+        summary: pandas dataframe indexed by sounding with launch_time, file and the
+                 pressures (mb) of the first and last level inside the DGZ (nan if there is none)
+    """
+    # calculate dewpoint for every level of every sounding at once
+    tdew = mcalc.dewpoint_from_relative_humidity(soundings['tdry'].values * units.degC,
+                                                 soundings['rh'].values * units.percent)
+    tdew = tdew.m_as('degC')
+    if 'tdew' in soundings:
+        # keep dewpoints that came with the files
+        tdew = np.where(soundings['tdew'].isna(), tdew, soundings['tdew'].values)
+    soundings = soundings.assign(tdew=tdew)
+    # find the levels where T is between -12 and -18
+    in_dgz = (soundings['tdry'] > DGZ_BOUNDS[0]) & (soundings['tdry'] < DGZ_BOUNDS[1])
+    dgz = soundings.loc[in_dgz, ['sounding', 'pres']].groupby('sounding')['pres']
+    summary = soundings.groupby('sounding')[['launch_time', 'file']].first()
+    summary['dgz_bottom'] = dgz.first()
+    summary['dgz_top'] = dgz.last()
+    return soundings, summary
+
+
+def grid_soundings(soundings, levels=PRESSURE_LEVELS, variables=COMPOSITE_VARIABLES):
+    """
+    This function interpolates every sounding onto a common log-pressure grid in one vectorized pass
+    Inputs:
+        soundings: long dataframe from derive_sounding_fields
+        levels: pressures (mb) of the grid
+        variables: list of the variables to interpolate
+    Outputs:
+        gridded: xarray dataset of (sounding, pres) arrays, nan outside of each sounding's pressure range
+    """
+    soundings = soundings.dropna(subset=['pres'])
+    ids, snd_ix = np.unique(soundings['sounding'].to_numpy(), return_inverse=True)
+    # -log(p) increases with height and stays within (-8, 0), so adding 100 per
+    # sounding gives one sorted key where every sounding has its own interval
+    key = snd_ix * 100 - np.log(soundings['pres'].to_numpy())
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    snd_ix = snd_ix[order]
+    target = np.arange(len(ids))[:, None] * 100 - np.log(np.asarray(levels, dtype=float))[None, :]
+    hi = np.minimum(np.searchsorted(key, target), len(key) - 1)
+    # a target on a level, e.g. the first level of a sounding, takes that level, otherwise the level below it
+    lo = np.where(key[hi] == target, hi, np.maximum(hi - 1, 0))
+    # only interpolate between two levels of the same sounding
+    own = np.arange(len(ids))[:, None]
+    valid = (snd_ix[lo] == own) & (snd_ix[hi] == own) & (key[lo] <= target) & (target <= key[hi])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(key[hi] > key[lo], (target - key[lo]) / (key[hi] - key[lo]), 1.0)
+    data_vars = {}
+    for var in variables:
+        values = soundings[var].to_numpy(dtype=float)[order]
+        gridded = values[lo] + weight * (values[hi] - values[lo])
+        data_vars[var] = (('sounding', 'pres'), np.where(valid, gridded, np.nan))
+    launch_time = soundings.groupby('sounding')['launch_time'].first().loc[ids].to_numpy()
+    gridded = xr.Dataset(data_vars, coords={'sounding': ids, 'pres': np.asarray(levels),
+                                            'launch_time': ('sounding', launch_time)})
+    return gridded
+
+
+def _composite_groups(launch_time, groupby):
+    # group key of each sounding
+    launch_time = pd.DatetimeIndex(launch_time)
+    if groupby is None:
+        return np.full(len(launch_time), 'all', dtype=object)
+    # strings first, comparing an array with a string is elementwise
+    if isinstance(groupby, str) and groupby == 'month':
+        return launch_time.month.to_numpy()
+    if isinstance(groupby, str) and groupby == 'hour':
+        return launch_time.hour.to_numpy()
+    if callable(groupby):
+        return np.asarray([groupby(x) for x in launch_time])
+    raise ValueError("groupby must be None, 'month', 'hour' or a function of the launch time")
+
+
+def update_composite(composite, gridded, groupby=None):
+    """
+    This function adds gridded soundings to running per-level accumulators
+    Inputs:
+        composite: dictionary of accumulators from an earlier call, or an empty dictionary
+        gridded: xarray dataset from grid_soundings
+        groupby: None, 'month', 'hour' (launch hour, i.e. time of day) or a function of the launch time
+    Outputs:
+        composite: the updated dictionary, group key to count, sum and histogram arrays of shape (variable, level, ...)
+    """
+    variables = list(gridded.data_vars)
+    # (sounding, variable, level)
+    values = np.stack([gridded[var].values for var in variables], axis=1)
+    groups = _composite_groups(gridded['launch_time'].values, groupby)
+    n_bins = len(QUANTILE_BINS) + 1
+    for group in pd.unique(groups).tolist():
+        group_values = values[groups == group]
+        if group not in composite:
+            shape = group_values.shape[1:]
+            composite[group] = {
+                'variables': variables,
+                'pres': gridded['pres'].values,
+                'count': np.zeros(shape, dtype=np.int64),
+                'sum': np.zeros(shape),
+                'hist': np.zeros(shape + (n_bins,), dtype=np.int64),
+            }
+        acc = composite[group]
+        finite = np.isfinite(group_values)
+        acc['count'] += finite.sum(axis=0)
+        acc['sum'] += np.where(finite, group_values, 0).sum(axis=0)
+        # one bincount over (variable, level, bin) for the histogram of the whole batch
+        bins = np.searchsorted(QUANTILE_BINS, group_values)
+        cell = np.arange(np.prod(group_values.shape[1:])).reshape(group_values.shape[1:])
+        flat = (cell[None] * n_bins + bins)[finite]
+        acc['hist'] += np.bincount(flat, minlength=acc['hist'].size).reshape(acc['hist'].shape)
+    return composite
+
+
+def _histogram_quantile(hist, count, q):
+    # linear interpolation inside the histogram bin holding quantile q
+    cum = np.cumsum(hist, axis=-1)
+    rank = q * count[..., None]
+    ix = np.minimum((cum < rank).sum(axis=-1), hist.shape[-1] - 1)
+    # bin edges, the open end bins are closed at the grid limits
+    edges = np.concatenate([[QUANTILE_BINS[0]], QUANTILE_BINS, [QUANTILE_BINS[-1]]])
+    below = np.take_along_axis(cum, ix[..., None], axis=-1)[..., 0] - np.take_along_axis(hist, ix[..., None], axis=-1)[..., 0]
+    in_bin = np.take_along_axis(hist, ix[..., None], axis=-1)[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(in_bin > 0, (q * count - below) / in_bin, 0)
+    return np.where(count > 0, edges[ix] + frac * (edges[ix + 1] - edges[ix]), np.nan)
+
+
+def finalize_composite(composite, quantiles=(0.1, 0.5, 0.9)):
+    """
+    This function turns running accumulators into mean, quantile and count profiles
+    Inputs:
+        composite: dictionary from update_composite
+        quantiles: quantiles to estimate from the running histograms
+    Outputs:
+        profiles: dictionary of group key to a pandas dataframe with pres, the mean of each variable,
+                  {var}_q{quantile} and {var}_count columns, surface first and only levels with data,
+                  i.e. the input of helper_funcs.mean_sounding
+    """
+    profiles = {}
+    for group, acc in composite.items():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = acc['sum'] / acc['count']
+        profile = pd.DataFrame({'pres': acc['pres']})
+        for i, var in enumerate(acc['variables']):
+            profile[var] = mean[i]
+            for q in quantiles:
+                profile[f'{var}_q{q:g}'] = _histogram_quantile(acc['hist'][i], acc['count'][i], q)
+            profile[f'{var}_count'] = acc['count'][i]
+        # drop levels that no sounding reached
+        has_data = (acc['count'] > 0).all(axis=0)
+        profiles[group] = profile[has_data].reset_index(drop=True)
+    return profiles
+
+
+def composite_soundings(files, groupby=None, levels=PRESSURE_LEVELS, quantiles=(0.1, 0.5, 0.9),
+                        batch_size=50):
+    """
+    This function composites many sonde files on a common pressure grid in constant memory
+    Files are read batch by batch and only the running accumulators are kept between batches
+    Inputs:
+        files: list of sonde file paths, or a directory / glob pattern
+        groupby: None, 'month', 'hour' (launch hour, i.e. time of day) or a function of the launch time
+        levels: pressures (mb) of the grid
+        quantiles: quantiles to estimate per level
+        batch_size: number of files read at a time
+    Outputs:
+        profiles: dictionary of group key ('all' without groupby) to a dataframe for helper_funcs.mean_sounding
+    """
+    if isinstance(files, str):
+        files = find_sonde_files(files)
+    composite = {}
+    for i in range(0, len(files), batch_size):
+        with stage('composite_soundings', 'decode'):
+            soundings = load_soundings(files[i:i + batch_size], min_pres=0)
+        with stage('composite_soundings', 'transform'):
+            soundings, _ = derive_sounding_fields(soundings)
+            update_composite(composite, grid_soundings(soundings, levels), groupby)
+    with stage('composite_soundings', 'transform'):
+        return finalize_composite(composite, quantiles)
+
+
+def skewt_background():
+    """
+    This function draws the static part of a sounding figure (axes style, adiabats, mixing lines, logo)
+    Outputs:
+        fig: matplotlib figure
+        skew: metpy SkewT on the figure
+    """
+    import matplotlib.pyplot as plt
+    from metpy.plots import SkewT, add_metpy_logo
+
+    fig = plt.figure(figsize=(8, 12))
+    # increase whitespace at the bottom of the plot
+    fig.subplots_adjust(bottom=0.2)
+    skew = SkewT(fig, aspect=100)
+    # draw the special lines over a wide range so they cover every sounding
+    skew.ax.set_xlim(-60, 50)
+    skew.ax.set_ylim(1050, 200)
+    # change the color and linestyle of the grid lines
+    skew.ax.grid(True, which='major', axis='both', color='white', linestyle='-', linewidth=1, alpha=0.5, label='Isotherms')
+    # Set some better labels than the default
+    skew.ax.set_xlabel('Temperature (\N{DEGREE CELSIUS})')
+    skew.ax.set_ylabel('Pressure (mb)')
+    # Add the relevant special lines
+    skew.plot_dry_adiabats(colors='red', alpha=0.5, linestyle='-', label='Dry Adiabats')
+    skew.plot_moist_adiabats(colors='blue', alpha=0.75, linestyle='-', label='Moist Adiabats')
+    skew.plot_mixing_lines(colors='grey', alpha=0.5, label='Mixing Ratio')
+    # make the outline of the figure white
+    for spine in ['top', 'left', 'right', 'bottom']:
+        skew.ax.spines[spine].set_color('white')
+    # make the background color black
+    skew.ax.set_facecolor('black')
+    # make the whole figure black
+    fig.patch.set_facecolor('black')
+    # make xaxis and yaxis ticks, labels, and ticklabels white
+    skew.ax.xaxis.label.set_color('white')
+    skew.ax.yaxis.label.set_color('white')
+    skew.ax.tick_params(axis='both', colors='white')
+    # add metpy logo as an inset to the bottom left corner
+    add_metpy_logo(fig, 750, 400, size='small', zorder=0)
+    return fig, skew
+
+
+def draw_sounding(skew, sounding, dgz_bottom, dgz_top, time):
+    """
+    This function draws one sounding on a background from skewt_background
+    Inputs:
+        skew: metpy SkewT
+        sounding: dataframe of a single sounding with pres, tdry, tdew, u_wind and v_wind
+        dgz_bottom, dgz_top: pressures (mb) of the DGZ bounds, nan if there is none
+        time: string of the launch time for the title
+    Outputs:
+        artists: list of the artists added, remove them to reuse the background
+    """
+    p = sounding['pres'].values * units.hPa
+    T = sounding['tdry'].values * units.degC
+    Td = sounding['tdew'].values * units.degC
+    u = sounding['u_wind'].values * units('m/s')
+    v = sounding['v_wind'].values * units('m/s')
+    artists = []
+    artists += skew.plot(p, T, 'r', label='Temperature')
+    artists += skew.plot(p, Td, 'g', label='Dew Point')
+    # Get indexes of values closest to defined interval
+    ix = mcalc.resample_nn_1d(p, BARB_LEVELS * units('mbar'))
+    # Plot only values nearest to defined interval values
+    artists.append(skew.plot_barbs(p[ix], u[ix], v[ix], color='white'))
+    skew.ax.set_ylim(p[0], 200)
+    if not np.isnan(dgz_bottom):
+        # plot a yellow line at the top and bottom of the dgz only on the left 0.25 of the plot
+        artists.append(skew.ax.axhline(y=dgz_bottom, color='yellow', linestyle='--', alpha=0.5, xmin=0, xmax=0.25))
+        artists.append(skew.ax.axhline(y=dgz_top, color='yellow', linestyle='--', alpha=0.5, xmin=0, xmax=0.25))
+        # label the zone DGZ
+        artists.append(skew.ax.text(T.min().magnitude-5, dgz_bottom-30, 'DGZ', color='yellow', alpha=0.5))
+    # set xaxis values to between min and max values + 10
+    skew.ax.set_xlim(T.min().magnitude - 10, T.max().magnitude + 10)
+    # make the title white
+    skew.ax.set_title(f'Radiosonde Sounding for {time} UTC', color='white')
+    # add legend outside the plot on the right
+    artists.append(skew.ax.legend(loc='center left', bbox_to_anchor=(1.05, 0.5),
+                                  facecolor='black', labelcolor='white'))
+    return artists
+
+
+# background of the current render worker, drawn once per process
+_background = None
+
+
+def _init_render_worker():
+    global _background
+    import matplotlib
+    matplotlib.use('Agg')
+    _background = skewt_background()
+
+
+def _render_one(job):
+    sounding, dgz_bottom, dgz_top, time, out_file = job
+    fig, skew = _background
+    artists = draw_sounding(skew, sounding, dgz_bottom, dgz_top, time)
+    fig.savefig(out_file, facecolor=fig.get_facecolor(), bbox_inches='tight')
+    # clear the sounding and keep the background for the next one
+    for artist in artists:
+        artist.remove()
+    return out_file
+
+
+def render_soundings(files, out_dir, n_workers=None, min_pres=200):
+    """
+    This function renders a PNG skew-T for every sonde file in parallel
+    Inputs:
+        files: list of sonde file paths, or a directory / glob pattern
+        out_dir: string of the directory to write the PNGs to
+        n_workers: number of render processes, defaults to the number of cores
+        min_pres: lowest pressure (mb) to plot
+    Outputs:
+        summary: pandas dataframe from derive_sounding_fields with a png column
+    """
+    soundings, summary = derive_sounding_fields(load_soundings(files, min_pres=min_pres))
+    os.makedirs(out_dir, exist_ok=True)
+    summary['png'] = [os.path.join(out_dir, os.path.splitext(os.path.basename(f))[0] + '.png')
+                      for f in summary['file']]
+    jobs = []
+    for i, sounding in soundings.groupby('sounding'):
+        row = summary.loc[i]
+        time = row['launch_time'].strftime('%Y-%m-%d %H:%M')
+        jobs.append((sounding[['pres', 'tdry', 'tdew', 'u_wind', 'v_wind']],
+                     row['dgz_bottom'], row['dgz_top'], time, row['png']))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_render_worker) as pool:
+        list(pool.map(_render_one, jobs, chunksize=max(1, len(jobs) // (4 * (n_workers or os.cpu_count())))))
+    return summary
@@ -0,0 +1,332 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import xarray as xr
+
+SOURCE_CACHE_DIR = './data/source_cache/'
+# the cache evicts least recently used entries above this size (bytes)
+SOURCE_CACHE_MAX_BYTES = 20 * 2**30
+SOURCE_CACHE_INDEX = 'index.json'
+# registered sources: name -> loader, dims, units and cache key
+DATA_SOURCES = {}
+# hit, miss and eviction counts of every cache directory in this process
+_CACHE_STATS = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def register_source(name, loader, dims, units=None, cache_key=None):
+    """
+    This function registers a data source so it can be requested by name through get_source
+    Inputs:
+        name: string of the source name, e.g. 'snodgrass'
+        loader: function of the request parameters returning an xarray dataset or a pandas dataframe
+                with a datetime column or index
+        dims: tuple of the dimensions of the loaded data, e.g. ('time',) or ('site', 'time')
+        units: dictionary of variable units, used where the loaded data has no units attribute
+        cache_key: function of the request parameters returning the string the cache entry is keyed on,
+                   defaults to the json of the parameters; include what invalidates the entry, e.g. file mtimes
+    Outputs:
+        source: dictionary of the registered source
+    """
+    DATA_SOURCES[name] = {'name': name, 'loader': loader, 'dims': tuple(dims), 'units': dict(units or {}),
+                          'cache_key': cache_key or _params_key}
+    return DATA_SOURCES[name]
+
+
+def _params_key(**params):
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def _mtimes(paths):
+    # modification time of every path, part of the cache key of file backed sources
+    return {os.path.abspath(path): os.path.getmtime(path) for path in paths if os.path.exists(path)}
+
+
+def to_utc_time(data, time_dim='time'):
+    """
+    This function puts a loaded source on a naive UTC time coordinate named time_dim
+    Inputs:
+        data: pandas dataframe with a datetime column or index (timezone aware or UTC), or an xarray dataset
+        time_dim: name of the time dimension
+    Outputs:
+        ds: xarray dataset
+    """
+    if isinstance(data, pd.DataFrame):
+        if 'datetime' in data.columns:
+            data = data.set_index('datetime')
+        index = pd.DatetimeIndex(data.index)
+        # xarray holds no timezones, so aware times are stored as naive UTC
+        if index.tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        data = xr.Dataset.from_dataframe(data.set_axis(index.rename(time_dim), axis=0))
+    elif 'datetime' in data.dims and time_dim not in data.dims:
+        data = data.rename({'datetime': time_dim})
+    return data
+
+
+def cf_attributes(ds, source):
+    """
+    This function adds CF style attributes to a loaded source: variable units, the time coordinate's
+    standard name, and the source name
+    Inputs:
+        ds: xarray dataset from to_utc_time
+        source: dictionary of the registered source
+    Outputs:
+        ds: xarray dataset
+    """
+    for var in ds.data_vars:
+        if 'units' not in ds[var].attrs and var in source['units']:
+            ds[var].attrs['units'] = source['units'][var]
+    if 'time' in ds.coords:
+        ds['time'].attrs.update({'standard_name': 'time', 'long_name': 'time (UTC)'})
+    ds.attrs.update({'Conventions': 'CF-1.8', 'source': source['name']})
+    return ds
+
+
+def _read_index(cache_dir):
+    path = os.path.join(cache_dir, SOURCE_CACHE_INDEX)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_index(cache_dir, index):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, SOURCE_CACHE_INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+
+def _stats(cache_dir):
+    return _CACHE_STATS.setdefault(os.path.abspath(cache_dir), {'hits': 0, 'misses': 0, 'evictions': 0})
+
+
+def evict_cache(cache_dir=SOURCE_CACHE_DIR, max_bytes=SOURCE_CACHE_MAX_BYTES, keep=()):
+    """
+    This function removes least recently used cache entries until the cache is no larger than max_bytes
+    Inputs:
+        cache_dir: directory of the source cache
+        max_bytes: size limit of the cache in bytes
+        keep: entry keys never evicted, e.g. the entry just written
+    Outputs:
+        evicted: list of the evicted entry keys
+    """
+    with _CACHE_LOCK:
+        index = _read_index(cache_dir)
+        total = sum(entry['bytes'] for entry in index.values())
+        evicted = []
+        for key, entry in sorted(index.items(), key=lambda item: item[1]['last_access']):
+            if total <= max_bytes:
+                break
+            if key in keep:
+                continue
+            path = os.path.join(cache_dir, entry['file'])
+            if os.path.exists(path):
+                os.remove(path)
+            total -= entry['bytes']
+            evicted.append(key)
+        for key in evicted:
+            del index[key]
+        _write_index(cache_dir, index)
+        _stats(cache_dir)['evictions'] += len(evicted)
+    return evicted
+
+
+def cache_stats(cache_dir=SOURCE_CACHE_DIR):
+    """
+    This function reports the use of a source cache
+    Inputs:
+        cache_dir: directory of the source cache
+    Outputs:
+        stats: dictionary of hits, misses and evictions in this process, hit_rate, and the entries and bytes
+               on disk
+    """
+    index = _read_index(cache_dir)
+    stats = dict(_stats(cache_dir))
+    requests = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / requests if requests else float('nan')
+    stats['entries'] = len(index)
+    stats['bytes'] = sum(entry['bytes'] for entry in index.values())
+    return stats
+
+
+def clear_cache(cache_dir=SOURCE_CACHE_DIR):
+    # remove every entry and reset the statistics of a source cache
+    evict_cache(cache_dir, max_bytes=-1)
+    _CACHE_STATS.pop(os.path.abspath(cache_dir), None)
+
+
+def get_source(name, cache_dir=SOURCE_CACHE_DIR, max_bytes=SOURCE_CACHE_MAX_BYTES, use_cache=True, **params):
+    """
+    This function requests data from a registered source, e.g. tower MET at Kettle Ponds with
+    get_source('arm_files', files='data/met_*.nc', start='2022-08-18', end='2022-08-20'),
+    reusing the cached result of an earlier identical request
+    Inputs:
+        name: string of the registered source
+        cache_dir: directory of the source cache
+        max_bytes: size limit of the cache in bytes, see evict_cache
+        use_cache: read and write the cache, set to False to always call the loader
+        params: request parameters passed to the source's loader
+    Outputs:
+        ds: lazily opened xarray dataset on a naive UTC time coordinate with CF style attributes
+    """
+    if name not in DATA_SOURCES:
+        raise KeyError(f'unknown data source {name}, registered sources are {sorted(DATA_SOURCES)}')
+    source = DATA_SOURCES[name]
+    if not use_cache:
+        return _load(source, params)
+    key = hashlib.sha1(f'{name}\n{source["cache_key"](**params)}'.encode()).hexdigest()
+    path = os.path.join(cache_dir, f'{name}_{key}.nc')
+    with _CACHE_LOCK:
+        index = _read_index(cache_dir)
+        hit = key in index and os.path.exists(path)
+        _stats(cache_dir)['hits' if hit else 'misses'] += 1
+        if hit:
+            index[key]['last_access'] = time.time()
+            _write_index(cache_dir, index)
+    if not hit:
+        ds = _load(source, params)
+        os.makedirs(cache_dir, exist_ok=True)
+        # the encodings of the original files (fill values, packing) do not all carry over
+        ds.drop_encoding().to_netcdf(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        ds.close()
+        with _CACHE_LOCK:
+            index = _read_index(cache_dir)
+            index[key] = {'source': name, 'file': os.path.basename(path), 'bytes': os.path.getsize(path),
+                          'last_access': time.time()}
+            _write_index(cache_dir, index)
+        evict_cache(cache_dir, max_bytes=max_bytes, keep=(key,))
+    return xr.open_dataset(path, chunks={})
+
+
+def _load(source, params):
+    # call the loader and bring its output to the common conventions
+    ds = source['loader'](**params)
+    if ds is None:
+        raise ValueError(f'{source["name"]} loader returned no data for {params}')
+    ds = cf_attributes(to_utc_time(ds), source)
+    missing = [dim for dim in source['dims'] if dim not in ds.dims]
+    if missing:
+        raise ValueError(f'{source["name"]} loader returned dims {tuple(ds.dims)}, missing {missing}')
+    return ds
+
+
+def _naive_utc(time):
+    # request times as naive UTC datetimes, the times of ARM file names and coordinates
+    if time is None:
+        return None
+    time = pd.Timestamp(time)
+    if time.tzinfo is not None:
+        time = time.tz_convert('UTC').tz_localize(None)
+    return time.to_pydatetime()
+
+
+def _time_slice(ds, start, end, time_dim='time'):
+    if start is None and end is None:
+        return ds
+    return ds.sel({time_dim: slice(start, end)})
+
+
+def _load_sail(datastream, start, end, username=None, token=None, sail_cache_dir='sail_cache', variables=None,
+               local_only=False, time=None):
+    # ARM files are opened from the local file cache sail_cache_dir, times are UTC
+    from scripts.get_sail_data import get_sail_data
+    return get_sail_data(username, token, datastream, start, end, time=time, cache_dir=sail_cache_dir,
+                         local_only=local_only, variables=variables, exact_window=True)
+
+
+def _sail_key(datastream, start, end, username=None, token=None, sail_cache_dir='sail_cache', variables=None,
+              local_only=False, time=None):
+    # credentials do not change the data, and a download fetches every file of the window, so the request
+    # is the key; local_only reads whatever the file cache holds, so its complete files of the window are too
+    key = {'datastream': datastream, 'start': start, 'end': end, 'variables': variables, 'time': time}
+    if local_only:
+        from scripts.get_sail_data import cached_sail_files
+        key['files'] = _mtimes(cached_sail_files(sail_cache_dir, datastream, start, end, time=time))
+    return _params_key(**key)
+
+
+def _load_arm_files(files, variables=None, start=None, end=None):
+    # ARM netCDF files already on disk, e.g. the Kettle Ponds tower files in data/
+    from scripts.get_sail_data import open_sail_files
+    return open_sail_files(sorted(glob.glob(files) if isinstance(files, str) else files), variables=variables,
+                           start=_naive_utc(start), end=_naive_utc(end))
+
+
+def _arm_files_key(files, variables=None, start=None, end=None):
+    files = glob.glob(files) if isinstance(files, str) else files
+    return _params_key(files=_mtimes(files), variables=variables, start=start, end=end)
+
+
+def _load_snodgrass(filename, filemeta, columns=None, start=None, end=None):
+    from scripts.get_snodgrass_data import get_columns_and_units, get_snodgrass_data
+    _, units, _, site_loc, site_name = get_columns_and_units(filemeta)
+    ds = to_utc_time(get_snodgrass_data(filename, filemeta, columns=columns, start=start, end=end))
+    for var in ds.data_vars:
+        if units.get(var):
+            ds[var].attrs['units'] = units[var]
+    return ds.assign_attrs(site_name=site_name, **{f'site_{k}': v for k, v in site_loc.items()})
+
+
+def _snodgrass_key(filename, filemeta, columns=None, start=None, end=None):
+    return _params_key(files=_mtimes([filename, filemeta]), columns=columns, start=start, end=end)
+
+
+def _load_daymet(directory=None, sites=None, start=None, end=None):
+    # daymet days are kept as dates, on a midnight UTC time coordinate
+    from scripts.get_daymet_data import DAYMET_DIR, get_daymet_data
+    ds = get_daymet_data(directory or DAYMET_DIR)
+    if sites is not None:
+        ds = ds.sel(site=list(sites))
+    return _time_slice(ds, start, end)
+
+
+def _daymet_key(directory=None, sites=None, start=None, end=None):
+    from scripts.get_daymet_data import DAYMET_DIR, DAYMET_PATTERN
+    files = sorted(glob.glob(os.path.join(directory or DAYMET_DIR, DAYMET_PATTERN)))
+    return _params_key(files=_mtimes(files), sites=sites, start=start, end=end)
+
+
+def _load_raster(path, name=None, start=None, end=None):
+    # monthly cubes of ingest_raster_stack, the month coordinate becomes time
+    from scripts.rasters import RASTER_TIME_DIM, open_raster_cube
+    cube = open_raster_cube(path, name).rename({RASTER_TIME_DIM: 'time'})
+    return _time_slice(cube, start, end)
+
+
+def _raster_key(path, name=None, start=None, end=None):
+    # a zarr cube changes its inner files, not the store directory
+    files = glob.glob(os.path.join(path, '**'), recursive=True) if os.path.isdir(path) else [path]
+    return _params_key(files=_mtimes(files), name=name, start=start, end=end)
+
+
+def _load_snotel(stations, start, end, variables=None, store_dir=None, offline=True):
+    # daily station data from the local store, a long frame pivoted to (station, time)
+    from scripts.get_snotel_data import SNOTEL_STORE_DIR, SNOTEL_VARIABLES, get_snotel_data
+    data = get_snotel_data(stations, start, end, variables=variables or SNOTEL_VARIABLES,
+                           store_dir=store_dir or SNOTEL_STORE_DIR, offline=offline)
+    data = data.drop(columns='name').rename(columns={'datetime': 'time'}).set_index(['station', 'time'])
+    return xr.Dataset.from_dataframe(data)
+
+
+def _snotel_key(stations, start, end, variables=None, store_dir=None, offline=True):
+    from scripts.get_snotel_data import SNOTEL_STORE_DIR, snotel_store_path
+    paths = [snotel_store_path(station, store_dir or SNOTEL_STORE_DIR) for station in stations]
+    return _params_key(files=_mtimes(paths), stations=sorted(stations), start=start, end=end, variables=variables)
+
+
+register_source('sail', _load_sail, dims=('time',), cache_key=_sail_key)
+register_source('arm_files', _load_arm_files, dims=('time',), cache_key=_arm_files_key)
+register_source('snodgrass', _load_snodgrass, dims=('time',), cache_key=_snodgrass_key)
+register_source('daymet', _load_daymet, dims=('site', 'time'), cache_key=_daymet_key)
+register_source('raster', _load_raster, dims=('time', 'y', 'x'), cache_key=_raster_key)
+register_source('snotel', _load_snotel, dims=('station', 'time'),
+                units={'SWE': 'mm', 'PRECIPITATION': 'mm'}, cache_key=_snotel_key)
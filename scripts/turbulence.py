@@ -0,0 +1,165 @@
+import re
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from scripts.variables import COUNT_VARIABLES, PRESSURE_VARIABLES, TURBULENCE_VARIABLES
+
+# sensor variable names: quantity, then height and tower, e.g. u_w__3m_uw, tc_10m_c, counts_2m_c
+SENSOR_NAME = re.compile(r'^(?P<quantity>.+?)_{1,2}(?P<height>\d+)m_(?P<tower>[a-z]+)$')
+TOWERS = ['uw', 'ue', 'd', 'c']
+# sonic sampling rate (Hz), the expected sample count of an averaging period is rate * period
+SONIC_SAMPLE_RATE = 20
+# averaging periods with fewer samples than this fraction of the expected count are masked
+MIN_COUNT_FRACTION = 0.9
+VON_KARMAN = 0.4
+GRAVITY = 9.81
+# dry air gas constant (J/kg/K) and specific heat (J/kg/K)
+R_DRY = 287.05
+CP_AIR = 1005.0
+# latent heat of vaporization (J/kg), use 2.834e6 for sublimation over snow
+LATENT_HEAT = 2.501e6
+# station pressure (hPa) used when the dataset has no pressure sensor, about 2860 m at Kettle Ponds
+DEFAULT_PRESSURE = 720.0
+# sensor quantities turbulence_diagnostics needs on every sonic
+REQUIRED_QUANTITIES = ['tc', 'u_u', 'v_v', 'w_w', 'u_w', 'v_w', 'w_tc', 'w_h2o']
+# z/L class edges and names
+STABILITY_BINS = [-1, -0.1, 0.1, 1]
+STABILITY_CLASSES = ['very unstable', 'unstable', 'neutral', 'stable', 'very stable']
+
+
+def parse_sensor_name(name):
+    """
+    This function splits a sensor variable name into its quantity, tower and height
+    Inputs:
+        name: string of the variable name, e.g. 'u_w__3m_uw'
+    Outputs:
+        quantity, tower, height: e.g. ('u_w', 'uw', 3), or None if the name has no height and tower
+    """
+    match = SENSOR_NAME.match(name)
+    if match is None:
+        return None
+    return match['quantity'], match['tower'], int(match['height'])
+
+
+def sensor_index(names):
+    """
+    This function builds the (tower, height) grid of a list of sensor variable names
+    Inputs:
+        names: list of variable names, e.g. TURBULENCE_VARIABLES
+    Outputs:
+        index: pandas dataframe of name, quantity, tower and height of every parsable name
+        towers: list of the towers, in TOWERS order
+        heights: sorted list of the heights (m)
+    """
+    parsed = [(name,) + parse_sensor_name(name) for name in names if parse_sensor_name(name) is not None]
+    index = pd.DataFrame(parsed, columns=['name', 'quantity', 'tower', 'height'])
+    towers = [tower for tower in TOWERS if tower in set(index['tower'])]
+    towers += sorted(set(index['tower']) - set(towers))
+    return index, towers, sorted(set(index['height']))
+
+
+def stack_sensors(ds, names=TURBULENCE_VARIABLES + COUNT_VARIABLES, time_dim='time'):
+    """
+    This function stacks the per-sensor variables of a dataset into one (tower, height, time) array per quantity
+    Sensors missing from a tower are nan, and dask backed variables stay lazy
+    Inputs:
+        ds: xarray dataset with sensor variables, e.g. a SoS or ECOR tower dataset
+        names: list of the sensor variables to stack; names missing from ds are skipped
+        time_dim: name of the time dimension
+    Outputs:
+        stacked: xarray dataset of every quantity (e.g. u_w, w_tc, counts) on (tower, height, time)
+    """
+    index, towers, heights = sensor_index([name for name in names if name in ds])
+    if index.empty:
+        raise ValueError('the dataset has none of the sensor variables in names, e.g. tc_3m_c or u_w__3m_c')
+    template = xr.full_like(ds[index['name'].iloc[0]], np.nan, dtype=float)
+    stacked = {}
+    for quantity, sensors in index.groupby('quantity', sort=False):
+        lookup = dict(zip(zip(sensors['tower'], sensors['height']), sensors['name']))
+        columns = [xr.concat([ds[lookup[tower, height]].astype(float) if (tower, height) in lookup else template
+                              for height in heights], dim=pd.Index(heights, name='height'), coords='minimal',
+                             compat='override')
+                   for tower in towers]
+        stacked[quantity] = xr.concat(columns, dim=pd.Index(towers, name='tower'), coords='minimal',
+                                      compat='override').transpose('tower', 'height', time_dim)
+    stacked = xr.Dataset(stacked)
+    stacked['height'].attrs['units'] = 'm'
+    if stacked.chunks:
+        # the sensors of one time chunk in one block, for the array-wide pass
+        stacked = stacked.chunk({'tower': -1, 'height': -1})
+    return stacked
+
+
+def _station_pressure(ds, time_dim):
+    # mean of the pressure sensors (hPa) of every time, DEFAULT_PRESSURE without any
+    sensors = [name for name in PRESSURE_VARIABLES if name in ds]
+    if not sensors:
+        return DEFAULT_PRESSURE
+    return xr.concat([ds[name] for name in sensors], dim='sensor').mean('sensor')
+
+
+def expected_counts(time, sample_rate=SONIC_SAMPLE_RATE):
+    # samples of one averaging period, from the time step of the dataset
+    step = np.median(np.diff(time[:1000]).astype('timedelta64[ns]').astype(float)) / 1e9
+    return sample_rate * step
+
+
+def turbulence_diagnostics(ds, names=TURBULENCE_VARIABLES + COUNT_VARIABLES, pressure=None,
+                           min_count_fraction=MIN_COUNT_FRACTION, sample_rate=SONIC_SAMPLE_RATE,
+                           latent_heat=LATENT_HEAT, time_dim='time'):
+    """
+    This function computes friction velocity, sensible and latent heat flux, TKE, Obukhov length, z/L and the
+    stability class of every sonic of a tower dataset in one array-wide pass on (tower, height, time)
+    Dask backed datasets (e.g. months of files from open_sail_files) stay lazy and are computed chunk by chunk
+    Inputs:
+        ds: xarray dataset with the TURBULENCE_VARIABLES and COUNT_VARIABLES sensors: covariances in m^2/s^2,
+            m/s degC (w_tc) and g/m^3 m/s (w_h2o), tc in degC
+        names: list of the sensor variables used
+        pressure: station pressure (hPa), scalar or dataarray on time; None uses the PRESSURE_VARIABLES of ds,
+                  or DEFAULT_PRESSURE
+        min_count_fraction: averaging periods with fewer samples than this fraction of sample_rate * time step
+                            are masked; None keeps every period
+        sample_rate: sonic sampling rate (Hz)
+        latent_heat: latent heat (J/kg) of the water vapor flux
+        time_dim: name of the time dimension
+    Outputs:
+        diagnostics: xarray dataset on (tower, height, time) of ustar (m/s), H and LE (W/m^2), tke (m^2/s^2),
+                     L (m), zeta (z/L), stability (index of STABILITY_CLASSES, -1 where zeta is nan) and qc
+                     (True for periods with enough samples)
+    """
+    sensors = stack_sensors(ds, names=names, time_dim=time_dim)
+    missing = [quantity for quantity in REQUIRED_QUANTITIES if quantity not in sensors]
+    if missing:
+        raise ValueError(f'the dataset has no {", ".join(missing)} sensors')
+    if min_count_fraction is not None and 'counts' in sensors:
+        qc = sensors['counts'] >= min_count_fraction * expected_counts(ds[time_dim].values, sample_rate)
+        sensors = sensors.drop_vars('counts').where(qc)
+    else:
+        qc = xr.ones_like(sensors['tc'], dtype=bool)
+    if pressure is None:
+        pressure = _station_pressure(ds, time_dim)
+    temperature = sensors['tc'] + 273.15
+    # sonic temperature is close to virtual temperature, so the dry air gas constant is used with it
+    density = pressure * 100 / (R_DRY * temperature)
+    diagnostics = xr.Dataset(coords=sensors.coords)
+    diagnostics['ustar'] = (sensors['u_w'] ** 2 + sensors['v_w'] ** 2) ** 0.25
+    diagnostics['H'] = density * CP_AIR * sensors['w_tc']
+    diagnostics['LE'] = latent_heat * sensors['w_h2o'] / 1000
+    diagnostics['tke'] = 0.5 * (sensors['u_u'] + sensors['v_v'] + sensors['w_w'])
+    # w_tc is the buoyancy flux, L is nan rather than infinite for a zero flux
+    buoyancy = VON_KARMAN * GRAVITY * sensors['w_tc'].where(sensors['w_tc'] != 0)
+    diagnostics['L'] = -diagnostics['ustar'] ** 3 * temperature / buoyancy
+    diagnostics['zeta'] = diagnostics['height'] / diagnostics['L']
+    stability = xr.apply_ufunc(np.digitize, diagnostics['zeta'], kwargs={'bins': STABILITY_BINS},
+                               dask='parallelized', output_dtypes=[np.int8])
+    diagnostics['stability'] = stability.where(diagnostics['zeta'].notnull(), -1).astype(np.int8)
+    diagnostics['qc'] = qc
+    units = {'ustar': 'm/s', 'H': 'W/m^2', 'LE': 'W/m^2', 'tke': 'm^2/s^2', 'L': 'm', 'zeta': '1'}
+    for name, unit in units.items():
+        diagnostics[name].attrs['units'] = unit
+    diagnostics['stability'].attrs = {'flag_values': list(range(len(STABILITY_CLASSES))),
+                                      'flag_meanings': ' '.join(x.replace(' ', '_') for x in STABILITY_CLASSES)}
+    # a time varying pressure moves time first
+    return diagnostics.transpose('tower', 'height', time_dim)
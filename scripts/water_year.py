@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+# first month of the water year, October
+WATER_YEAR_START_MONTH = 10
+
+
+def _to_days(dates):
+    # dates as datetime64[D], local wall time for timezone-aware input
+    dates = pd.DatetimeIndex(np.asarray(dates).ravel() if not isinstance(dates, pd.Series) else dates)
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+    return dates.values.astype('datetime64[D]')
+
+
+def _with_nat(values, valid):
+    # values of the valid dates, nan for NaT dates (the notebook's row-wise lambdas gave nan for NaT)
+    if valid.all():
+        return values
+    filled = np.full(valid.shape, np.nan)
+    filled[valid] = values
+    return filled
+
+
+def _like(values, dates, name):
+    # return a series on the index of series input, an array otherwise
+    if isinstance(dates, pd.Series):
+        return pd.Series(values, index=dates.index, name=name)
+    return values.reshape(np.shape(dates))
+
+
+def _tabulated(func, values):
+    # evaluate func once per distinct value of a narrow integer range and look the results up,
+    # e.g. 40 years of days for hundreds of stations
+    values = np.asarray(values, dtype=np.int64)
+    if values.size == 0:
+        return func(values)
+    low, high = values.min(), values.max()
+    if high - low + 1 >= values.size:
+        return func(values)
+    table = func(np.arange(low, high + 1))
+    if isinstance(table, tuple):
+        return tuple(part[values - low] for part in table)
+    return table[values - low]
+
+
+def _civil_from_days(days):
+    # proleptic gregorian year and month of days since 1970-01-01 in integer arithmetic,
+    # much faster than casting to datetime64[Y] / [M] (H. Hinnant's civil_from_days)
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    months = np.where(mp < 10, mp + 3, mp - 9)
+    return yoe + era * 400 + (months <= 2), months
+
+
+def _year_month(days):
+    return _tabulated(_civil_from_days, days.astype(np.int64))
+
+
+def _days_from_civil(years, months, day=1):
+    # days since 1970-01-01 of proleptic gregorian dates, the inverse of _year_month
+    years = years - (months <= 2)
+    era = years // 400
+    yoe = years - era * 400
+    doy = (153 * np.where(months > 2, months - 3, months + 9) + 2) // 5 + day - 1
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+
+
+def water_year(dates, start_month=WATER_YEAR_START_MONTH):
+    """
+    This function computes the water year of dates, named by the calendar year it ends in
+    Inputs:
+        dates: array, list, datetimeindex or series of datetimes
+        start_month: first month of the water year
+    Outputs:
+        water_year: integer array, or series for series input; float with nan for NaT dates
+    """
+    days = _to_days(dates)
+    valid = ~np.isnat(days)
+    years, months = _year_month(days[valid])
+    if start_month != 1:
+        years = years + (months >= start_month)
+    return _like(_with_nat(years, valid), dates, 'water_year')
+
+
+def water_year_start(water_year, start_month=WATER_YEAR_START_MONTH):
+    """
+    This function computes the first day of water years
+    Inputs:
+        water_year: integer or array of water years
+        start_month: first month of the water year
+    Outputs:
+        start: datetime64[D] array of the first day of each water year
+    """
+    water_year = np.asarray(water_year, dtype=np.int64)
+    first_year = water_year - (start_month != 1)
+    return _tabulated(lambda years: _days_from_civil(years, np.int64(start_month)), first_year).astype('datetime64[D]')
+
+
+def day_of_water_year(dates, start_month=WATER_YEAR_START_MONTH):
+    """
+    This function computes the day of water year of dates, 1 on the first day of the water year
+    Inputs:
+        dates: array, list, datetimeindex or series of datetimes
+        start_month: first month of the water year
+    Outputs:
+        dowy: integer array, or series for series input; float with nan for NaT dates
+    """
+    days = _to_days(dates)
+    valid = ~np.isnat(days)
+    years, months = _year_month(days[valid])
+    if start_month != 1:
+        years = years + (months >= start_month)
+    dowy = (days[valid] - water_year_start(years, start_month)).astype(np.int64) + 1
+    return _like(_with_nat(dowy, valid), dates, 'dowy')
+
+
+def yday_to_date(year, yday):
+    """
+    This function converts a year and day of year (1 on January 1st), e.g. the Daymet year and yday columns, to dates
+    Inputs:
+        year: integer array or series of years
+        yday: integer array or series of days of year
+    Outputs:
+        date: datetime64[ns] array, or series for series input
+    """
+    days = _tabulated(lambda years: _days_from_civil(years, np.int64(1)), year) + np.asarray(yday, dtype=np.int64) - 1
+    dates = (days * 86400 * 10**9).astype('datetime64[ns]')
+    if isinstance(year, pd.Series):
+        return pd.Series(dates, index=year.index, name='Date')
+    return dates
+
+
+def add_water_year_columns(df, date_col='datetime', start_month=WATER_YEAR_START_MONTH):
+    """
+    This function adds the water_year and dowy columns used in snotel_max_accumulation.ipynb
+    Inputs:
+        df: pandas dataframe with a datetime column
+        date_col: name of the datetime column
+        start_month: first month of the water year
+    Outputs:
+        df: the same dataframe with water_year and dowy columns
+    """
+    df['water_year'] = water_year(df[date_col], start_month)
+    df['dowy'] = day_of_water_year(df[date_col], start_month)
+    return df
@@ -0,0 +1,341 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import geopandas as gpd
+import pyproj
+import shapely
+import scipy.sparse as sparse
+
+# width (m) of the elevation bands
+ELEVATION_BAND_WIDTH = 200
+# directory of the gage_{id}.json basin polygons
+BASIN_POLYGON_DIR = './data/basin_polygons/'
+
+
+def grid_fingerprint(x, y, crs=None):
+    """
+    This function makes a short key identifying a grid from its cell center coordinates
+    Inputs:
+        x: 1d array of the x (longitude) cell centers
+        y: 1d array of the y (latitude) cell centers
+        crs: crs of the grid (anything pyproj.CRS accepts), part of the key when given
+    Outputs:
+        fingerprint: string of 16 hex characters
+    """
+    digest = hashlib.sha1()
+    for coord in (x, y):
+        coord = np.asarray(coord, dtype=np.float64)
+        digest.update(np.int64(coord.size).tobytes())
+        digest.update(coord.tobytes())
+    if crs is not None:
+        digest.update(pyproj.CRS.from_user_input(crs).to_wkt().encode())
+    return digest.hexdigest()[:16]
+
+
+def elevation_hash(elevation):
+    # short key of a dem on the grid, an index built from another dem is rebuilt
+    elevation = np.asarray(elevation, dtype=np.float64)
+    digest = hashlib.sha1(np.asarray(elevation.shape, dtype=np.int64).tobytes())
+    digest.update(elevation.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def basin_geometry(geometry, crs=None):
+    # one shapely geometry of a basin, geodataframes and geoseries are reprojected to crs and dissolved
+    if isinstance(geometry, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        if crs is not None and geometry.crs is not None:
+            geometry = geometry.to_crs(crs)
+        geometry = geometry.geometry.union_all()
+    return geometry
+
+
+def geometry_hash(geometry):
+    # short key of a basin polygon, a re-delineated basin gets new weights
+    return hashlib.sha1(shapely.to_wkb(geometry)).hexdigest()[:16]
+
+
+def grid_cells(x, y):
+    """
+    This function builds the polygon of every cell of a regular grid, in (y, x) row-major order
+    Inputs:
+        x: 1d array of the x cell centers
+        y: 1d array of the y cell centers
+    Outputs:
+        cells: 1d array of shapely polygons
+        cell_area: area of one cell in the grid's units
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    dx = np.abs(np.diff(x).mean()) if x.size > 1 else 1.0
+    dy = np.abs(np.diff(y).mean()) if y.size > 1 else 1.0
+    xx, yy = np.meshgrid(x, y)
+    cells = shapely.box(xx.ravel() - dx / 2, yy.ravel() - dy / 2, xx.ravel() + dx / 2, yy.ravel() + dy / 2)
+    return cells, dx * dy
+
+
+def read_gage_basins(gage_ids, directory=BASIN_POLYGON_DIR):
+    """
+    This function reads the delineated basin polygons of gages
+    Inputs:
+        gage_ids: list of USGS gage id strings, e.g. ['09124700', '09072500', '09180500']
+        directory: directory of the gage_{id}.json files
+    Outputs:
+        basins: dictionary of gage id to geopandas geodataframe
+    """
+    return {gage_id: gpd.read_file(os.path.join(directory, f'gage_{gage_id}.json')) for gage_id in gage_ids}
+
+
+def basin_weights(x, y, basins, crs=None):
+    """
+    This function computes the fraction of every grid cell covered by each basin
+    Cells inside a basin get 1 without any geometry work; only cells on the boundary are intersected
+    Inputs:
+        x: 1d array of the x cell centers
+        y: 1d array of the y cell centers
+        basins: dictionary of basin label to a geodataframe, geoseries or shapely geometry
+        crs: crs of the grid, geodataframes and geoseries are reprojected to it
+    Outputs:
+        weights: scipy sparse csr matrix (basin, cell) of fractional coverage
+    """
+    cells, cell_area = grid_cells(x, y)
+    tree = shapely.STRtree(cells)
+    rows, cols, fracs = [], [], []
+    for row, geometry in enumerate(basins.values()):
+        geometry = basin_geometry(geometry, crs)
+        shapely.prepare(geometry)
+        touching = tree.query(geometry, predicate='intersects')
+        inside = np.isin(touching, tree.query(geometry, predicate='contains'))
+        frac = np.ones(touching.size)
+        edge = touching[~inside]
+        frac[~inside] = shapely.area(shapely.intersection(cells[edge], geometry)) / cell_area
+        keep = frac > 0
+        rows.append(np.full(keep.sum(), row))
+        cols.append(touching[keep])
+        fracs.append(frac[keep])
+    shape = (len(basins), cells.size)
+    if not rows:
+        return sparse.csr_matrix(shape)
+    return sparse.csr_matrix((np.concatenate(fracs), (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+
+
+def elevation_band_weights(elevation, bins):
+    """
+    This function assigns every grid cell to its elevation band
+    Inputs:
+        elevation: 2d array (y, x) of the dem on the grid, cells <= 0 or nan belong to no band
+        bins: 1d array of the band edges (m)
+    Outputs:
+        weights: scipy sparse csr matrix (band, cell) of 0/1 membership
+    """
+    elevation = np.asarray(elevation, dtype=float).ravel()
+    # right-closed bands, as groupby_bins
+    band = np.searchsorted(bins, elevation, side='left') - 1
+    valid = np.isfinite(elevation) & (elevation > 0) & (band >= 0) & (band < len(bins) - 1)
+    cells = np.flatnonzero(valid)
+    return sparse.csr_matrix((np.ones(cells.size), (band[valid], cells)), shape=(len(bins) - 1, elevation.size))
+
+
+def build_zonal_index(x, y, basins=None, elevation=None, bins=None, band_width=ELEVATION_BAND_WIDTH, crs=None):
+    """
+    This function builds the zonal index of a grid: basin coverage and elevation band membership of every cell
+    Inputs:
+        x: 1d array of the x cell centers
+        y: 1d array of the y cell centers
+        basins: dictionary of basin label to geometry, see basin_weights
+        elevation: 2d array (y, x) of the dem on the grid
+        bins: band edges (m), default of band_width steps covering the dem
+        band_width: width (m) of the default bands
+        crs: crs of the grid
+    Outputs:
+        index: dictionary of the grid coordinates, fingerprint, cell area, basin labels, geometry hashes and
+               weights, dem hash, band edges and weights
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    _, cell_area = grid_cells(x, y)
+    index = {
+        'x': x,
+        'y': y,
+        'fingerprint': grid_fingerprint(x, y),
+        'cell_area': cell_area,
+        'basins': [],
+        'basin_hashes': [],
+        'basin_weights': sparse.csr_matrix((0, x.size * y.size)),
+        'dem_hash': '',
+        'bins': np.array([]),
+        'band_weights': sparse.csr_matrix((0, x.size * y.size)),
+    }
+    if basins:
+        add_basins(index, basins, crs=crs)
+    if elevation is not None:
+        elevation = np.asarray(elevation, dtype=float)
+        if bins is None:
+            valid = elevation[np.isfinite(elevation) & (elevation > 0)]
+            bins = np.arange(np.floor(valid.min() / band_width) * band_width, valid.max() + band_width, band_width)
+        index['bins'] = np.asarray(bins, dtype=float)
+        index['band_weights'] = elevation_band_weights(elevation, index['bins'])
+        index['dem_hash'] = elevation_hash(elevation)
+    return index
+
+
+def add_basins(index, basins, crs=None):
+    """
+    This function adds basins to a zonal index, computing only the basins it does not have yet and the basins
+    whose geometry changed under the same label
+    Inputs:
+        index: dictionary from build_zonal_index
+        basins: dictionary of basin label to geometry
+        crs: crs of the grid
+    Outputs:
+        index: the updated index
+    """
+    geometries = {label: basin_geometry(geometry, crs) for label, geometry in basins.items()}
+    hashes = {label: geometry_hash(geometry) for label, geometry in geometries.items()}
+    known = dict(zip(index['basins'], index['basin_hashes']))
+    new = {label: geometry for label, geometry in geometries.items() if known.get(label) != hashes[label]}
+    if new:
+        # drop the rows of re-delineated basins, they are computed again below
+        keep = [row for row, label in enumerate(index['basins']) if label not in new]
+        weights = basin_weights(index['x'], index['y'], new)
+        index['basin_weights'] = sparse.vstack([index['basin_weights'][keep], weights], format='csr')
+        index['basins'] = [index['basins'][row] for row in keep] + list(new)
+        index['basin_hashes'] = [index['basin_hashes'][row] for row in keep] + [hashes[label] for label in new]
+    return index
+
+
+def save_zonal_index(index, path):
+    """
+    This function writes a zonal index to a .npz file
+    Inputs:
+        index: dictionary from build_zonal_index
+        path: string of the .npz path
+    """
+    arrays = {'x': index['x'], 'y': index['y'], 'cell_area': index['cell_area'],
+              'basins': np.asarray(index['basins'], dtype=str),
+              'basin_hashes': np.asarray(index['basin_hashes'], dtype=str),
+              'dem_hash': np.asarray(index['dem_hash']), 'bins': index['bins']}
+    for name in ('basin_weights', 'band_weights'):
+        weights = index[name]
+        arrays[f'{name}_data'] = weights.data
+        arrays[f'{name}_indices'] = weights.indices
+        arrays[f'{name}_indptr'] = weights.indptr
+        arrays[f'{name}_shape'] = np.asarray(weights.shape)
+    tmp = path + '.tmp.npz'
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def load_zonal_index(path):
+    """
+    This function reads a zonal index written by save_zonal_index
+    Inputs:
+        path: string of the .npz path
+    Outputs:
+        index: dictionary as from build_zonal_index
+    """
+    with np.load(path) as arrays:
+        index = {'x': arrays['x'], 'y': arrays['y'], 'cell_area': float(arrays['cell_area']),
+                 'basins': arrays['basins'].tolist(), 'bins': arrays['bins']}
+        # indexes written before the hashes were kept match no geometry or dem, so they are recomputed
+        index['basin_hashes'] = (arrays['basin_hashes'].tolist() if 'basin_hashes' in arrays
+                                 else [''] * len(index['basins']))
+        index['dem_hash'] = str(arrays['dem_hash']) if 'dem_hash' in arrays else ''
+        for name in ('basin_weights', 'band_weights'):
+            index[name] = sparse.csr_matrix((arrays[f'{name}_data'], arrays[f'{name}_indices'],
+                                             arrays[f'{name}_indptr']), shape=tuple(arrays[f'{name}_shape']))
+    index['fingerprint'] = grid_fingerprint(index['x'], index['y'])
+    return index
+
+
+def get_zonal_index(path, x, y, basins=None, elevation=None, bins=None, crs=None):
+    """
+    This function loads the zonal index of a grid from disk, building or extending it only when needed
+    The index is rebuilt when the dem changed, and a basin is recomputed when its polygon changed
+    Inputs:
+        path: string of the .npz index of this grid
+        x, y, basins, elevation, bins, crs: see build_zonal_index
+    Outputs:
+        index: dictionary from build_zonal_index
+    """
+    index = None
+    if os.path.exists(path):
+        index = load_zonal_index(path)
+        stale = index['fingerprint'] != grid_fingerprint(x, y)
+        if bins is not None and not np.array_equal(index['bins'], bins):
+            stale = True
+        if elevation is not None and index['dem_hash'] != elevation_hash(elevation):
+            stale = True
+        if stale:
+            index = None
+    if index is None:
+        index = build_zonal_index(x, y, basins=basins, elevation=elevation, bins=bins, crs=crs)
+        save_zonal_index(index, path)
+    elif basins:
+        before = list(zip(index['basins'], index['basin_hashes']))
+        add_basins(index, basins, crs=crs)
+        if list(zip(index['basins'], index['basin_hashes'])) != before:
+            save_zonal_index(index, path)
+    return index
+
+
+def _zone_weights(index, zones):
+    # (zone, cell) weights and the coordinate of the zones
+    if zones == 'basin':
+        return index['basin_weights'], pd.Index(index['basins'], name='basin')
+    if zones == 'band':
+        return index['band_weights'], pd.IntervalIndex.from_breaks(index['bins'], name='elevation_bins')
+    raise ValueError("zones must be 'basin' or 'band'")
+
+
+def zonal_means(index, cube, zones='basin', x_dim='x', y_dim='y'):
+    """
+    This function computes the coverage-weighted mean of every zone for every time step with one sparse product
+    Nan cells are left out of the mean of their zone
+    Inputs:
+        index: dictionary from build_zonal_index on the grid of cube
+        cube: xarray dataarray (..., y, x), e.g. imerg.ppt
+        zones: 'basin' or 'band'
+        x_dim, y_dim: names of the grid dimensions
+    Outputs:
+        means: xarray dataarray (..., basin) or (..., elevation_bins)
+    """
+    if grid_fingerprint(cube[x_dim].values, cube[y_dim].values) != index['fingerprint']:
+        raise ValueError('the cube is not on the grid of the zonal index')
+    weights, zone_coord = _zone_weights(index, zones)
+    cube = cube.transpose(..., y_dim, x_dim)
+    other_dims = cube.dims[:-2]
+    values = cube.values.reshape(-1, weights.shape[1])
+    valid = np.isfinite(values)
+    # (zone, cell) @ (cell, time)
+    totals = weights @ np.where(valid, values, 0).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (totals / (weights @ valid.T.astype(float))).T
+    means = means.reshape(cube.shape[:-2] + (weights.shape[0],))
+    coords = {dim: cube[dim] for dim in other_dims}
+    coords[zone_coord.name] = zone_coord
+    return xr.DataArray(means, dims=other_dims + (zone_coord.name,), coords=coords, name=cube.name)
+
+
+def zonal_fractional_area(index):
+    """
+    This function computes the hypsometry of the grid and of every basin
+    Inputs:
+        index: dictionary from build_zonal_index with elevation bands
+    Outputs:
+        fractional_area: xarray dataarray (zone, elevation_bins), the first zone 'grid' is the whole grid,
+                         each row sums to 1 over the cells with an elevation
+    """
+    bands = index['band_weights']
+    area = np.asarray(bands.sum(axis=1)).ravel()
+    # (basin, cell) @ (cell, band)
+    basin_area = (index['basin_weights'] @ bands.T).toarray()
+    areas = np.vstack([area, basin_area]) * index['cell_area']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fractions = areas / areas.sum(axis=1, keepdims=True)
+    _, bins = _zone_weights(index, 'band')
+    return xr.DataArray(fractions, dims=('zone', 'elevation_bins'),
+                        coords={'zone': ['grid'] + list(index['basins']), 'elevation_bins': bins},
+                        name='fractional_area')
@@ -0,0 +1,69 @@
+"""
+Tests batch delineation from cached flow grids on a synthetic D8 grid where
+every catchment is known: cells drain south, the bottom row drains east to
+the outlet in the bottom right corner.
+"""
+import numpy as np
+import geopandas as gpd
+
+from scripts.delineate import (DIRMAP, D8_OFFSETS, delineate_basins, dem_checksum, get_flow_grids,
+                               load_flow_grids, save_flow_grids)
+
+N_ROWS, N_COLS = 40, 30
+CELL = 150.0
+# UTM 13N grid, the crs the basin areas are computed in
+META = {'affine': [CELL, 0.0, 300000.0, 0.0, -CELL, 4300000.0], 'crs': 'EPSG:32613', 'dirmap': list(DIRMAP)}
+
+
+def synthetic_grids():
+    south, east = DIRMAP[D8_OFFSETS.index((1, 0))], DIRMAP[D8_OFFSETS.index((0, 1))]
+    fdir = np.full((N_ROWS, N_COLS), south, dtype=np.int16)
+    fdir[-1] = east
+    fdir[-1, -1] = 0
+    # cells draining through every cell, itself included
+    rows, cols = np.indices(fdir.shape)
+    acc = np.where(rows < N_ROWS - 1, rows + 1, N_ROWS * (cols + 1)).astype(float)
+    return fdir, acc
+
+
+def cell_center(row, col):
+    a, _, c, _, e, f = META['affine']
+    return c + (col + 0.5) * a, f + (row + 0.5) * e
+
+
+def pour_points(cells):
+    x, y = zip(*(cell_center(row, col) for row, col in cells.values()))
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), index=list(cells), crs=META['crs'])
+
+
+def test_delineate_basins(tmp_path):
+    flow_grids = load_flow_grids(save_flow_grids(*synthetic_grids(), META, str(tmp_path / 'grids')))
+    assert isinstance(flow_grids['fdir'], np.memmap)
+    # the outlet, a nested gage on the bottom row and a headwater gage in one column
+    cells = {'outlet': (N_ROWS - 1, N_COLS - 1), 'nested': (N_ROWS - 1, 9), 'headwater': (19, 4)}
+    basins = delineate_basins(flow_grids, pour_points(cells), threshold=0)
+    expected = {'outlet': N_ROWS * N_COLS, 'nested': N_ROWS * 10, 'headwater': 20}
+    assert basins['n_cells'].to_dict() == expected
+    np.testing.assert_allclose(basins['area_km2'], [expected[gage] * CELL ** 2 / 1e6 for gage in basins.index])
+    # the headwater catchment is the top 20 cells of column 4
+    xmin, ymin, xmax, ymax = basins.loc['headwater'].geometry.bounds
+    assert (xmin, xmax) == (300000 + 4 * CELL, 300000 + 5 * CELL)
+    assert (ymin, ymax) == (4300000 - 20 * CELL, 4300000)
+
+
+def test_pour_points_snap_to_streams(tmp_path):
+    flow_grids = load_flow_grids(save_flow_grids(*synthetic_grids(), META, str(tmp_path / 'grids')))
+    # two cells above the bottom row, which is the only stream above a threshold of 40 cells
+    basins = delineate_basins(flow_grids, pour_points({'gage': (N_ROWS - 3, 9)}), threshold=N_ROWS)
+    np.testing.assert_allclose(basins[['x_snap', 'y_snap']].iloc[0], cell_center(N_ROWS - 1, 9))
+    assert basins.loc['gage', 'n_cells'] == N_ROWS * 10
+
+
+def test_cached_grids_skip_conditioning(tmp_path):
+    dem_path = tmp_path / 'dem.tif'
+    dem_path.write_bytes(b'a dem')
+    cache_dir = str(tmp_path / 'flow_grids')
+    save_flow_grids(*synthetic_grids(), META, str(tmp_path / 'flow_grids' / dem_checksum(str(dem_path))))
+    # pysheds is never imported for a DEM with cached grids
+    flow_grids = get_flow_grids(str(dem_path), cache_dir=cache_dir)
+    np.testing.assert_array_equal(flow_grids['acc'], synthetic_grids()[1])
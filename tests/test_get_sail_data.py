@@ -0,0 +1,217 @@
+"""
+Tests the query date parsing of get_sail_data, and its cached bulk download
+against a local stand-in for the ARM Live query and saveData endpoints.
+"""
+import http.server
+import json
+import os
+import threading
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from scripts.get_sail_data import (DATE_FORMATS, date_parser, download_sail_files, get_sail_data, open_sail_files,
+                                   parse_dates)
+
+DATASTREAM = 'gucmetM1.b1'
+DAYS = ['20220817', '20220818', '20220819']
+# random times of day over a few years, day and month both above and below 12
+DATETIMES = (pd.date_range('2021-09-01', periods=1000, freq='D')
+             + pd.to_timedelta(np.random.default_rng(0).integers(0, 86400, 1000), unit='s'))
+
+
+def expected_datetimes(fmt):
+    # formats without a time parse to midnight
+    return pd.DatetimeIndex([x if 'H' in fmt else x.normalize() for x in DATETIMES]).to_numpy()
+
+
+@pytest.mark.parametrize('fmt', DATE_FORMATS)
+def test_date_parser_round_trip(fmt):
+    strings = [x.strftime(fmt) for x in DATETIMES]
+    parsed = np.array([date_parser(x, return_datetime=True) for x in strings], dtype='datetime64[ns]')
+    np.testing.assert_array_equal(parsed, expected_datetimes(fmt))
+    np.testing.assert_array_equal(parse_dates(strings), expected_datetimes(fmt))
+    assert [date_parser(x, output_format=fmt) for x in strings] == strings
+
+
+def test_compact_datetime_format():
+    # the format list once spelled this '%Y%m%dT%%H:%M:%S', so no compact date with a time parsed
+    assert '%Y%m%dT%H:%M:%S' in DATE_FORMATS
+    assert date_parser('20220818T11:23:00', return_datetime=True) == pd.Timestamp('2022-08-18 11:23').to_pydatetime()
+    assert date_parser('20220818T11:23:00', output_format='%Y-%m-%dT%H:%M:%S') == '2022-08-18T11:23:00'
+
+
+def test_parse_dates_mixed_layouts():
+    fmts = [DATE_FORMATS[i % len(DATE_FORMATS)] for i in range(len(DATETIMES))]
+    strings = np.array([x.strftime(fmt) for x, fmt in zip(DATETIMES, fmts)]).reshape(40, 25)
+    expected = np.array([date_parser(x, return_datetime=True) for x in strings.ravel()],
+                        dtype='datetime64[ns]').reshape(strings.shape)
+    np.testing.assert_array_equal(parse_dates(strings), expected)
+    np.testing.assert_array_equal(parse_dates(list(strings[0])), expected[0])
+
+
+def test_invalid_dates():
+    with pytest.raises(ValueError, match='Invalid Date format'):
+        date_parser('18 Aug 2022')
+    # a string of a layout already cached that does not parse as a date
+    date_parser('2022-08-18')
+    with pytest.raises(ValueError):
+        date_parser('2022-13-18')
+    with pytest.raises(ValueError):
+        parse_dates(['2022-08-18', '2022-13-18'])
+
+
+def write_day_file(directory, day):
+    """Writes one hourly ARM-like file starting at 00:00 of day."""
+    times = pd.date_range(pd.Timestamp(day), periods=24, freq='h')
+    ds = xr.Dataset({'temp_mean': ('time', np.arange(24, dtype='float32'))}, coords={'time': times})
+    fname = os.path.join(directory, f'{DATASTREAM}.{day}.000000.nc')
+    ds.to_netcdf(fname)
+    return fname
+
+
+class ArmLiveHandler(http.server.BaseHTTPRequestHandler):
+    """Serves query and saveData from the files of the server's directory, with Range support."""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        self.server.requests.append((url.path.rsplit('/', 1)[-1], params, self.headers.get('Range')))
+        if url.path.endswith('/query'):
+            body = json.dumps({'status': 'success', 'files': sorted(os.listdir(self.server.directory))}).encode()
+            self.send_response(200)
+        elif url.path.endswith('/saveData'):
+            with open(os.path.join(self.server.directory, params['file'][0]), 'rb') as f:
+                body = f.read()
+            byte_range = self.headers.get('Range')
+            if byte_range is not None:
+                offset = int(byte_range.split('=')[1].rstrip('-'))
+                if offset >= len(body):
+                    self.send_response(416)
+                    self.end_headers()
+                    return
+                body = body[offset:]
+                self.send_response(206)
+            else:
+                self.send_response(200)
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def arm_live(tmp_path):
+    served = tmp_path / 'served'
+    served.mkdir()
+    for day in DAYS:
+        write_day_file(served, day)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ArmLiveHandler)
+    server.directory = str(served)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+
+def saved_files(server):
+    return [params['file'][0] for endpoint, params, _ in server.requests if endpoint == 'saveData']
+
+
+def test_download_fills_cache(arm_live, tmp_path):
+    server, base_url = arm_live
+    cache_dir = str(tmp_path / 'cache')
+    files = download_sail_files('user', 'token', DATASTREAM, '2022-08-17', '2022-08-19', cache_dir=cache_dir,
+                                base_url=base_url)
+    assert [os.path.basename(f) for f in files] == sorted(os.listdir(server.directory))
+    for fname in files:
+        with open(fname, 'rb') as f, open(os.path.join(server.directory, os.path.basename(fname)), 'rb') as g:
+            assert f.read() == g.read()
+    assert not [f for f in os.listdir(os.path.join(cache_dir, DATASTREAM)) if f.endswith('.part')]
+
+
+def test_cached_files_are_skipped(arm_live, tmp_path):
+    server, base_url = arm_live
+    cache_dir = str(tmp_path / 'cache')
+    download_sail_files('user', 'token', DATASTREAM, '2022-08-17', '2022-08-19', cache_dir=cache_dir,
+                        base_url=base_url)
+    server.requests.clear()
+    download_sail_files('user', 'token', DATASTREAM, '2022-08-17', '2022-08-19', cache_dir=cache_dir,
+                        base_url=base_url)
+    assert saved_files(server) == []
+
+
+def test_partial_download_is_resumed(arm_live, tmp_path):
+    server, base_url = arm_live
+    fname = f'{DATASTREAM}.{DAYS[1]}.000000.nc'
+    with open(os.path.join(server.directory, fname), 'rb') as f:
+        content = f.read()
+    stream_dir = tmp_path / 'cache' / DATASTREAM
+    stream_dir.mkdir(parents=True)
+    (stream_dir / (fname + '.part')).write_bytes(content[:len(content) // 2])
+    download_sail_files('user', 'token', DATASTREAM, '2022-08-17', '2022-08-19', cache_dir=str(tmp_path / 'cache'),
+                        base_url=base_url)
+    ranges = {params['file'][0]: byte_range for endpoint, params, byte_range in server.requests
+              if endpoint == 'saveData'}
+    assert ranges[fname] == f'bytes={len(content) // 2}-'
+    assert (stream_dir / fname).read_bytes() == content
+    assert not (stream_dir / (fname + '.part')).exists()
+
+
+def test_local_only_matches_online(arm_live, tmp_path):
+    server, base_url = arm_live
+    cache_dir = str(tmp_path / 'cache')
+    start, end = '2022-08-18T06:00:00', '2022-08-19T03:00:00'
+    online = get_sail_data('user', 'token', DATASTREAM, start, end, cache_dir=cache_dir, base_url=base_url,
+                           exact_window=True)
+    server.requests.clear()
+    # a partial download in the cache is never listed
+    open(os.path.join(cache_dir, DATASTREAM, f'{DATASTREAM}.20220820.000000.nc.part'), 'wb').close()
+    local = get_sail_data(None, None, DATASTREAM, start, end, cache_dir=cache_dir, local_only=True,
+                          exact_window=True)
+    assert server.requests == []
+    # the file starting at 00:00 on the 18th holds the start of the window
+    assert local['time'].values[0] == np.datetime64('2022-08-18T06:00')
+    assert local['time'].values[-1] == np.datetime64('2022-08-19T03:00')
+    xr.testing.assert_identical(local.load(), online.load())
+
+
+def test_local_only_requires_cache_dir(arm_live):
+    server, base_url = arm_live
+    with pytest.raises(ValueError, match='requires cache_dir'):
+        get_sail_data(None, None, DATASTREAM, '2022-08-17', '2022-08-19', local_only=True, base_url=base_url)
+    assert server.requests == []
+
+
+def test_local_only_lists_overlapping_files(arm_live, tmp_path):
+    _, base_url = arm_live
+    cache_dir = str(tmp_path / 'cache')
+    download_sail_files('user', 'token', DATASTREAM, '2022-08-17', '2022-08-19', cache_dir=cache_dir,
+                        base_url=base_url)
+    files = download_sail_files(None, None, DATASTREAM, '2022-08-18T06:00:00', '2022-08-18T12:00:00',
+                                cache_dir=cache_dir, local_only=True)
+    assert [os.path.basename(f) for f in files] == [f'{DATASTREAM}.20220818.000000.nc']
+
+
+def test_empty_window(tmp_path):
+    files = [write_day_file(tmp_path, day) for day in DAYS]
+    with pytest.raises(ValueError, match='no files hold data'):
+        open_sail_files(files, start=pd.Timestamp('2022-08-01').to_pydatetime(),
+                        end=pd.Timestamp('2022-08-02').to_pydatetime())
+    stream_dir = tmp_path / 'cache' / DATASTREAM
+    stream_dir.mkdir(parents=True)
+    for day in DAYS:
+        write_day_file(stream_dir, day)
+    assert get_sail_data(None, None, DATASTREAM, '2022-08-01', '2022-08-02', cache_dir=str(tmp_path / 'cache'),
+                         local_only=True, exact_window=True) is None
@@ -0,0 +1,112 @@
+"""
+Tests the Parquet store and csv paths of get_snodgrass_data on a small
+synthetic Snodgrass AWS csv and meta file.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import scripts.get_snodgrass_data as snodgrass
+from scripts.get_snodgrass_data import (get_snodgrass_data, ingest_snodgrass_data, read_snodgrass_store_meta,
+                                        snodgrass_store_path, stream_snodgrass_data)
+
+COLUMNS = ['year', 'month', 'day', 'hour (MST)', 'minute', 'Tair (deg C)', 'RH (%)', 'SWE (mm)']
+
+
+def write_meta(filemeta, lat=38.92, columns=COLUMNS):
+    with open(filemeta, 'w') as f:
+        f.write(f'SND_opn\nlat = {lat}\nlon = -106.98\nelevation = 3350\n')
+        f.writelines(f'column {i} = {column}\n' for i, column in enumerate(columns))
+
+
+@pytest.fixture
+def station(tmp_path):
+    """An hourly record over two years, with a few missing values."""
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2010-10-01', '2012-03-01', freq='h')
+    data = pd.DataFrame({'year': times.year, 'month': times.month, 'day': times.day, 'hour': times.hour,
+                         'minute': times.minute})
+    for column in COLUMNS[5:]:
+        values = np.round(rng.uniform(-20, 100, times.size), 2)
+        values[rng.integers(0, times.size, 50)] = np.nan
+        data[column] = values
+    filename, filemeta = str(tmp_path / 'SND_opn_AWS_data_001hr.csv'), str(tmp_path / 'SND_opn_AWS_data_meta.txt')
+    data.to_csv(filename, header=False, index=False)
+    write_meta(filemeta)
+    return filename, filemeta
+
+
+def test_store_matches_csv(station):
+    filename, filemeta = station
+    pd.testing.assert_frame_equal(get_snodgrass_data(filename, filemeta),
+                                  get_snodgrass_data(filename, filemeta, use_store=False), check_like=True)
+
+
+def test_interrupted_ingest_leaves_no_store(station, monkeypatch):
+    filename, filemeta = station
+    stream = snodgrass.stream_snodgrass_data
+
+    def interrupted(*args, **kwargs):
+        chunks = stream(*args, **kwargs)
+        yield next(chunks)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(snodgrass, 'stream_snodgrass_data', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        ingest_snodgrass_data(filename, filemeta, chunksize=1000)
+    monkeypatch.undo()
+    assert not os.path.exists(snodgrass_store_path(filename))
+    # the next call ingests the whole record
+    pd.testing.assert_frame_equal(get_snodgrass_data(filename, filemeta),
+                                  get_snodgrass_data(filename, filemeta, use_store=False), check_like=True)
+
+
+def test_store_rebuilt_when_meta_changes(station):
+    filename, filemeta = station
+    get_snodgrass_data(filename, filemeta)
+    store_mtime = os.path.getmtime(snodgrass_store_path(filename))
+    write_meta(filemeta, lat=38.93)
+    os.utime(filemeta, (store_mtime + 10, store_mtime + 10))
+    get_snodgrass_data(filename, filemeta)
+    assert read_snodgrass_store_meta(snodgrass_store_path(filename))['site_loc']['lat'] == '38.93'
+
+
+@pytest.mark.parametrize('use_store', [True, False])
+def test_aware_time_range(station, use_store):
+    filename, filemeta = station
+    start = pd.Timestamp('2011-01-01', tz='America/Denver')
+    end = pd.Timestamp('2011-02-01', tz='America/Denver')
+    site_data = get_snodgrass_data(filename, filemeta, use_store=use_store, start=start, end=end)
+    naive = get_snodgrass_data(filename, filemeta, use_store=use_store, start='2011-01-01T07:00',
+                               end='2011-02-01T07:00')
+    assert site_data['datetime'].iloc[0] == start
+    assert site_data['datetime'].iloc[-1] == end
+    pd.testing.assert_frame_equal(site_data.reset_index(drop=True), naive.reset_index(drop=True))
+
+
+@pytest.mark.parametrize('chunksize', [1000, 4096, 10**6])
+def test_stream_matches_eager(station, chunksize):
+    filename, filemeta = station
+    streamed = pd.concat(stream_snodgrass_data(filename, filemeta, chunksize=chunksize), ignore_index=True)
+    pd.testing.assert_frame_equal(streamed, get_snodgrass_data(filename, filemeta, use_store=False), check_exact=True)
+
+
+def test_text_values_become_nan(station):
+    filename, filemeta = station
+    data = pd.read_csv(filename, header=None)
+    # a logger code column that is only text late in the record, and a column of integers
+    flags = np.full(len(data), '7', dtype=object)
+    flags[-3000::500] = 'M'
+    data[len(COLUMNS)] = flags
+    data[len(COLUMNS) + 1] = np.arange(len(data))
+    data.to_csv(filename, header=False, index=False)
+    write_meta(filemeta, columns=COLUMNS + ['logger code', 'record'])
+    eager = get_snodgrass_data(filename, filemeta, use_store=False)
+    assert (eager.dtypes.drop('datetime') == 'float64').all()
+    assert eager['logger code'].isna().sum() == 6
+    assert (eager['logger code'].dropna() == 7).all()
+    for chunk in stream_snodgrass_data(filename, filemeta, chunksize=4096):
+        assert (chunk.dtypes.drop('datetime') == 'float64').all()
+    pd.testing.assert_frame_equal(get_snodgrass_data(filename, filemeta), eager, check_like=True)
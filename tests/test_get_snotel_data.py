@@ -0,0 +1,119 @@
+"""
+Tests the incremental SNOTEL store with the offline stand-in fetcher.
+"""
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts.get_snotel_data import (METLOOM_VARIABLES, SNOTEL_UNITS, get_snotel_data, local_fetcher,
+                                     metloom_fetcher, read_snotel_store, snotel_store_path)
+
+STATION = '515:WA:SNTL'
+
+
+def write_station(directory, end):
+    days = pd.date_range('2010-10-01', end, freq='D')
+    pd.DataFrame({'datetime': days, 'SWE': np.linspace(0, 30, days.size), 'SWE_units': 'in',
+                  'PRECIPITATION': np.linspace(0, 40, days.size), 'PRECIPITATION_units': 'in',
+                  'SNOWDEPTH': np.linspace(0, 90, days.size), 'SNOWDEPTH_units': 'in'}).to_csv(
+        directory / '515_WA_SNTL.csv', index=False)
+
+
+def fetched(store_dir):
+    return read_snotel_store(snotel_store_path(STATION, store_dir))[1]['fetched']
+
+
+def recording(fetcher, calls):
+    def fetch(station_id, name, start, end, variables):
+        calls.append((start, end))
+        return fetcher(station_id, name, start, end, variables)
+    return fetch
+
+
+def test_store_matches_service(tmp_path):
+    write_station(tmp_path, '2011-09-30')
+    store_dir = str(tmp_path / 'store')
+    fetcher = local_fetcher(str(tmp_path))
+    get_snotel_data([STATION], '2010-10-01', '2011-03-31', store_dir=store_dir, fetcher=fetcher)
+    data = get_snotel_data([STATION], '2010-12-01', '2011-09-30', store_dir=store_dir, fetcher=fetcher)
+    expected = pd.read_csv(tmp_path / '515_WA_SNTL.csv', parse_dates=['datetime'])
+    expected = expected[expected['datetime'] >= '2010-12-01'].reset_index(drop=True)
+    np.testing.assert_allclose(data['SWE'], expected['SWE'] * 25.4)
+    assert fetched(store_dir) == {var: [['2010-10-01', '2011-09-30']] for var in ['SWE', 'PRECIPITATION']}
+
+
+def test_unpublished_days_are_requested_again(tmp_path):
+    write_station(tmp_path, '2011-03-15')
+    store_dir = str(tmp_path / 'store')
+    calls = []
+    fetcher = recording(local_fetcher(str(tmp_path)), calls)
+    get_snotel_data([STATION], '2011-03-01', '2011-03-31', store_dir=store_dir, fetcher=fetcher)
+    # only the days the service returned are marked fetched
+    assert fetched(store_dir)['SWE'] == [['2011-03-01', '2011-03-15']]
+    # the service publishes the rest of the month
+    write_station(tmp_path, '2011-03-31')
+    calls.clear()
+    data = get_snotel_data([STATION], '2011-03-01', '2011-03-31', store_dir=store_dir, fetcher=fetcher)
+    assert calls == [(pd.Timestamp('2011-03-16'), pd.Timestamp('2011-03-31'))]
+    assert data['datetime'].tolist() == pd.date_range('2011-03-01', '2011-03-31').tolist()
+
+
+def test_empty_response_is_not_recorded(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    calls = []
+    fetcher = recording(local_fetcher(str(tmp_path)), calls)
+    get_snotel_data([STATION], '2011-03-01', '2011-03-31', store_dir=store_dir, fetcher=fetcher)
+    get_snotel_data([STATION], '2011-03-01', '2011-03-31', store_dir=store_dir, fetcher=fetcher)
+    assert len(calls) == 2
+
+
+def test_new_variable_keeps_stored_columns(tmp_path):
+    write_station(tmp_path, '2011-09-30')
+    store_dir = str(tmp_path / 'store')
+    calls = []
+    fetcher = recording(local_fetcher(str(tmp_path)), calls)
+    get_snotel_data([STATION], '2011-01-01', '2011-03-31', store_dir=store_dir, fetcher=fetcher)
+    get_snotel_data([STATION], '2010-12-01', '2011-03-31', variables=['SWE', 'SNOWDEPTH'], store_dir=store_dir,
+                    fetcher=fetcher)
+    # December was never fetched with precipitation, so only it is requested
+    calls.clear()
+    data = get_snotel_data([STATION], '2010-12-01', '2011-03-31', store_dir=store_dir, fetcher=fetcher)
+    assert calls == [(pd.Timestamp('2010-12-01'), pd.Timestamp('2010-12-31'))]
+    expected = pd.read_csv(tmp_path / '515_WA_SNTL.csv', parse_dates=['datetime'])
+    expected = expected[expected['datetime'].between('2010-12-01', '2011-03-31')].reset_index(drop=True)
+    np.testing.assert_allclose(data['PRECIPITATION'], expected['PRECIPITATION'] * 25.4)
+    np.testing.assert_allclose(data['SWE'], expected['SWE'] * 25.4)
+    assert fetched(store_dir) == {'SWE': [['2010-12-01', '2011-03-31']],
+                                  'PRECIPITATION': [['2010-12-01', '2011-03-31']],
+                                  'SNOWDEPTH': [['2010-12-01', '2011-03-31']]}
+
+
+def test_metloom_variables(monkeypatch):
+    # a stand-in for metloom whose variables only exist under their metloom attribute names
+    class SnotelPointData:
+        ALLOWED_VARIABLES = types.SimpleNamespace(**{attr: f'sensor {attr}' for attr in
+                                                     ['SWE', 'PRECIPITATION', 'SNOWDEPTH', 'TEMPAVG', 'TEMPMAX',
+                                                      'TEMPMIN']})
+
+        def __init__(self, station_id, name):
+            pass
+
+        def get_daily_data(self, start, end, variables):
+            requested.extend(variables)
+            return None
+
+    requested = []
+    pointdata = types.ModuleType('metloom.pointdata')
+    pointdata.SnotelPointData = SnotelPointData
+    monkeypatch.setitem(sys.modules, 'metloom', types.ModuleType('metloom'))
+    monkeypatch.setitem(sys.modules, 'metloom.pointdata', pointdata)
+    assert set(METLOOM_VARIABLES) == set(SNOTEL_UNITS)
+    metloom_fetcher(STATION, 'Harts Pass', pd.Timestamp('2011-03-01'), pd.Timestamp('2011-03-31'),
+                    list(SNOTEL_UNITS))
+    assert requested == ['sensor SWE', 'sensor PRECIPITATION', 'sensor SNOWDEPTH', 'sensor TEMPAVG',
+                         'sensor TEMPMAX', 'sensor TEMPMIN']
+    with pytest.raises(ValueError, match='no metloom variable'):
+        metloom_fetcher(STATION, 'Harts Pass', pd.Timestamp('2011-03-01'), pd.Timestamp('2011-03-31'), ['TEMP'])
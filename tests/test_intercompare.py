@@ -0,0 +1,81 @@
+"""
+Tests the grouping of time steps in intercompare and composite_soundings,
+and the statistics of intercompare against scipy and numpy.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats as stats
+import xarray as xr
+
+from scripts.intercompare import intercompare, time_groups
+from scripts.soundings import _composite_groups
+
+TIME = pd.date_range('2001-01-01', periods=36, freq='MS')
+
+
+def cubes(seed=0):
+    rng = np.random.default_rng(seed)
+    coords = {'month': TIME, 'y': np.arange(4), 'x': np.arange(5)}
+    x = xr.DataArray(rng.gamma(2, 30, (TIME.size, 4, 5)), dims=('month', 'y', 'x'), coords=coords)
+    return x, x + rng.normal(0, 5, x.shape)
+
+
+@pytest.mark.parametrize('labels', [np.asarray, pd.Series, list], ids=['ndarray', 'series', 'list'])
+def test_label_arrays(labels):
+    groups = time_groups(TIME, labels(TIME.month.to_numpy()))
+    np.testing.assert_array_equal(groups, time_groups(TIME, 'month'))
+
+
+def test_intercompare_with_labels():
+    x, y = cubes()
+    pixel, spatial_mean = intercompare(x, y, groupby='month')
+    pixel_labels, spatial_mean_labels = intercompare(x, y, groupby=TIME.month.to_numpy())
+    xr.testing.assert_allclose(pixel, pixel_labels)
+    xr.testing.assert_allclose(spatial_mean, spatial_mean_labels)
+
+
+def test_bad_groupby():
+    with pytest.raises(ValueError):
+        time_groups(TIME, 'week')
+    with pytest.raises(ValueError):
+        time_groups(TIME, np.arange(5))
+
+
+def test_composite_groups():
+    np.testing.assert_array_equal(_composite_groups(TIME, 'hour'), TIME.hour.to_numpy())
+    # launch times are grouped batch by batch, so a fixed array of labels is refused with a clear error
+    with pytest.raises(ValueError, match='groupby must be'):
+        _composite_groups(TIME, TIME.month.to_numpy())
+
+
+@pytest.mark.parametrize('offset', [0, 1e8], ids=['small', 'large'])
+def test_statistics_match_scipy(offset):
+    # a long record of large values read in many batches, where raw moment sums cancel
+    rng = np.random.default_rng(1)
+    time = pd.date_range('1981-01-01', periods=5000, freq='D')
+    coords = {'month': time, 'y': [0], 'x': [0, 1]}
+    values = offset + rng.normal(0, 3, (time.size, 1, 2))
+    x = xr.DataArray(values, dims=('month', 'y', 'x'), coords=coords)
+    y = 0.8 * x + 0.2 * offset + rng.normal(0, 1, x.shape)
+    y[::17, 0, 1] = np.nan
+    pixel, spatial_mean = intercompare(x, y, groupby=None, batch_size=7)
+    for col in range(2):
+        xs, ys = x.values[:, 0, col], y.values[:, 0, col]
+        ok = np.isfinite(ys)
+        xs, ys = xs[ok], ys[ok]
+        fit = stats.linregress(xs, ys)
+        stat = pixel.isel(group=0, y=0, x=col)
+        assert stat['n'] == ok.sum()
+        np.testing.assert_allclose(stat['corr'], np.corrcoef(xs, ys)[0, 1], rtol=1e-9)
+        np.testing.assert_allclose(stat['slope'], fit.slope, rtol=1e-9)
+        np.testing.assert_allclose(stat['intercept'], fit.intercept, rtol=1e-9, atol=1e-9 * offset)
+        np.testing.assert_allclose(stat['p_value'], fit.pvalue, rtol=1e-6)
+        np.testing.assert_allclose(stat['rmse'], np.sqrt(np.mean((xs - ys) ** 2)), rtol=1e-9)
+        np.testing.assert_allclose(stat['mae'], np.mean(np.abs(xs - ys)), rtol=1e-9)
+        # the difference of two means of 1e8 keeps about 1e-8 absolute precision
+        np.testing.assert_allclose(stat['bias'], np.mean(ys - xs), atol=1e-9 + 1e-14 * offset)
+    both = np.isfinite(y.values[:, 0, 1])
+    x_mean = np.where(both, x.values[:, 0].mean(axis=-1), x.values[:, 0, 0])
+    y_mean = np.where(both, y.values[:, 0].mean(axis=-1), y.values[:, 0, 0])
+    np.testing.assert_allclose(spatial_mean['corr'].item(), np.corrcoef(x_mean, y_mean)[0, 1], rtol=1e-9)
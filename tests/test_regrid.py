@@ -0,0 +1,113 @@
+"""
+Tests the cached regridding weights: conservation of basin totals by the
+conservative weights and agreement of the nearest weights with
+rasterio's Resampling.nearest.
+"""
+import numpy as np
+import pyproj
+import pytest
+import shapely
+import xarray as xr
+
+from scripts.regrid import apply_regrid_weights, conservative_weights, nearest_weights, regrid, regrid_weights
+from scripts.zonal import basin_weights, grid_cells
+
+# a PRISM-like 1/24 degree grid and the IMERG 0.1 degree grid over part of the UCRB
+PRISM_X = np.arange(-108, -106, 1 / 24) + 1 / 48
+PRISM_Y = np.arange(40, 38, -1 / 24) - 1 / 48
+IMERG_X = np.arange(-108, -106, 0.1) + 0.05
+IMERG_Y = np.arange(40, 38, -0.1) - 0.05
+# a 1 km UTM 13N dem-like grid
+UTM_X = np.arange(200000, 360000, 1000) + 500
+UTM_Y = np.arange(4430000, 4230000, -1000) - 500
+
+
+def cube(x, y, n_months=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return xr.DataArray(rng.gamma(2, 30, (n_months, y.size, x.size)), dims=('month', 'y', 'x'),
+                        coords={'month': np.arange(n_months), 'y': y, 'x': x}, name='ppt')
+
+
+def basin_totals(da, basins):
+    # area weighted total of every basin and month
+    weights = basin_weights(da['x'].values, da['y'].values, basins)
+    _, cell_area = grid_cells(da['x'].values, da['y'].values)
+    return (weights @ da.values.reshape(da.shape[0], -1).T).T * cell_area
+
+
+def test_conservative_keeps_basin_totals():
+    prism = cube(PRISM_X, PRISM_Y)
+    regridded = regrid(prism, cube(IMERG_X, IMERG_Y, n_months=1).isel(month=0), method='conservative',
+                       src_crs=4326, dst_crs=4326, cache_dir=None)
+    # basins made of whole target cells, so both grids cover exactly the same area
+    basins = {'upper': shapely.box(-107.8, 38.5, -107.2, 39.3), 'lower': shapely.box(-107.0, 38.1, -106.3, 38.6),
+              'domain': shapely.box(-108, 38, -106, 40)}
+    np.testing.assert_allclose(basin_totals(regridded, basins), basin_totals(prism, basins), rtol=1e-10)
+
+
+def test_conservative_same_crs_matches_polygon_overlaps():
+    # target grid shifted off the source edges and wider than it, with the y axis ascending
+    dst_x = np.arange(-108.33, -105.8, 0.1) + 0.05
+    dst_y = np.arange(37.87, 40.2, 0.1) + 0.05
+    weights = conservative_weights(PRISM_X, PRISM_Y, 4326, dst_x, dst_y, 4326)
+    src_cells, _ = grid_cells(PRISM_X, PRISM_Y)
+    dst_cells, _ = grid_cells(dst_x, dst_y)
+    expected = shapely.area(shapely.intersection(dst_cells[:, None], src_cells[None, :]))
+    np.testing.assert_allclose(weights.toarray(), expected, atol=1e-14)
+
+
+def test_conservative_reprojected_mean():
+    # UTM source to the geographic target: a uniform field stays uniform and a linear one keeps its cell means
+    x0 = UTM_X - UTM_X.mean()
+    field = xr.DataArray(100 + 0.0002 * x0[None, :] + np.zeros((UTM_Y.size, 1)), dims=('y', 'x'),
+                         coords={'y': UTM_Y, 'x': UTM_X})
+    target = cube(IMERG_X, IMERG_Y, n_months=1).isel(month=0)
+    weights = regrid_weights(UTM_X, UTM_Y, 32613, IMERG_X, IMERG_Y, 4326, method='conservative', cache_dir=None)
+    uniform = apply_regrid_weights(weights, xr.full_like(field, 5.0), IMERG_X, IMERG_Y)
+    np.testing.assert_allclose(uniform.values[np.isfinite(uniform.values)], 5.0)
+    regridded = apply_regrid_weights(weights, field, IMERG_X, IMERG_Y)
+    # target cells fully covered by the source grid
+    covered = np.asarray(weights.sum(axis=1)).reshape(target.shape)
+    covered = covered > 0.999 * np.median(covered[covered > 0])
+    transformer = pyproj.Transformer.from_crs(4326, 32613, always_xy=True)
+    xx, _ = transformer.transform(*np.meshgrid(IMERG_X, IMERG_Y))
+    expected = 100 + 0.0002 * (xx - UTM_X.mean())
+    np.testing.assert_allclose(regridded.values[covered], expected[covered], rtol=1e-3)
+
+
+def brute_force_nearest(values, src_x, src_y, src_crs, dst_x, dst_y, dst_crs):
+    # the source cell holding every target cell center, found by distance to the source centers
+    transformer = pyproj.Transformer.from_crs(dst_crs, src_crs, always_xy=True)
+    xx, yy = transformer.transform(*np.meshgrid(dst_x, dst_y))
+    col = np.abs(xx[..., None] - src_x).argmin(axis=-1)
+    row = np.abs(yy[..., None] - src_y).argmin(axis=-1)
+    dx, dy = np.abs(src_x[1] - src_x[0]), np.abs(src_y[1] - src_y[0])
+    inside = ((xx >= src_x.min() - dx / 2) & (xx < src_x.max() + dx / 2)
+              & (yy > src_y.min() - dy / 2) & (yy <= src_y.max() + dy / 2))
+    return np.where(inside, values[row, col], np.nan)
+
+
+def test_nearest_picks_containing_cell():
+    dem = cube(UTM_X, UTM_Y, n_months=1).isel(month=0)
+    weights = nearest_weights(UTM_X, UTM_Y, 32613, IMERG_X, IMERG_Y, 4326)
+    regridded = apply_regrid_weights(weights, dem, IMERG_X, IMERG_Y)
+    expected = brute_force_nearest(dem.values, UTM_X, UTM_Y, 32613, IMERG_X, IMERG_Y, 4326)
+    np.testing.assert_array_equal(regridded.values, expected)
+
+
+def test_nearest_matches_rasterio():
+    pytest.importorskip('rasterio')
+    from rasterio.transform import from_origin
+    from rasterio.warp import Resampling, reproject
+
+    dem = cube(UTM_X, UTM_Y, n_months=1).isel(month=0)
+    destination = np.full((IMERG_Y.size, IMERG_X.size), np.nan)
+    reproject(dem.values, destination,
+              src_transform=from_origin(UTM_X[0] - 500, UTM_Y[0] + 500, 1000, 1000), src_crs='EPSG:32613',
+              dst_transform=from_origin(IMERG_X[0] - 0.05, IMERG_Y[0] + 0.05, 0.1, 0.1), dst_crs='EPSG:4326',
+              resampling=Resampling.nearest, src_nodata=np.nan, dst_nodata=np.nan, tolerance=0)
+    weights = nearest_weights(UTM_X, UTM_Y, 32613, IMERG_X, IMERG_Y, 4326)
+    regridded = apply_regrid_weights(weights, dem, IMERG_X, IMERG_Y).values
+    # centers falling on a source cell edge may round either way
+    same = (regridded == destination) | (np.isnan(regridded) & np.isnan(destination))
+    assert same.mean() > 0.999
@@ -0,0 +1,48 @@
+"""
+Tests the vectorized interpolation of soundings onto the common pressure grid
+against np.interp per sounding.
+"""
+import numpy as np
+import pandas as pd
+
+from scripts.soundings import grid_soundings
+
+
+def soundings(seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    # surface pressures on and off the grid, the last sounding has a single level
+    for i, (surface, top, n) in enumerate([(1040.0, 250.0, 60), (843.7, 300.0, 40), (700.0, 200.0, 80),
+                                           (650.0, 650.0, 1)]):
+        pres = np.sort(np.r_[surface, top, rng.uniform(top, surface, max(n - 2, 0))])[::-1][:n]
+        frames.append(pd.DataFrame({'sounding': i, 'pres': pres, 'launch_time': pd.Timestamp('2022-12-01') +
+                                    pd.Timedelta(hours=12 * i), 'tdry': rng.normal(-10, 10, n),
+                                    'u_wind': rng.normal(5, 3, n)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_grid_matches_interp():
+    df = soundings()
+    levels = np.r_[np.arange(1050, 190, -10), 843.7]
+    gridded = grid_soundings(df.sample(frac=1, random_state=0), levels=levels, variables=['tdry', 'u_wind'])
+    for i, group in df.groupby('sounding'):
+        # np.interp needs increasing x, -log(p) increases with height; the sorted key of grid_soundings offsets
+        # every sounding by 100, which costs a few digits
+        x = -np.log(group['pres'].to_numpy())
+        inside = (levels <= group['pres'].max()) & (levels >= group['pres'].min())
+        for var in ['tdry', 'u_wind']:
+            expected = np.where(inside, np.interp(-np.log(levels), x, group[var].to_numpy()), np.nan)
+            np.testing.assert_allclose(gridded[var].sel(sounding=i).values, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_first_and_last_levels_on_the_grid():
+    df = soundings()
+    gridded = grid_soundings(df, levels=[1040.0, 843.7, 700.0, 650.0, 300.0, 250.0, 200.0], variables=['tdry'])
+    tdry = gridded['tdry']
+    first = df.groupby('sounding').first()
+    last = df.groupby('sounding').last()
+    # a level equal to the first (surface) level of a sounding takes its value
+    for i in range(4):
+        assert tdry.sel(sounding=i, pres=first.loc[i, 'pres']).item() == first.loc[i, 'tdry']
+        assert tdry.sel(sounding=i, pres=last.loc[i, 'pres']).item() == last.loc[i, 'tdry']
+    assert np.isnan(tdry.sel(sounding=1, pres=1040.0).item())
@@ -0,0 +1,60 @@
+"""
+Tests the data-source registry and its cache on ARM-named files.
+"""
+import numpy as np
+import pytest
+import xarray as xr
+
+from scripts.sources import _sail_key, cache_stats, get_source
+from tests.test_get_sail_data import DATASTREAM, write_day_file
+
+
+def test_arm_files_window(tmp_path):
+    for day in ('20220817', '20220818', '20220819'):
+        write_day_file(tmp_path, day)
+    cache_dir = str(tmp_path / 'source_cache')
+    files = str(tmp_path / f'{DATASTREAM}.*.nc')
+    ds = get_source('arm_files', cache_dir=cache_dir, files=files, start='2022-08-18T06:00', end='2022-08-19')
+    assert ds['time'].values[0] == np.datetime64('2022-08-18T06:00')
+    assert ds['time'].values[-1] == np.datetime64('2022-08-19T00:00')
+    again = get_source('arm_files', cache_dir=cache_dir, files=files, start='2022-08-18T06:00', end='2022-08-19')
+    xr.testing.assert_identical(ds.load(), again.load())
+    assert cache_stats(cache_dir)['hits'] == 1
+
+
+def test_sail_key_ignores_downloads(tmp_path):
+    # a download fetches every file of the window, so filling the file cache keeps the key
+    stream_dir = tmp_path / DATASTREAM
+    stream_dir.mkdir()
+    params = dict(datastream=DATASTREAM, start='2022-08-18', end='2022-08-19', sail_cache_dir=str(tmp_path))
+    before = _sail_key(**params)
+    write_day_file(stream_dir, '20220818')
+    assert _sail_key(**params) == before
+
+
+def test_sail_local_only(tmp_path):
+    stream_dir = tmp_path / 'sail_cache' / DATASTREAM
+    stream_dir.mkdir(parents=True)
+    write_day_file(stream_dir, '20220818')
+    cache_dir = str(tmp_path / 'source_cache')
+    params = dict(datastream=DATASTREAM, start='2022-08-18', end='2022-08-19T12:00:00',
+                  sail_cache_dir=str(tmp_path / 'sail_cache'), local_only=True)
+    key = _sail_key(**params)
+    (stream_dir / f'{DATASTREAM}.20220819.000000.nc.part').write_bytes(b'partial')
+    assert _sail_key(**params) == key
+    get_source('sail', cache_dir=cache_dir, **params)
+    get_source('sail', cache_dir=cache_dir, **params)
+    assert cache_stats(cache_dir)['hits'] == 1
+    # the partial file completed inside the window is read by the next request
+    (stream_dir / f'{DATASTREAM}.20220819.000000.nc.part').unlink()
+    write_day_file(stream_dir, '20220819')
+    assert _sail_key(**params) != key
+
+
+def test_sail_without_data(tmp_path):
+    stream_dir = tmp_path / 'sail_cache' / DATASTREAM
+    stream_dir.mkdir(parents=True)
+    write_day_file(stream_dir, '20220818')
+    with pytest.raises(ValueError, match='sail loader returned no data'):
+        get_source('sail', cache_dir=str(tmp_path / 'source_cache'), datastream=DATASTREAM, start='2022-08-01',
+                   end='2022-08-02', sail_cache_dir=str(tmp_path / 'sail_cache'), local_only=True)
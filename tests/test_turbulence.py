@@ -0,0 +1,57 @@
+"""
+Tests the turbulence diagnostics on a synthetic tower and on a dataset
+without sensor variables.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from scripts.turbulence import turbulence_diagnostics
+
+KETTLE_PONDS_ECOR = os.path.join(os.path.dirname(__file__), '..', 'data',
+                                 'eddy_covariance_kettle_ponds_20220818_20220820.nc')
+SENSORS = [('3m', 'uw'), ('10m', 'uw'), ('2m', 'c'), ('10m', 'c')]
+
+
+def synthetic_tower(n=48, seed=0):
+    rng = np.random.default_rng(seed)
+    time = pd.date_range('2022-08-18', periods=n, freq='30min')
+    ds = xr.Dataset(coords={'time': time})
+    for height, tower in SENSORS:
+        suffix = f'_{height}_{tower}'
+        ds['tc' + suffix] = ('time', rng.uniform(0, 20, n))
+        ds['counts' + suffix] = ('time', np.full(n, 36000.0))
+        for quantity in ('u_u_', 'v_v_', 'w_w_'):
+            ds[quantity + suffix] = ('time', rng.uniform(0.1, 1, n))
+        for quantity in ('u_w_', 'v_w_', 'w_tc_', 'w_h2o_'):
+            ds[quantity + suffix] = ('time', rng.normal(0, 0.1, n))
+    return ds
+
+
+def test_matches_single_sensor():
+    ds = synthetic_tower()
+    ds['counts_2m_c'][:5] = 100
+    diagnostics = turbulence_diagnostics(ds, pressure=720.0)
+    sensor = diagnostics.sel(tower='c', height=2)
+    ustar = (ds['u_w__2m_c'] ** 2 + ds['v_w__2m_c'] ** 2) ** 0.25
+    density = 72000 / (287.05 * (ds['tc_2m_c'] + 273.15))
+    np.testing.assert_allclose(sensor['ustar'].values[5:], ustar.values[5:])
+    np.testing.assert_allclose(sensor['H'].values[5:], (density * 1005.0 * ds['w_tc__2m_c']).values[5:])
+    # periods with too few samples are masked
+    assert not sensor['qc'].values[:5].any() and np.isnan(sensor['ustar'].values[:5]).all()
+    # the c tower has no 3 m sonic in this dataset
+    assert np.isnan(diagnostics['ustar'].sel(tower='c', height=3)).all()
+
+
+def test_no_sensor_variables():
+    with xr.open_dataset(KETTLE_PONDS_ECOR) as ds:
+        with pytest.raises(ValueError, match='none of the sensor variables'):
+            turbulence_diagnostics(ds)
+
+
+def test_missing_quantity():
+    with pytest.raises(ValueError, match='w_h2o'):
+        turbulence_diagnostics(synthetic_tower().drop_vars([f'w_h2o__{h}_{t}' for h, t in SENSORS]))
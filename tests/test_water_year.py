@@ -0,0 +1,70 @@
+"""
+Tests the vectorized water year columns against row-wise pandas date
+arithmetic, including missing dates.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts.snow_events import days_until_meltout, snow_events
+from scripts.water_year import add_water_year_columns, day_of_water_year, water_year, water_year_start, yday_to_date
+
+# long enough to hold leap years, centuries and the 2000 leap century
+DAYS = pd.date_range('1895-01-01', '2105-12-31', freq='D')
+
+
+def expected_water_year(date, start_month):
+    return date.year + (start_month != 1 and date.month >= start_month)
+
+
+def expected_dowy(date, start_month):
+    start = pd.Timestamp(expected_water_year(date, start_month) - (start_month != 1), start_month, 1)
+    return (date - start).days + 1
+
+
+@pytest.mark.parametrize('start_month', [10, 1])
+def test_water_year_matches_row_wise(start_month):
+    dates = pd.Series(DAYS[::7])
+    np.testing.assert_array_equal(water_year(dates, start_month),
+                                  dates.apply(expected_water_year, start_month=start_month))
+    np.testing.assert_array_equal(day_of_water_year(dates, start_month),
+                                  dates.apply(expected_dowy, start_month=start_month))
+    # every day of a record, which takes the tabulated path
+    dowy = day_of_water_year(DAYS, start_month)
+    assert dowy.min() == 1 and dowy.max() == 366
+    assert water_year_start(water_year(DAYS, start_month), start_month)[0] <= DAYS[0]
+
+
+def test_timezone_aware_dates_use_local_days():
+    dates = pd.Series(pd.date_range('2021-09-30 20:00', periods=3, freq='h', tz='America/Denver'))
+    assert water_year(dates).tolist() == [2021, 2021, 2021]
+    assert water_year(dates.dt.tz_convert('UTC')).tolist() == [2022, 2022, 2022]
+
+
+def test_missing_dates():
+    dates = pd.Series(pd.to_datetime(['2022-10-05', None, '2022-09-30']), index=[3, 4, 5])
+    wy = water_year(dates)
+    assert wy.index.tolist() == [3, 4, 5]
+    np.testing.assert_array_equal(wy, [2023, np.nan, 2022])
+    np.testing.assert_array_equal(day_of_water_year(dates), [5, np.nan, 365])
+    np.testing.assert_array_equal(water_year(pd.DatetimeIndex([None, None])), [np.nan, np.nan])
+    df = add_water_year_columns(pd.DataFrame({'datetime': dates}))
+    np.testing.assert_array_equal(df['dowy'], [5, np.nan, 365])
+
+
+def test_yday_to_date():
+    dates = pd.Series(DAYS[::11])
+    np.testing.assert_array_equal(yday_to_date(dates.dt.year, dates.dt.dayofyear), dates)
+
+
+def test_snow_events_skip_missing_dates():
+    days = pd.date_range('2021-10-01', '2022-09-30', freq='D')
+    swe = np.r_[np.arange(183), np.arange(182)[::-1]].astype(float)
+    df = pd.DataFrame({'station': 'a', 'datetime': days, 'SWE': swe})
+    events = snow_events(df)
+    df.loc[[10, 200], 'datetime'] = pd.NaT
+    # the rows without a date are left out of their water year, not the whole frame
+    pd.testing.assert_frame_equal(snow_events(df), events)
+    until = days_until_meltout(df, events)
+    assert np.isnan(until[[10, 200]]).all()
+    assert until[11] == events['meltout_dowy'].iloc[0] - 12
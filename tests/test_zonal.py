@@ -0,0 +1,58 @@
+"""
+Tests that get_zonal_index reuses a saved index only for the same dem and
+basin polygons.
+"""
+import os
+
+import numpy as np
+import shapely
+
+from scripts.zonal import build_zonal_index, get_zonal_index
+
+X = np.arange(-108, -106, 0.1) + 0.05
+Y = np.arange(40, 38, -0.1) - 0.05
+
+
+def dem(offset=0):
+    xx, yy = np.meshgrid(X, Y)
+    return 2000 + 1000 * (xx - X.min()) + 500 * (yy - Y.min()) + offset
+
+
+BASINS = {'09124700': shapely.box(-107.83, 38.31, -107.22, 39.04), '09072500': shapely.box(-107.5, 39.1, -106.6, 39.8)}
+
+
+def assert_same_index(index, expected):
+    assert index['basins'] == expected['basins']
+    np.testing.assert_array_equal(index['bins'], expected['bins'])
+    for name in ('basin_weights', 'band_weights'):
+        np.testing.assert_allclose(index[name].toarray(), expected[name].toarray())
+
+
+def test_unchanged_index_is_reused(tmp_path):
+    path = str(tmp_path / 'index.npz')
+    get_zonal_index(path, X, Y, basins=BASINS, elevation=dem())
+    mtime = os.path.getmtime(path)
+    os.utime(path, (mtime - 100, mtime - 100))
+    index = get_zonal_index(path, X, Y, basins=BASINS, elevation=dem())
+    assert os.path.getmtime(path) == mtime - 100
+    assert_same_index(index, build_zonal_index(X, Y, basins=BASINS, elevation=dem()))
+
+
+def test_new_dem_rebuilds(tmp_path):
+    path = str(tmp_path / 'index.npz')
+    get_zonal_index(path, X, Y, basins=BASINS, elevation=dem())
+    index = get_zonal_index(path, X, Y, basins=BASINS, elevation=dem(offset=150))
+    assert_same_index(index, build_zonal_index(X, Y, basins=BASINS, elevation=dem(offset=150)))
+
+
+def test_redelineated_basin_is_recomputed(tmp_path):
+    path = str(tmp_path / 'index.npz')
+    get_zonal_index(path, X, Y, basins=BASINS, elevation=dem())
+    redelineated = {**BASINS, '09124700': shapely.box(-107.9, 38.2, -107.4, 38.9)}
+    index = get_zonal_index(path, X, Y, basins=redelineated, elevation=dem())
+    expected = build_zonal_index(X, Y, basins=redelineated, elevation=dem())
+    rows = [index['basins'].index(label) for label in expected['basins']]
+    np.testing.assert_allclose(index['basin_weights'][rows].toarray(), expected['basin_weights'].toarray())
+    # and the saved index holds the new polygon
+    index = get_zonal_index(path, X, Y, basins=redelineated)
+    np.testing.assert_allclose(index['basin_weights'][rows].toarray(), expected['basin_weights'].toarray())